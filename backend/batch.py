@@ -0,0 +1,430 @@
+import asyncio
+import json
+import os
+import time
+import uuid
+
+from logger import log
+from model_registry import model_registry
+from scheduler import QueueFullError, scheduler
+
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", "4"))
+BATCH_TIMEOUT = int(os.environ.get("BATCH_TIMEOUT", "300"))
+BATCH_DIR = os.environ.get("BATCH_DIR", os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "batch_jobs"))
+# Rows buffered per Parquet row group; JSONL is flushed on every result
+BATCH_PARQUET_ROW_GROUP = int(os.environ.get("BATCH_PARQUET_ROW_GROUP", "64"))
+# Seconds a pair waits before going back in line when the scheduler's queue is full
+BATCH_QUEUE_FULL_BACKOFF = float(os.environ.get("BATCH_QUEUE_FULL_BACKOFF", "2"))
+
+
+class BatchInputError(ValueError):
+    pass
+
+
+def parse_concurrency(value) -> int:
+    """A job's concurrency as sent by a client: a whole number, at least 1"""
+    try:
+        concurrency = int(value)
+    except (TypeError, ValueError):
+        raise BatchInputError(f"concurrency must be a whole number, not {value!r}")
+    if concurrency < 1:
+        raise BatchInputError(f"concurrency must be at least 1, not {concurrency}")
+    return concurrency
+
+
+def load_questions(lines):
+    """Parse JSONL question records into (id, question, options) tuples
+
+    Accepts {"question": ...} or {"prompt": ...} records, and backlog-style
+    {"request_id", "title", "body"} records. Blank lines are skipped.
+    """
+    questions = []
+    seen = set()
+    for number, line in enumerate(lines, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError as e:
+            raise BatchInputError(f"Line {number}: invalid JSON ({e})")
+        if isinstance(record, str):
+            record = {"question": record}
+        question = record.get("question") or record.get("prompt")
+        if not question and (record.get("title") or record.get("body")):
+            question = "\n\n".join(part for part in (record.get("title"), record.get("body")) if part)
+        if not question:
+            raise BatchInputError(f"Line {number}: no question, prompt or body field")
+        question_id = str(record.get("id") or record.get("request_id") or number)
+        if question_id in seen:
+            raise BatchInputError(f"Line {number}: duplicate id {question_id}")
+        seen.add(question_id)
+        questions.append((question_id, question.strip(), {
+            "responseLength": record.get("responseLength"),
+            "customLength": record.get("customLength"),
+        }))
+    return questions
+
+
+def select_models(names=None):
+    """(display name, entry) pairs for the named models, or every installed model"""
+    if not names:
+        return list(model_registry.models.items())
+    models = []
+    for name in names:
+        entry = model_registry.get(name)
+        if entry is None:
+            raise BatchInputError(f"Model {name} not found")
+        models.append((entry["display_name"], entry))
+    return models
+
+
+class _FrameSink:
+    """Stands in for the WebSocket; keeps the final completed or error frame"""
+
+    def __init__(self):
+        self.final = None
+
+    async def send_text(self, payload: str):
+        # Deltas are the bulk of the traffic and are not needed here
+        if '"completed"' in payload or '"error"' in payload:
+            self.final = json.loads(payload)
+
+    async def send_message(self, message: dict):
+        if message.get("status") in ("completed", "error"):
+            self.final = message
+
+
+class JsonlSink:
+    """Appends one JSON object per line, flushed as each result arrives"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.checkpoint_path = path
+        self._file = None
+
+    def open(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        partial_line = False
+        if os.path.exists(self.path) and os.path.getsize(self.path):
+            with open(self.path, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                partial_line = f.read(1) != b"\n"
+        self._file = open(self.path, "a", encoding="utf-8")
+        if partial_line:
+            # A run killed mid-write left half a line; start on a fresh one
+            self._file.write("\n")
+
+    def write(self, record: dict):
+        self._file.write(json.dumps(record) + "\n")
+        self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class ParquetSink:
+    """Writes row groups to a new part file in a Parquet dataset directory
+
+    Needs pyarrow. Each run adds a part file, so resuming never rewrites what an
+    earlier run produced; finished pairs are tracked in _checkpoint.jsonl.
+    """
+
+    COLUMNS = ("id", "model", "model_tag", "question", "response", "error", "cached",
+               "eval_count", "tokens_per_second", "time_to_first_token", "total_seconds", "seconds", "finished_at")
+
+    def __init__(self, path: str, row_group_size: int = BATCH_PARQUET_ROW_GROUP):
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise BatchInputError("Parquet output needs pyarrow (pip install pyarrow)")
+        self.path = path
+        self.checkpoint_path = os.path.join(path, "_checkpoint.jsonl")
+        self.row_group_size = row_group_size
+        self._checkpoint = JsonlSink(self.checkpoint_path)
+        self._rows = []
+        self._writer = None
+
+    def open(self):
+        os.makedirs(self.path, exist_ok=True)
+        self._checkpoint.open()
+
+    def write(self, record: dict):
+        self._rows.append(record)
+        if len(self._rows) >= self.row_group_size:
+            self._flush()
+        self._checkpoint.write({"id": record["id"], "model": record["model"], "error": record["error"]})
+
+    def _flush(self):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        if not self._rows:
+            return
+        table = pa.table({column: [row.get(column) for row in self._rows] for column in self.COLUMNS})
+        if self._writer is None:
+            part = sum(1 for name in os.listdir(self.path) if name.endswith(".parquet"))
+            self._writer = pq.ParquetWriter(os.path.join(self.path, f"part-{part:05d}.parquet"), table.schema)
+        else:
+            table = table.cast(self._writer.schema)
+        self._writer.write_table(table)
+        self._rows.clear()
+
+    def close(self):
+        self._flush()
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        self._checkpoint.close()
+
+
+def make_sink(path: str, output_format: str = None):
+    output_format = output_format or ("parquet" if path.endswith(".parquet") else "jsonl")
+    if output_format == "parquet":
+        return ParquetSink(path)
+    if output_format == "jsonl":
+        return JsonlSink(path)
+    raise BatchInputError(f"Unknown output format {output_format}")
+
+
+def finished_pairs(checkpoint_path: str, retry_errors: bool = True) -> set:
+    """(question id, model) pairs an earlier run already wrote"""
+    done = set()
+    if not os.path.exists(checkpoint_path):
+        return done
+    with open(checkpoint_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # the partial line of an interrupted write
+            if retry_errors and record.get("error"):
+                continue
+            done.add((str(record.get("id")), record.get("model")))
+    return done
+
+
+class BatchJob:
+    """Runs every (question, model) pair through the same path as the WebSocket"""
+
+    def __init__(self, job_id: str, questions, models, sink, generate, make_prompt,
+                 response_length: str = "medium", custom_length: str = "10",
+                 concurrency: int = BATCH_CONCURRENCY, order: str = "model",
+                 use_cache: bool = True, retry_errors: bool = True, timeout: int = BATCH_TIMEOUT):
+        self.job_id = job_id
+        self.questions = questions
+        self.models = models  # (display name, registry entry) pairs
+        self.sink = sink
+        self._generate = generate
+        self._make_prompt = make_prompt
+        self.response_length = response_length
+        self.custom_length = custom_length
+        self.concurrency = max(1, concurrency)
+        self.order = order
+        self.use_cache = use_cache
+        self.retry_errors = retry_errors
+        self.timeout = timeout
+        self.status = "pending"
+        self.error = None
+        self.task = None
+        self.total = len(questions) * len(models)
+        self.skipped = 0
+        self.completed = 0
+        self.failed = 0
+        self.tokens = 0
+        self.started_at = None
+        self.finished_at = None
+        self._rate = None  # pairs per second, smoothed
+
+    def pairs(self, done: set):
+        """Pairs still to run. Model-major order keeps each model loaded for its whole pass"""
+        if self.order == "question":
+            combos = ((q, m) for q in self.questions for m in self.models)
+        else:
+            combos = ((q, m) for m in self.models for q in self.questions)
+        return [(q, m) for q, m in combos if (q[0], m[0]) not in done]
+
+    async def run(self):
+        self.status = "running"
+        self.started_at = time.time()
+        self.sink.open()
+        try:
+            done = finished_pairs(self.sink.checkpoint_path, self.retry_errors)
+            pending = self.pairs(done)
+            self.skipped = self.total - len(pending)
+            queue = asyncio.Queue()
+            for pair in pending:
+                queue.put_nowait(pair)
+            workers = [asyncio.create_task(self._worker(queue)) for _ in range(min(self.concurrency, len(pending)))]
+            try:
+                await asyncio.gather(*workers)
+            finally:
+                for worker in workers:
+                    worker.cancel()
+            self.status = "completed"
+        except asyncio.CancelledError:
+            self.status = "cancelled"
+            raise
+        except Exception as e:
+            self.status = "failed"
+            self.error = str(e)
+            raise
+        finally:
+            self.sink.close()
+            self.finished_at = time.time()
+
+    async def _worker(self, queue: asyncio.Queue):
+        session = f"batch:{self.job_id}"
+        while not queue.empty():
+            pair = queue.get_nowait()
+            (question_id, question, options), (model_name, config) = pair
+            try:
+                # Batch work queues behind interactive sessions fairly, as one more session
+                async with scheduler.slot(session, config["model_name"], self.concurrency):
+                    record = await self._run_pair(question_id, question, options, model_name, config)
+            except QueueFullError:
+                # Interactive traffic filled the queue; try again once it has drained a little
+                queue.put_nowait(pair)
+                await asyncio.sleep(BATCH_QUEUE_FULL_BACKOFF)
+                continue
+            except Exception as e:
+                # One pair going wrong doesn't end the job; its error row is retried on resume
+                log.warning("batch_pair_failed", job=self.job_id, id=question_id, model=model_name, error=repr(e))
+                record = self._record(question_id, question, model_name, config, error=f"{type(e).__name__}: {e}")
+            try:
+                self.sink.write(record)
+            except Exception as e:
+                # Not checkpointed either, so a resumed job runs the pair again
+                log.warning("batch_write_failed", job=self.job_id, id=question_id, model=model_name, error=repr(e))
+                record = {**record, "error": f"could not write result: {e}"}
+            self._account(record)
+
+    async def _run_pair(self, question_id, question, options, model_name, config) -> dict:
+        response_length = options.get("responseLength") or self.response_length
+        custom_length = options.get("customLength") or self.custom_length
+        prompt = self._make_prompt(question, response_length, custom_length)
+        sink = _FrameSink()
+        started = time.monotonic()
+        result = await self._generate(
+            config["model_name"], prompt, sink, display_name=model_name, response_length=response_length,
+            session_id=f"batch:{self.job_id}", timeout=self.timeout, use_cache=self.use_cache, protocol=2,
+            custom_length=custom_length,
+        )
+        final = sink.final or {}
+        stats = final.get("stats") or {}
+        error = final.get("error") if final.get("status") == "error" else None
+        if error is None and isinstance(result, str) and result.startswith("Error:"):
+            error = result[len("Error: "):]
+        return self._record(question_id, question, model_name, config, None if error else result, error,
+                            cached=bool(final.get("cached")), stats=stats, seconds=time.monotonic() - started)
+
+    @staticmethod
+    def _record(question_id, question, model_name, config, response=None, error=None,
+                cached: bool = False, stats=None, seconds: float = 0.0) -> dict:
+        """One output row; every sink writes the same columns"""
+        stats = stats or {}
+        return {
+            "id": question_id,
+            "model": model_name,
+            "model_tag": config["model_name"],
+            "question": question,
+            "response": response,
+            "error": error,
+            "cached": cached,
+            "eval_count": stats.get("evalCount"),
+            "tokens_per_second": stats.get("tokensPerSecond"),
+            "time_to_first_token": stats.get("timeToFirstToken"),
+            "total_seconds": stats.get("totalSeconds"),
+            "seconds": round(seconds, 3),
+            "finished_at": time.time(),
+        }
+
+    def _account(self, record: dict):
+        if record["error"]:
+            self.failed += 1
+        else:
+            self.completed += 1
+        self.tokens += record["eval_count"] or 0
+        elapsed = time.time() - self.started_at
+        processed = self.completed + self.failed
+        if elapsed > 0:
+            rate = processed / elapsed
+            self._rate = rate if self._rate is None else 0.8 * self._rate + 0.2 * rate
+
+    def progress(self) -> dict:
+        processed = self.completed + self.failed
+        remaining = max(0, self.total - self.skipped - processed)
+        elapsed = (self.finished_at or time.time()) - self.started_at if self.started_at else 0.0
+        return {
+            "jobId": self.job_id,
+            "status": self.status,
+            "error": self.error,
+            "total": self.total,
+            "skipped": self.skipped,
+            "completed": self.completed,
+            "failed": self.failed,
+            "remaining": remaining,
+            "tokens": self.tokens,
+            "elapsedSeconds": round(elapsed, 1),
+            "pairsPerMinute": round(processed / elapsed * 60, 2) if elapsed else None,
+            "tokensPerSecond": round(self.tokens / elapsed, 2) if elapsed else None,
+            "etaSeconds": round(remaining / self._rate) if self._rate and self.status == "running" else None,
+            "output": self.sink.path,
+        }
+
+
+class BatchJobs:
+    """Jobs started through the REST API, by ID"""
+
+    def __init__(self, directory: str = BATCH_DIR):
+        self.directory = directory
+        self._jobs = {}
+
+    def new_id(self) -> str:
+        return uuid.uuid4().hex[:12]
+
+    def output_path(self, job_id: str, output_format: str) -> str:
+        if not job_id or not all(c.isalnum() or c in "-_" for c in job_id):
+            raise BatchInputError("Job IDs may only contain letters, digits, - and _")
+        return os.path.join(self.directory, f"{job_id}.{output_format}")
+
+    def input_path(self, name: str) -> str:
+        """An input file under the batch directory; the API must not open arbitrary server files"""
+        root = os.path.realpath(self.directory)
+        path = os.path.realpath(os.path.join(root, name))
+        if os.path.commonpath([root, path]) != root:
+            raise BatchInputError(f"Input files must be inside {self.directory}")
+        return path
+
+    def get(self, job_id: str):
+        return self._jobs.get(job_id)
+
+    def start(self, job: BatchJob):
+        existing = self._jobs.get(job.job_id)
+        if existing is not None and existing.status == "running":
+            raise BatchInputError(f"Job {job.job_id} is already running")
+        self._jobs[job.job_id] = job
+        job.task = asyncio.create_task(job.run())
+        # Failures are reported through progress(); don't log them as unretrieved
+        job.task.add_done_callback(lambda task: task.cancelled() or task.exception())
+        return job
+
+    async def cancel(self, job_id: str):
+        job = self._jobs.get(job_id)
+        if job is None or job.task is None or job.task.done():
+            return job
+        job.task.cancel()
+        await asyncio.gather(job.task, return_exceptions=True)
+        return job
+
+    async def close(self):
+        for job_id in list(self._jobs):
+            await self.cancel(job_id)
+
+    def list(self):
+        return [job.progress() for job in self._jobs.values()]
+
+
+batch_jobs = BatchJobs()
@@ -0,0 +1,159 @@
+import array
+import collections
+import os
+import time
+
+import metrics
+
+# Packed context arrays kept across every conversation; least recently used go first
+CONVERSATION_MAX_MB = float(os.environ.get("CONVERSATION_MAX_MB", "32"))
+# Seconds a conversation can sit idle before its contexts are dropped
+CONVERSATION_TTL = float(os.environ.get("CONVERSATION_TTL", "3600"))
+
+context_tokens_reused = metrics.registry.counter(
+    "compare_context_tokens_reused_total", "Conversation tokens follow-ups did not have to evaluate again",
+    labelnames=("model",))
+prompt_seconds_saved = metrics.registry.counter(
+    "compare_context_prompt_seconds_saved_total", "Estimated prompt evaluation seconds saved by reusing a context",
+    labelnames=("model",))
+
+
+class _Context:
+    __slots__ = ("tokens", "turns", "touched_at")
+
+    def __init__(self, tokens: array.array, turns: int):
+        self.tokens = tokens
+        self.turns = turns
+        self.touched_at = time.monotonic()
+
+    @property
+    def bytes(self) -> int:
+        return len(self.tokens) * self.tokens.itemsize
+
+
+class ConversationStore:
+    """Each model's Ollama context per conversation, for follow-up questions
+
+    /api/generate ends with a context array: the token IDs of the conversation
+    so far. Sending it back with the next prompt continues the conversation,
+    and Ollama skips evaluating that prefix again while the model still holds
+    it in its KV cache. Contexts are packed as int32 arrays, dropped after
+    CONVERSATION_TTL idle seconds, and evicted least recently used first
+    beyond CONVERSATION_MAX_MB.
+    """
+
+    def __init__(self, max_bytes: int = int(CONVERSATION_MAX_MB * 1024 * 1024), ttl: float = CONVERSATION_TTL):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._contexts = collections.OrderedDict()  # (conversation, model) -> _Context
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.expired = 0
+        self.follow_ups = 0
+        self.prefix_reused = 0
+        self.tokens_reused = 0
+        self.prompt_tokens_evaluated = 0
+        self.prompt_seconds_saved = 0.0
+
+    def get(self, conversation_id: str, model: str):
+        """The context to send with this model's next turn, or None on a first turn"""
+        self._purge()
+        key = (conversation_id, model)
+        entry = self._contexts.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._contexts.move_to_end(key)
+        entry.touched_at = time.monotonic()
+        self.hits += 1
+        return entry.tokens.tolist()
+
+    def put(self, conversation_id: str, model: str, context: list):
+        key = (conversation_id, model)
+        previous = self._contexts.pop(key, None)
+        if previous is not None:
+            self.bytes -= previous.bytes
+        entry = _Context(array.array("i", context), previous.turns + 1 if previous else 1)
+        if entry.bytes > self.max_bytes:
+            # Larger than the whole budget; the next turn starts over
+            return
+        self._contexts[key] = entry
+        self.bytes += entry.bytes
+        self.stores += 1
+        while self.bytes > self.max_bytes:
+            _, evicted = self._contexts.popitem(last=False)
+            self.bytes -= evicted.bytes
+            self.evictions += 1
+
+    def drop(self, conversation_id: str) -> int:
+        """Forget every model's context in a conversation"""
+        keys = [key for key in self._contexts if key[0] == conversation_id]
+        for key in keys:
+            self.bytes -= self._contexts.pop(key).bytes
+        return len(keys)
+
+    def record_follow_up(self, model: str, context_tokens: int, done: dict, record: bool = True) -> dict:
+        """What reusing a context of context_tokens saved on one follow-up
+
+        Ollama only counts the tokens it evaluated. Fewer than the context
+        means the prefix came from the KV cache; the saving is that prefix at
+        this turn's prompt evaluation rate.
+        """
+        evaluated = done.get("prompt_eval_count") or 0
+        duration = (done.get("prompt_eval_duration") or 0) / 1e9
+        reused = context_tokens if evaluated < context_tokens else 0
+        rate = evaluated / duration if evaluated and duration else None
+        seconds = reused / rate if reused and rate else 0.0
+        if record:
+            self.follow_ups += 1
+            self.prompt_tokens_evaluated += evaluated
+            if reused:
+                self.prefix_reused += 1
+                self.tokens_reused += reused
+                self.prompt_seconds_saved += seconds
+                context_tokens_reused.inc(reused, model=model)
+                prompt_seconds_saved.inc(seconds, model=model)
+        return {
+            "contextTokens": context_tokens,
+            "contextReused": bool(reused),
+            "promptEvalSecondsSaved": round(seconds, 3),
+        }
+
+    def _purge(self):
+        if self.ttl <= 0:
+            return
+        cutoff = time.monotonic() - self.ttl
+        # Least recently used first, so stop at the first one still fresh
+        while self._contexts:
+            key, entry = next(iter(self._contexts.items()))
+            if entry.touched_at > cutoff:
+                break
+            del self._contexts[key]
+            self.bytes -= entry.bytes
+            self.expired += 1
+
+    def stats(self) -> dict:
+        self._purge()
+        return {
+            "max_bytes": self.max_bytes,
+            "ttl_seconds": self.ttl,
+            "bytes": self.bytes,
+            "contexts": len(self._contexts),
+            "conversations": len({conversation for conversation, _ in self._contexts}),
+            "hits": self.hits,
+            "misses": self.misses,
+            "stores": self.stores,
+            "evictions": self.evictions,
+            "expired": self.expired,
+            "follow_ups": self.follow_ups,
+            "prefix_reused": self.prefix_reused,
+            "tokens_reused": self.tokens_reused,
+            "prompt_tokens_evaluated": self.prompt_tokens_evaluated,
+            "prompt_seconds_saved": round(self.prompt_seconds_saved, 3),
+        }
+
+
+conversations = ConversationStore()
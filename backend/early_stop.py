@@ -0,0 +1,132 @@
+import os
+import time
+
+import metrics
+
+# Modes that stop as soon as they have enough answers and cancel the rest
+EARLY_STOP_MODES = ("race", "top_k", "quorum")
+# Answers top_k waits for, and how many must agree for quorum, unless the request sends "k"
+EARLY_STOP_K = int(os.environ.get("EARLY_STOP_K", "3"))
+# Similarity (from the scoring backend) at which two answers count as agreeing
+QUORUM_SIMILARITY = float(os.environ.get("QUORUM_SIMILARITY", "0.5"))
+
+time_to_answer = metrics.registry.histogram(
+    "compare_time_to_answer_seconds", "Seconds from a question to the answer an early-stop mode settled on",
+    labelnames=("mode",))
+gpu_seconds_saved = metrics.registry.counter(
+    "compare_early_stop_gpu_seconds_saved_total", "Estimated generation seconds not spent because a mode stopped early",
+    labelnames=("mode",))
+
+
+class EarlyStop:
+    """Decides when a race, top_k or quorum session has the answers it needs
+
+    race wants the first successful answer, top_k the first k, and quorum k
+    answers that agree with one of them. Models are added as they finish;
+    once reached is set, whatever is still running can be cancelled.
+    """
+
+    def __init__(self, mode: str, k=None, threshold: float = QUORUM_SIMILARITY):
+        self.mode = mode
+        try:
+            k = int(k) if k is not None else EARLY_STOP_K
+        except (TypeError, ValueError):
+            k = EARLY_STOP_K
+        if mode == "race":
+            k = 1
+        elif mode == "quorum":
+            k = max(2, k)
+        self.k = max(1, k)
+        self.threshold = threshold
+        self.started_at = time.monotonic()
+        self.answers = []  # (model, seconds since the question) in finishing order
+        self.answered_by = []
+        self.seconds_to_answer = None
+        self.cancelled = []  # savings reports of the generations stopped
+
+    @property
+    def reached(self) -> bool:
+        return self.seconds_to_answer is not None
+
+    def add(self, model: str, scorer) -> bool:
+        """Count a successful answer (already added to scorer); True once the mode is satisfied"""
+        self.answers.append((model, time.monotonic() - self.started_at))
+        if self.reached:
+            return True
+        if self.mode == "quorum":
+            group = scorer.agreement(self.threshold)
+        else:
+            group = [name for name, _ in self.answers]
+        if len(group) >= self.k:
+            self.answered_by = group if self.mode == "quorum" else group[:self.k]
+            self.seconds_to_answer = self.answers[-1][1]
+            time_to_answer.observe(self.seconds_to_answer, mode=self.mode)
+        return self.reached
+
+    def stopped(self, reports: list):
+        """Record the generations cancelled once the answer was in"""
+        self.cancelled.extend(reports)
+        saved = sum(report["secondsSaved"] or 0 for report in reports)
+        if saved:
+            gpu_seconds_saved.inc(saved, mode=self.mode)
+
+    def report(self) -> dict:
+        """Time to the answer against running every model to the end, as parallel would"""
+        seconds_saved = sum(report["secondsSaved"] or 0 for report in self.cancelled)
+        # A cancelled model would have finished after what it had run plus what it saved
+        finish_times = [seconds for _, seconds in self.answers] + [
+            report["secondsElapsed"] + (report["secondsSaved"] or 0) for report in self.cancelled
+        ]
+        return {
+            "mode": self.mode,
+            "k": self.k,
+            "reached": self.reached,
+            "answeredBy": self.answered_by,
+            "secondsToAnswer": round(self.seconds_to_answer, 2) if self.reached else None,
+            "estimatedParallelSeconds": round(max(finish_times), 2) if finish_times else None,
+            "cancelled": len(self.cancelled),
+            "tokensSaved": sum(report["tokensSaved"] for report in self.cancelled),
+            "gpuSecondsSaved": round(seconds_saved, 2),
+        }
+
+
+class EarlyStopStats:
+    def __init__(self):
+        self.modes = {}
+
+    def record(self, stop: EarlyStop):
+        report = stop.report()
+        totals = self.modes.setdefault(stop.mode, {
+            "sessions": 0, "reached": 0, "seconds_to_answer": 0.0, "parallel_seconds": 0.0,
+            "cancelled_generations": 0, "tokens_saved": 0, "gpu_seconds_saved": 0.0,
+        })
+        totals["sessions"] += 1
+        totals["cancelled_generations"] += report["cancelled"]
+        totals["tokens_saved"] += report["tokensSaved"]
+        totals["gpu_seconds_saved"] += report["gpuSecondsSaved"]
+        if stop.reached:
+            totals["reached"] += 1
+            totals["seconds_to_answer"] += report["secondsToAnswer"]
+            totals["parallel_seconds"] += report["estimatedParallelSeconds"] or 0.0
+
+    def stats(self) -> dict:
+        modes = {}
+        for mode, totals in self.modes.items():
+            reached = totals["reached"]
+            modes[mode] = {
+                "sessions": totals["sessions"],
+                "reached": reached,
+                "avg_seconds_to_answer": round(totals["seconds_to_answer"] / reached, 2) if reached else None,
+                "avg_estimated_parallel_seconds": round(totals["parallel_seconds"] / reached, 2) if reached else None,
+                "cancelled_generations": totals["cancelled_generations"],
+                "tokens_saved": totals["tokens_saved"],
+                "gpu_seconds_saved": round(totals["gpu_seconds_saved"], 2),
+            }
+        return {
+            "default_k": EARLY_STOP_K,
+            "quorum_similarity": QUORUM_SIMILARITY,
+            "modes": modes,
+        }
+
+
+early_stop_stats = EarlyStopStats()
@@ -0,0 +1,374 @@
+import asyncio
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+from logger import log
+
+HISTORY_ENABLED = os.environ.get("HISTORY_ENABLED", "1") == "1"
+HISTORY_PATH = os.environ.get("HISTORY_PATH", os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "history.db"))
+# Oldest sessions are pruned once the database grows past this
+HISTORY_MAX_MB = float(os.environ.get("HISTORY_MAX_MB", "200"))
+# Writes are committed in one transaction per interval (or per batch, if sooner)
+HISTORY_FLUSH_INTERVAL = float(os.environ.get("HISTORY_FLUSH_INTERVAL", "0.5"))
+HISTORY_BATCH_SIZE = int(os.environ.get("HISTORY_BATCH_SIZE", "200"))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    session_id TEXT PRIMARY KEY,
+    created REAL NOT NULL,
+    updated REAL NOT NULL,
+    question TEXT NOT NULL,
+    options TEXT NOT NULL,
+    models TEXT NOT NULL,
+    status TEXT NOT NULL,
+    best TEXT
+);
+CREATE INDEX IF NOT EXISTS sessions_created ON sessions (created);
+CREATE TABLE IF NOT EXISTS responses (
+    session_id TEXT NOT NULL,
+    model TEXT NOT NULL,
+    model_tag TEXT,
+    response TEXT,
+    error TEXT,
+    stats TEXT,
+    cached INTEGER NOT NULL DEFAULT 0,
+    created REAL NOT NULL,
+    PRIMARY KEY (session_id, model)
+);
+"""
+
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS history_fts USING fts5(
+    session_id UNINDEXED, model UNINDEXED, content, tokenize='porter unicode61'
+);
+"""
+
+
+def fts5_available() -> bool:
+    conn = sqlite3.connect(":memory:")
+    try:
+        conn.execute("CREATE VIRTUAL TABLE probe USING fts5(content)")
+        return True
+    except sqlite3.OperationalError:
+        return False
+    finally:
+        conn.close()
+
+
+def fts_query(text: str) -> str:
+    """Turn free text into an FTS5 query of quoted terms, so user input can't be a syntax error"""
+    terms = [term.replace('"', '""') for term in text.split()]
+    return " ".join(f'"{term}"' for term in terms if term)
+
+
+class _HistoryWriter(threading.Thread):
+    """Owns the write connection; applies queued writes in batched transactions"""
+
+    def __init__(self, path: str, fts: bool, max_bytes: int):
+        super().__init__(name="history-writer", daemon=True)
+        self.path = path
+        self.fts = fts
+        self.max_bytes = max_bytes
+        self.queue = queue.Queue()
+        self.batches = 0
+        self.writes = 0
+        self.pruned_sessions = 0
+        self.errors = 0
+        self.last_error = None
+
+    def run(self):
+        conn = sqlite3.connect(self.path)
+        try:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    return
+                batch = [item]
+                deadline = time.monotonic() + HISTORY_FLUSH_INTERVAL
+                while len(batch) < HISTORY_BATCH_SIZE:
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = self.queue.get(timeout=timeout)
+                    except queue.Empty:
+                        break
+                    if item is None:
+                        self._apply(conn, batch)
+                        return
+                    batch.append(item)
+                self._apply(conn, batch)
+        finally:
+            conn.close()
+
+    def _apply(self, conn, batch):
+        try:
+            with conn:
+                for op, args in batch:
+                    getattr(self, f"_op_{op}")(conn, *args)
+            self.batches += 1
+            self.writes += len(batch)
+            self._prune(conn)
+        except sqlite3.Error as e:
+            self.errors += 1
+            self.last_error = str(e)
+            log.error("history_write_failed", error=str(e))
+        finally:
+            for _ in batch:
+                self.queue.task_done()
+
+    def _op_session(self, conn, session_id, created, question, options, models):
+        conn.execute(
+            "INSERT OR REPLACE INTO sessions (session_id, created, updated, question, options, models, status) "
+            "VALUES (?, ?, ?, ?, ?, ?, 'running')",
+            (session_id, created, created, question, json.dumps(options), json.dumps(models)),
+        )
+        # Re-running a session ID starts it over
+        conn.execute("DELETE FROM responses WHERE session_id = ?", (session_id,))
+        if self.fts:
+            conn.execute("DELETE FROM history_fts WHERE session_id = ?", (session_id,))
+            conn.execute("INSERT INTO history_fts (session_id, model, content) VALUES (?, '', ?)", (session_id, question))
+
+    def _op_response(self, conn, session_id, model, model_tag, response, error, stats, cached, created):
+        conn.execute(
+            "INSERT OR REPLACE INTO responses (session_id, model, model_tag, response, error, stats, cached, created) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (session_id, model, model_tag, response, error, json.dumps(stats) if stats else None, int(cached), created),
+        )
+        conn.execute("UPDATE sessions SET updated = ? WHERE session_id = ?", (created, session_id))
+        if self.fts:
+            # A model's response replaces its earlier one, in the index too
+            conn.execute("DELETE FROM history_fts WHERE session_id = ? AND model = ?", (session_id, model))
+        if self.fts and response:
+            conn.execute("INSERT INTO history_fts (session_id, model, content) VALUES (?, ?, ?)",
+                         (session_id, model, response))
+
+    def _op_finish(self, conn, session_id, status, best, updated):
+        conn.execute("UPDATE sessions SET status = ?, best = ?, updated = ? WHERE session_id = ?",
+                     (status, best, updated, session_id))
+
+    def _op_delete(self, conn, session_id):
+        self._delete_sessions(conn, [session_id])
+
+    def _delete_sessions(self, conn, session_ids):
+        marks = ",".join("?" * len(session_ids))
+        conn.execute(f"DELETE FROM responses WHERE session_id IN ({marks})", session_ids)
+        conn.execute(f"DELETE FROM sessions WHERE session_id IN ({marks})", session_ids)
+        if self.fts:
+            conn.execute(f"DELETE FROM history_fts WHERE session_id IN ({marks})", session_ids)
+
+    def _used_bytes(self, conn) -> int:
+        page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+        pages = conn.execute("PRAGMA page_count").fetchone()[0]
+        free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        return (pages - free) * page_size
+
+    def _prune(self, conn):
+        """Drop the oldest sessions until the data fits in 90% of the budget"""
+        used = self._used_bytes(conn)
+        if not self.max_bytes or used <= self.max_bytes:
+            return
+        sessions = conn.execute("SELECT count(*) FROM sessions").fetchone()[0]
+        if not sessions:
+            return
+        # Deleted FTS rows only free pages once the index is merged, so the
+        # page count can't be re-measured per step: size the cut from the average
+        excess = used - self.max_bytes * 0.9
+        count = min(sessions, max(1, -(-excess * sessions // used)))
+        oldest = [row[0] for row in conn.execute(
+            "SELECT session_id FROM sessions ORDER BY created LIMIT ?", (int(count),))]
+        with conn:
+            self._delete_sessions(conn, oldest)
+            if self.fts:
+                conn.execute("INSERT INTO history_fts (history_fts) VALUES ('optimize')")
+        self.pruned_sessions += len(oldest)
+        # Hand the freed pages back to the filesystem; execute() would step the
+        # pragma once and free a single page
+        conn.executescript("PRAGMA incremental_vacuum;")
+
+
+class ComparisonHistory:
+    """Every comparison's question, options and per-model results, searchable"""
+
+    def __init__(self, enabled: bool = HISTORY_ENABLED, path: str = HISTORY_PATH,
+                 max_bytes: int = int(HISTORY_MAX_MB * 1024 * 1024)):
+        self.enabled = enabled
+        self.path = path
+        self.max_bytes = max_bytes
+        self.fts = False
+        self._writer = None
+        self._read_lock = threading.Lock()
+        self._reader = None
+
+    def start(self):
+        if not self.enabled or self._writer is not None:
+            return
+        self.fts = fts5_available()
+        conn = sqlite3.connect(self.path)
+        try:
+            # auto_vacuum only takes effect before the first table exists
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+            if self.fts:
+                conn.executescript(FTS_SCHEMA)
+            conn.commit()
+        finally:
+            conn.close()
+        if not self.fts:
+            log.warning("history_no_fts5", detail="search falls back to LIKE")
+        self._reader = sqlite3.connect(self.path, check_same_thread=False)
+        self._reader.row_factory = sqlite3.Row
+        self._writer = _HistoryWriter(self.path, self.fts, self.max_bytes)
+        self._writer.start()
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.queue.put(None)
+            self._writer.join(timeout=10)
+            self._writer = None
+        if self._reader is not None:
+            with self._read_lock:
+                self._reader.close()
+            self._reader = None
+
+    def _enqueue(self, op: str, *args):
+        # Never blocks: the queue is unbounded and the writer thread does the I/O
+        if self._writer is not None:
+            self._writer.queue.put_nowait((op, args))
+
+    def record_session(self, session_id: str, question: str, options: dict, models):
+        self._enqueue("session", session_id, time.time(), question, options, list(models))
+
+    def record_response(self, session_id: str, model: str, model_tag: str, result, stats=None, cached=False):
+        error = None
+        response = result if isinstance(result, str) else None
+        if response is None or response.startswith("Error:"):
+            error = response[len("Error: "):] if response else "No response"
+            response = None
+        self._enqueue("response", session_id, model, model_tag, response, error, stats, cached, time.time())
+
+    def finish_session(self, session_id: str, status: str, best=None):
+        self._enqueue("finish", session_id, status, best, time.time())
+
+    def delete(self, session_id: str):
+        self._enqueue("delete", session_id)
+
+    def _query(self, sql: str, params=()):
+        with self._read_lock:
+            return [dict(row) for row in self._reader.execute(sql, params).fetchall()]
+
+    @staticmethod
+    def _summary(row: dict) -> dict:
+        return {
+            "sessionId": row["session_id"],
+            "question": row["question"],
+            "created": row["created"],
+            "status": row["status"],
+            "best": row["best"],
+            "models": json.loads(row["models"]),
+            "options": json.loads(row["options"]),
+        }
+
+    async def list(self, limit: int = 20, before: float = None) -> dict:
+        """Newest first; pass the returned cursor as before for the next page"""
+        limit = max(1, min(limit, 100))
+        sql = "SELECT * FROM sessions"
+        params = []
+        if before is not None:
+            sql += " WHERE created < ?"
+            params.append(before)
+        sql += " ORDER BY created DESC LIMIT ?"
+        params.append(limit + 1)
+        rows = await asyncio.to_thread(self._query, sql, params)
+        items = [self._summary(row) for row in rows[:limit]]
+        return {"items": items, "next": items[-1]["created"] if len(rows) > limit else None}
+
+    async def search(self, text: str, limit: int = 20, offset: int = 0) -> dict:
+        """Sessions whose question or responses match, best match first"""
+        limit = max(1, min(limit, 100))
+        if self.fts:
+            query = fts_query(text)
+            if not query:
+                return {"items": [], "next": None}
+            # snippet() can't run inside an aggregate, so sessions are ranked first
+            # and each page's best-matching row is looked up afterwards
+            sql = (
+                "SELECT s.*, m.best_rank FROM ("
+                "  SELECT session_id, min(rank) AS best_rank FROM history_fts"
+                "  WHERE history_fts MATCH ? GROUP BY session_id"
+                ") m JOIN sessions s ON s.session_id = m.session_id"
+                " ORDER BY m.best_rank LIMIT ? OFFSET ?"
+            )
+            params = (query, limit + 1, offset)
+        else:
+            pattern = f"%{text}%"
+            sql = (
+                "SELECT s.* FROM sessions s WHERE s.question LIKE ?"
+                " OR s.session_id IN (SELECT session_id FROM responses WHERE response LIKE ?)"
+                " ORDER BY s.created DESC LIMIT ? OFFSET ?"
+            )
+            params = (pattern, pattern, limit + 1, offset)
+        rows = await asyncio.to_thread(self._query, sql, params)
+        items = []
+        for row in rows[:limit]:
+            item = self._summary(row)
+            item["match"] = {"model": None, "snippet": None}
+            if self.fts:
+                match = await asyncio.to_thread(
+                    self._query,
+                    "SELECT model, snippet(history_fts, 2, '[', ']', '…', 12) AS snippet FROM history_fts"
+                    " WHERE history_fts MATCH ? AND session_id = ? ORDER BY rank LIMIT 1",
+                    (query, row["session_id"]),
+                )
+                if match:
+                    item["match"] = {"model": match[0]["model"] or None, "snippet": match[0]["snippet"]}
+            items.append(item)
+        return {"items": items, "next": offset + limit if len(rows) > limit else None}
+
+    async def get(self, session_id: str):
+        rows = await asyncio.to_thread(self._query, "SELECT * FROM sessions WHERE session_id = ?", (session_id,))
+        if not rows:
+            return None
+        session = self._summary(rows[0])
+        responses = await asyncio.to_thread(
+            self._query, "SELECT * FROM responses WHERE session_id = ? ORDER BY created", (session_id,))
+        session["responses"] = [
+            {
+                "model": row["model"],
+                "modelTag": row["model_tag"],
+                "response": row["response"],
+                "error": row["error"],
+                "stats": json.loads(row["stats"]) if row["stats"] else None,
+                "cached": bool(row["cached"]),
+                "created": row["created"],
+            }
+            for row in responses
+        ]
+        return session
+
+    def stats(self) -> dict:
+        if self._writer is None:
+            return {"enabled": self.enabled, "started": False}
+        size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        return {
+            "enabled": self.enabled,
+            "started": True,
+            "path": self.path,
+            "fts5": self.fts,
+            "file_bytes": size,
+            "max_bytes": self.max_bytes,
+            "pending_writes": self._writer.queue.qsize(),
+            "batches": self._writer.batches,
+            "writes": self._writer.writes,
+            "pruned_sessions": self._writer.pruned_sessions,
+            "errors": self._writer.errors,
+            "last_error": self._writer.last_error,
+        }
+
+
+history = ComparisonHistory()
@@ -0,0 +1,181 @@
+import json
+import os
+import queue
+import random
+import sys
+import threading
+import time
+
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "info").lower()
+# "text" for people reading a console, "json" for one object per line
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text")
+# File to append to; empty writes to stderr
+LOG_PATH = os.environ.get("LOG_PATH", "")
+# Share of per-message debug events kept, so debug logging can stay on under load
+LOG_DEBUG_SAMPLE = float(os.environ.get("LOG_DEBUG_SAMPLE", "1.0"))
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", "10000"))
+LOG_FLUSH_INTERVAL = float(os.environ.get("LOG_FLUSH_INTERVAL", "0.5"))
+
+LEVELS = {"debug": 10, "info": 20, "warning": 30, "error": 40}
+
+
+class LineWriter(threading.Thread):
+    """Drains a bounded queue of records on its own thread and writes them as lines
+
+    Producers only enqueue; formatting and I/O happen here, in batches, so the
+    event loop never waits on a terminal or a disk. When the queue is full the
+    record is dropped and counted rather than blocking.
+    """
+
+    def __init__(self, name: str, open_stream, format_record, max_queue: int = LOG_QUEUE_SIZE,
+                 flush_interval: float = LOG_FLUSH_INTERVAL):
+        super().__init__(name=name, daemon=True)
+        self._open_stream = open_stream
+        self._format = format_record
+        self._queue = queue.Queue(max_queue)
+        self.flush_interval = flush_interval
+        self.written = 0
+        self.dropped = 0
+        self.errors = 0
+        self._start_lock = threading.Lock()
+
+    def put(self, record):
+        if not self.is_alive():
+            with self._start_lock:
+                if not self.is_alive() and self.ident is None:
+                    self.start()
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    @property
+    def queued(self) -> int:
+        return self._queue.qsize()
+
+    def run(self):
+        stream = self._open_stream()
+        while True:
+            record = self._queue.get()
+            batch = [record]
+            # Take whatever else is already waiting, then write it all at once
+            deadline = time.monotonic() + self.flush_interval
+            while record is not None and len(batch) < 1000:
+                try:
+                    record = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                batch.append(record)
+            lines = []
+            for item in batch:
+                if item is None:
+                    continue
+                try:
+                    lines.append(self._format(item))
+                except Exception:
+                    self.errors += 1
+            if lines:
+                try:
+                    stream = self._write(stream, lines)
+                    self.written += len(lines)
+                except Exception:
+                    self.errors += len(lines)
+            if batch[-1] is None:
+                stream.flush()
+                return
+
+    def _write(self, stream, lines):
+        stream.write("\n".join(lines) + "\n")
+        stream.flush()
+        return stream
+
+    def close(self, timeout: float = 2.0):
+        """Flush what's queued and stop; safe to call if it never started"""
+        if self.is_alive():
+            try:
+                self._queue.put(None, timeout=timeout)
+            except queue.Full:
+                return
+            self.join(timeout)
+
+
+def _open_log():
+    if LOG_PATH:
+        return open(LOG_PATH, "a", encoding="utf-8", buffering=1 << 16)
+    return sys.stderr
+
+
+def _json_default(value):
+    return str(value)
+
+
+class StructuredLogger:
+    """Leveled, sampled key-value events, written off the event loop
+
+        log.info("question_started", session=session_id, models=4)
+
+    Filtering by level and sampling happen before anything is formatted, so a
+    disabled or sampled-out call costs a comparison and a function call.
+    """
+
+    def __init__(self, level: str = LOG_LEVEL, fmt: str = LOG_FORMAT, debug_sample: float = LOG_DEBUG_SAMPLE):
+        self.level = LEVELS.get(level, LEVELS["info"])
+        self.format = fmt if fmt in ("text", "json") else "text"
+        self.debug_sample = debug_sample
+        self.sampled_out = 0
+        self.counts = dict.fromkeys(LEVELS, 0)
+        self._writer = LineWriter("log-writer", _open_log, self._format_record)
+
+    def _format_record(self, record) -> str:
+        timestamp, level, event, fields = record
+        if self.format == "json":
+            return json.dumps({"ts": round(timestamp, 6), "level": level, "event": event, **fields},
+                              default=_json_default, ensure_ascii=False)
+        stamp = time.strftime("%H:%M:%S", time.localtime(timestamp)) + f".{int(timestamp % 1 * 1000):03d}"
+        pairs = " ".join(f"{key}={value!r}" if isinstance(value, str) and " " in value else f"{key}={value}"
+                         for key, value in fields.items())
+        return f"{stamp} {level.upper():7} {event} {pairs}".rstrip()
+
+    def _log(self, level: str, event: str, sample: float, fields: dict):
+        if LEVELS[level] < self.level:
+            return
+        if sample < 1.0 and random.random() >= sample:
+            self.sampled_out += 1
+            return
+        self.counts[level] += 1
+        self._writer.put((time.time(), level, event, fields))
+
+    def enabled(self, level: str) -> bool:
+        return LEVELS[level] >= self.level
+
+    def debug(self, event: str, sample: float = None, **fields):
+        self._log("debug", event, self.debug_sample if sample is None else sample, fields)
+
+    def info(self, event: str, sample: float = 1.0, **fields):
+        self._log("info", event, sample, fields)
+
+    def warning(self, event: str, sample: float = 1.0, **fields):
+        self._log("warning", event, sample, fields)
+
+    def error(self, event: str, sample: float = 1.0, **fields):
+        self._log("error", event, sample, fields)
+
+    def close(self):
+        self._writer.close()
+
+    def stats(self) -> dict:
+        return {
+            "level": next(name for name, value in LEVELS.items() if value == self.level),
+            "format": self.format,
+            "path": LOG_PATH or "stderr",
+            "debug_sample": self.debug_sample,
+            "events": self.counts,
+            "sampled_out": self.sampled_out,
+            "queued": self._writer.queued,
+            "written": self._writer.written,
+            "dropped": self._writer.dropped,
+            "errors": self._writer.errors,
+        }
+
+
+log = StructuredLogger()
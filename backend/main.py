@@ -1,88 +1,70 @@
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
-from fastapi.responses import HTMLResponse
+from fastapi.responses import FileResponse, HTMLResponse, PlainTextResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
+from contextlib import asynccontextmanager
 import asyncio
 import json
 import httpx
 import os
+import time
+import uuid
 
-app = FastAPI()
+import metrics
+from batch import BATCH_CONCURRENCY, BatchInputError, BatchJob, batch_jobs, load_questions, make_sink, parse_concurrency, select_models
+from conversations import conversations
+from early_stop import EARLY_STOP_MODES, EarlyStop, early_stop_stats
+from history import history
+from logger import log
+from meta_summary import META_SUMMARY_MIN_RESPONSES, meta_summarizer, summary_sessions
+from model_health import GENERATION_TIMEOUT, Deadline, StallTimeout, model_health
+from model_profile import model_profiles
+from model_registry import MODEL_REFRESH_MIN_INTERVAL, model_registry
+from ollama_client import ollama_pool, stream_generate
+from outbound import connections
+from protocol import PROTOCOL_V2, ModelStreamWriter, negotiate_protocol
+from residency import residency
+from response_cache import RESPONSE_CACHE_REPLAY, make_cache_key, response_cache
+from resume import session_buffers
+from scheduler import MODE_SESSION_LIMITS, QueueFullError, scheduler
+from scoring import ResponseScorer, rank
+from semantic_cache import SEMANTIC_CACHE_MODE, SemanticMatch, semantic_cache
+from sessions import GenerationProgress, SessionRun, cancel_stats
+from singleflight import single_flight
+from token_budget import target_tokens, token_budgets
+from tracing import tracer
 
-class QuestionRequest(BaseModel):
-    question: str
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await ollama_pool.start()
+    # Models load in the background; startup doesn't wait on Ollama
+    await model_registry.start()
+    await metrics.loop_lag_monitor.start()
+    history.start()
+    model_profiles.load()
+    await semantic_cache.start()
+    try:
+        yield
+    finally:
+        await batch_jobs.close()
+        await metrics.loop_lag_monitor.close()
+        await model_registry.close()
+        await ollama_pool.close()
+        response_cache.close()
+        semantic_cache.close()
+        history.close()
+        tracer.close()
+        log.close()
 
-class ModelConfig:
-    def __init__(self):
-        self.models = {}
-        self.load_available_models()
-    
-    async def get_available_models(self):
-        """Get list of available Ollama models"""
-        try:
-            async with httpx.AsyncClient() as client:
-                response = await client.get("http://localhost:11434/api/tags", timeout=10.0)
-                if response.status_code == 200:
-                    data = response.json()
-                    return [model["name"] for model in data.get("models", [])]
-                else:
-                    print(f"Failed to get models: {response.status_code}")
-                    return []
-        except Exception as e:
-            print(f"Error getting available models: {e}")
-            return []
-    
-    def load_available_models(self):
-        """Load available models synchronously at startup"""
-        import asyncio
-        try:
-            # Try to get existing event loop, or create a new one
-            try:
-                loop = asyncio.get_event_loop()
-                if loop.is_running():
-                    # If loop is already running, schedule the coroutine
-                    task = asyncio.create_task(self._load_models_async())
-                    return
-            except RuntimeError:
-                # No event loop exists, create a new one
-                pass
-            
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            available_models = loop.run_until_complete(self.get_available_models())
-            loop.close()
-            
-            for model_name in available_models:
-                # Clean model name (remove version tags if present)
-                clean_name = model_name.split(':')[0]
-                self.models[clean_name] = {
-                    "provider": "ollama",
-                    "model_name": model_name,
-                    "display_name": clean_name
-                }
-            
-            print(f"Available models: {list(self.models.keys())}")
-        except Exception as e:
-            print(f"Error loading models: {e}")
-            # Fallback to empty models dict
-            self.models = {}
-    
-    async def _load_models_async(self):
-        """Async helper for loading models"""
-        try:
-            available_models = await self.get_available_models()
-            for model_name in available_models:
-                clean_name = model_name.split(':')[0]
-                self.models[clean_name] = {
-                    "provider": "ollama",
-                    "model_name": model_name,
-                    "display_name": clean_name
-                }
-            print(f"Available models: {list(self.models.keys())}")
-        except Exception as e:
-            print(f"Error loading models: {e}")
+app = FastAPI(lifespan=lifespan)
 
-model_config = ModelConfig()
+metrics.registry.gauge("compare_scheduler_active", "Generations holding a scheduler slot", lambda: scheduler.active)
+metrics.registry.gauge("compare_scheduler_queued", "Generations waiting for a scheduler slot", lambda: scheduler.stats()["queued"])
+metrics.registry.gauge("compare_websocket_connections", "Open WebSocket connections", lambda: connections.count)
+metrics.registry.gauge("ollama_pool_connections_in_use", "Ollama connections with a request in flight", lambda: ollama_pool.stats().get("in_use", 0))
+
+class QuestionRequest(BaseModel):
+    question: str
 
 def create_enhanced_prompt(question: str, response_length: str, custom_length: str = "10") -> str:
     """Create an enhanced prompt with specific length instructions"""
@@ -117,87 +99,291 @@ async def get_models():
                 "full_name": config["model_name"],
                 "provider": config["provider"]
             }
-            for config in model_config.models.values()
+            for config in model_registry.models.values()
         ]
     }
 
 @app.post("/api/refresh-models")
 async def refresh_models():
     """Refresh the list of available models"""
-    available_models = await model_config.get_available_models()
-    model_config.models.clear()
-    
-    for model_name in available_models:
-        clean_name = model_name.split(':')[0]
-        model_config.models[clean_name] = {
-            "provider": "ollama",
-            "model_name": model_name,
-            "display_name": clean_name
-        }
+    changes = await model_registry.refresh(max_age=MODEL_REFRESH_MIN_INTERVAL)
+    if changes.get("error"):
+        return {"error": f"Failed to refresh models: {changes['error']}", "models": list(model_registry.models.keys())}
     
     return {
         "message": "Models refreshed successfully",
-        "models": list(model_config.models.keys())
+        "models": list(model_registry.models.keys()),
+        "changes": changes
     }
 
+@app.get("/api/model-stats")
+async def get_model_stats():
+    """Model registry refresh state"""
+    return model_registry.stats()
+
+@app.post("/api/batch/jobs")
+async def create_batch_job(request: dict):
+    """Start (or resume, when jobId names an earlier job) a headless batch run"""
+    try:
+        if request.get("questions") is not None:
+            # Plain strings and question records, same as the JSONL lines
+            questions = load_questions(json.dumps(q) for q in request["questions"])
+        elif request.get("input"):
+            with open(batch_jobs.input_path(request["input"]), encoding="utf-8") as f:
+                questions = load_questions(f)
+        else:
+            return {"error": "Provide questions or an input JSONL path"}
+        if not questions:
+            return {"error": "No questions to run"}
+        
+        await model_registry.wait_ready()
+        models = select_models(request.get("models"))
+        if not models:
+            return {"error": "No models available"}
+        
+        output_format = request.get("format", "jsonl")
+        job_id = request.get("jobId") or batch_jobs.new_id()
+        job = BatchJob(
+            job_id, questions, models,
+            make_sink(batch_jobs.output_path(job_id, output_format), output_format),
+            generate=run_model_with_timeout, make_prompt=create_enhanced_prompt,
+            response_length=request.get("responseLength", "medium"),
+            custom_length=request.get("customLength", "10"),
+            concurrency=parse_concurrency(request.get("concurrency", BATCH_CONCURRENCY)),
+            order=request.get("order", "model"),
+            use_cache=request.get("useCache", True),
+            retry_errors=request.get("retryErrors", True),
+        )
+        batch_jobs.start(job)
+        return job.progress()
+    except (BatchInputError, OSError) as e:
+        return {"error": str(e)}
+
+@app.get("/api/batch/jobs")
+async def list_batch_jobs():
+    return {"jobs": batch_jobs.list()}
+
+@app.get("/api/batch/jobs/{job_id}")
+async def get_batch_job(job_id: str):
+    """Progress, throughput and ETA of a batch job"""
+    job = batch_jobs.get(job_id)
+    if job is None:
+        return {"error": f"Job {job_id} not found"}
+    return job.progress()
+
+@app.get("/api/batch/jobs/{job_id}/results")
+async def get_batch_results(job_id: str):
+    """Results written so far, as JSONL"""
+    job = batch_jobs.get(job_id)
+    if job is None:
+        return {"error": f"Job {job_id} not found"}
+    if not os.path.isfile(job.sink.path):
+        return {"error": f"Job {job_id} writes Parquet to {job.sink.path}"}
+    return FileResponse(job.sink.path, media_type="application/x-ndjson")
+
+@app.delete("/api/batch/jobs/{job_id}")
+async def cancel_batch_job(job_id: str):
+    """Stop a batch job; finished pairs stay in its output for a later resume"""
+    job = await batch_jobs.cancel(job_id)
+    if job is None:
+        return {"error": f"Job {job_id} not found"}
+    return job.progress()
+
+@app.get("/api/history")
+async def list_history(limit: int = 20, before: float = None):
+    if not history.enabled:
+        return {"error": "History is disabled"}
+    return await history.list(limit, before)
+
+@app.get("/api/history/search")
+async def search_history(q: str, limit: int = 20, offset: int = 0):
+    if not history.enabled:
+        return {"error": "History is disabled"}
+    return await history.search(q, limit, max(0, offset))
+
+@app.get("/api/history/{session_id}")
+async def get_history_session(session_id: str):
+    if not history.enabled:
+        return {"error": "History is disabled"}
+    session = await history.get(session_id)
+    if session is None:
+        return {"error": f"Unknown session: {session_id}"}
+    return session
+
+@app.delete("/api/history/{session_id}")
+async def delete_history_session(session_id: str):
+    if not history.enabled:
+        return {"error": "History is disabled"}
+    history.delete(session_id)
+    return {"status": "deleted", "sessionId": session_id}
+
+@app.get("/api/history-stats")
+async def get_history_stats():
+    return history.stats()
+
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus text exposition of latency, throughput and error metrics"""
+    return PlainTextResponse(metrics.registry.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/api/connection-stats")
+async def get_connection_stats():
+    return connections.stats()
+
+@app.get("/api/conversation-stats")
+async def get_conversation_stats():
+    return conversations.stats()
+
+@app.delete("/api/conversations/{conversation_id}")
+async def delete_conversation(conversation_id: str):
+    """Forget a conversation's contexts; its next question starts fresh"""
+    return {"status": "deleted", "conversationId": conversation_id, "contexts": conversations.drop(conversation_id)}
+
+@app.get("/api/model-health")
+async def get_model_health():
+    """Per-model latency percentiles, adaptive timeouts and circuit state"""
+    return model_health.stats()
+
+@app.get("/api/log-stats")
+async def get_log_stats():
+    """Structured logger levels, sampling and writer queue"""
+    return log.stats()
+
+@app.get("/api/trace-stats")
+async def get_trace_stats():
+    """Span export counters"""
+    return tracer.stats()
+
+@app.get("/api/traces/{session_id}")
+async def get_trace(session_id: str):
+    """Spans of a recent session, to see where its time went"""
+    spans = tracer.trace(session_id)
+    if spans is None:
+        return {"error": f"No recent trace for session {session_id}"}
+    return {"sessionId": session_id, "spans": spans}
+
+@app.get("/api/early-stop-stats")
+async def get_early_stop_stats():
+    return early_stop_stats.stats()
+
+@app.get("/api/token-budget-stats")
+async def get_token_budget_stats():
+    """Learned token budgets per model and length, and wasted/truncated tokens"""
+    return token_budgets.stats()
+
+@app.get("/api/resume-stats")
+async def get_resume_stats():
+    return session_buffers.stats()
+
+@app.get("/api/residency-stats")
+async def get_residency_stats():
+    """Loaded models, model switches and warm-ups"""
+    return residency.stats()
+
+@app.get("/api/model-profile")
+async def get_model_profile():
+    """Profiled latency, speed and memory per model (from check_ollama.py profile)"""
+    return model_profiles.stats()
+
+@app.get("/api/pool-stats")
+async def get_pool_stats():
+    """Connection pool usage for the shared Ollama client"""
+    return ollama_pool.stats()
+
+@app.get("/api/scheduler-stats")
+async def get_scheduler_stats():
+    """Global generation slots, per-model usage and queue depth"""
+    return scheduler.stats()
+
+@app.get("/api/cache-stats")
+async def get_cache_stats():
+    """Response cache hit/miss counters"""
+    return response_cache.stats()
+
+@app.post("/api/cache/clear")
+async def clear_cache():
+    """Drop every cached response"""
+    await response_cache.clear()
+    await semantic_cache.clear()
+    return {"message": "Response cache cleared"}
+
+@app.get("/api/semantic-cache-stats")
+async def get_semantic_cache_stats():
+    """Similar-question matches and index search latency"""
+    return semantic_cache.stats()
+
+@app.get("/api/singleflight-stats")
+async def get_singleflight_stats():
+    """Shared in-flight generations and how many requests joined them"""
+    return single_flight.stats()
+
+@app.get("/api/cancel-stats")
+async def get_cancel_stats():
+    """Cancelled generations and the tokens/seconds they saved"""
+    return cancel_stats.stats()
+
 @app.post("/api/meta-summary")
 async def generate_meta_summary(request: dict):
     """Generate a comprehensive summary using the best model"""
-    from fastapi.responses import StreamingResponse
     
     try:
         model_name = request.get("model")
         prompt = request.get("prompt")
+        session_id = request.get("sessionId")
         
-        if not model_name or not prompt:
+        if session_id:
+            # Server-side pipeline: the responses are already here, addressed by session
+            session = summary_sessions.get(session_id)
+            if session is None:
+                return {"error": f"Session {session_id} not found"}
+            if not model_name:
+                # Default to the best-scoring response, else whichever finished first
+                model_name = session.best or next(iter(session.responses), None)
+                if model_name is None:
+                    return {"error": "No successful responses to summarize"}
+        elif not model_name or not prompt:
             return {"error": "Missing model or prompt"}
         
         # Find the full model name
-        model_config_entry = None
-        for config in model_config.models.values():
-            if config["display_name"] == model_name:
-                model_config_entry = config
-                break
+        model_config_entry = model_registry.get(model_name)
         
         if not model_config_entry:
             return {"error": f"Model {model_name} not found"}
         
         full_model_name = model_config_entry["model_name"]
         
+        if session_id:
+            async def summarize_session():
+                try:
+                    async for event in meta_summarizer.summarize(session, full_model_name, request.get("minResponses", META_SUMMARY_MIN_RESPONSES)):
+                        yield f"data: {json.dumps(event)}\n\n"
+                except Exception as e:
+                    yield f"data: {json.dumps({'error': str(e)})}\n\n"
+            
+            return StreamingResponse(
+                summarize_session(),
+                media_type="text/plain",
+                headers={
+                    "Cache-Control": "no-cache",
+                    "Connection": "keep-alive",
+                }
+            )
+        
         async def generate_stream():
             try:
-                async with httpx.AsyncClient(timeout=180.0) as client:
-                    response = await client.post(
-                        "http://localhost:11434/api/generate",
-                        json={
-                            "model": full_model_name,
-                            "prompt": prompt,
-                            "stream": True,
-                            "options": {
-                                "temperature": 0.3,  # Lower temperature for more focused analysis
-                                "top_p": 0.9,
-                                "num_predict": 1500,  # Longer for comprehensive analysis
-                            }
-                        },
-                        timeout=180.0
-                    )
-                    
-                    if response.status_code != 200:
-                        yield f"data: {json.dumps({'error': f'API returned {response.status_code}'})}\n\n"
-                        return
-                    
-                    async for line in response.aiter_lines():
-                        if line.strip():
-                            try:
-                                data = json.loads(line)
-                                if "response" in data and data["response"]:
-                                    yield f"data: {json.dumps({'content': data['response']})}\n\n"
-                                if data.get("done", False):
-                                    yield f"data: {json.dumps({'done': True})}\n\n"
-                                    break
-                            except json.JSONDecodeError:
-                                continue
-                                
+                events = stream_generate(full_model_name, prompt, {
+                    "temperature": 0.3,  # Lower temperature for more focused analysis
+                    "top_p": 0.9,
+                    "num_predict": 1500,  # Longer for comprehensive analysis
+                }, timeout=ollama_pool.timeout(read=180.0))
+                try:
+                    async for data in events:
+                        if data.get("response"):
+                            yield f"data: {json.dumps({'content': data['response']})}\n\n"
+                        if data.get("done", False):
+                            yield f"data: {json.dumps({'done': True})}\n\n"
+                finally:
+                    await events.aclose()
             except Exception as e:
                 yield f"data: {json.dumps({'error': str(e)})}\n\n"
         
@@ -213,97 +399,218 @@ async def generate_meta_summary(request: dict):
     except Exception as e:
         return {"error": str(e)}
 
-async def stream_ollama_response(model_name: str, question: str, websocket: WebSocket, display_name: str = None, response_length: str = "medium", session_id: str = ""):
+async def replay_cached_response(cached: dict, writer: ModelStreamWriter, pace: str = RESPONSE_CACHE_REPLAY, **extra):
+    """Send a cached generation in the same streaming/completed messages as a live one"""
+    await writer.start(cached=True, **extra)
+    
+    previous_offset = 0.0
+    for offset, content in cached["chunks"]:
+        if pace == "recorded" and offset > previous_offset:
+            await asyncio.sleep(offset - previous_offset)
+        previous_offset = offset
+        await writer.push(content)
+    
+    await writer.complete(cached["response"], cached=True, **extra)
+    return cached["response"]
+
+async def stream_ollama_response(model_name: str, question: str, websocket: WebSocket, display_name: str = None, response_length: str = "medium", session_id: str = "", use_cache: bool = True, replay_pace: str = RESPONSE_CACHE_REPLAY, protocol: int = 1, progress: GenerationProgress = None, conversation_id: str = None, similar: SemanticMatch = None, custom_length: str = "10"):
     display_name = display_name or model_name.split(':')[0]  # Use clean name for display
+    progress = progress or GenerationProgress()
+    writer = ModelStreamWriter(websocket.send_message, display_name, session_id, protocol)
     
-    # Set appropriate token limits based on response length
-    token_limits = {
-        "brief": 100,
-        "short": 200,
-        "medium": 500,
-        "long": 800,
-        "detailed": 1200,
-        "custom": 600  # Default for custom, can be adjusted
+    # Learned from how long this model's answers at this setting have been
+    num_predict = token_budgets.num_predict(model_name, response_length, custom_length)
+    options = {
+        "temperature": 0.7,
+        "top_p": 0.9,
+        "num_predict": num_predict,
+        "stop": ["\n\n\n", "Question:", "---"]  # Stop at excessive whitespace or new questions
     }
     
-    num_predict = token_limits.get(response_length, 500)
+    # Follow-ups continue this model's earlier turns; their answers depend on
+    # the history and must produce a context, so they never come from the cache
+    context = conversations.get(conversation_id, model_name) if conversation_id else None
+    # Keyed by the length setting, not the budget, so answers stay cached as budgets adapt
+    key_options = {**options, "num_predict": token_budgets.setting(response_length, custom_length)}
+    
+    cache_key = None
+    if response_cache.enabled and not conversation_id:
+        if use_cache:
+            cache_key = make_cache_key(model_name, model_registry.digest_for(model_name), question, key_options)
+            cached = await response_cache.get(cache_key)
+            extra = {}
+            if cached is None and similar is not None:
+                # A rephrasing of a question whose answer is still cached
+                cached = await response_cache.get(
+                    make_cache_key(model_name, model_registry.digest_for(model_name), similar.prompt, key_options),
+                    record=False
+                )
+                if cached is not None:
+                    semantic_cache.served += 1
+                    extra["similarTo"] = similar.report()
+            if cached is not None:
+                metrics.generations.inc(model=model_name, source="similar" if extra else "cached")
+                progress.cached = True
+                replay_started = time.monotonic()
+                try:
+                    return await replay_cached_response(cached, writer, replay_pace, **extra)
+                finally:
+                    writer.close()
+                    progress.span.record("cache_replay", replay_started, pace=replay_pace, similar=bool(extra))
+        else:
+            response_cache.record_bypass()
     
+    progress.num_predict = num_predict
     try:
-        await websocket.send_text(json.dumps({
-            "model": display_name,
-            "status": "streaming",
-            "content": "",
-            "sessionId": session_id
-        }))
+        loaded = ollama_pool.is_loaded(model_name)
+        expected = model_profiles.expected_seconds(model_name, num_predict, loaded)
+        await writer.start(**({"expectedSeconds": expected} if expected is not None else {}))
         
-        async with httpx.AsyncClient(timeout=120.0) as client:
-            # Set a reasonable timeout for the request
-            response = await client.post(
-                "http://localhost:11434/api/generate",
-                json={
-                    "model": model_name,
-                    "prompt": question,
-                    "stream": True,
-                    "options": {
-                        "temperature": 0.7,
-                        "top_p": 0.9,
-                        "num_predict": num_predict,
-                        "stop": ["\n\n\n", "Question:", "---"]  # Stop at excessive whitespace or new questions
-                    }
-                },
-                timeout=120.0
+        request_key = cache_key or make_cache_key(
+            model_name, model_registry.digest_for(model_name), question,
+            {**key_options, "context": context} if context else key_options
+        )
+        # Host and connect time, filled in by the leader's request
+        timings = {}
+        flight, is_leader = single_flight.join(
+            request_key, lambda: stream_generate(
+                model_name, question, options, context=context, hedge_after=model_health.hedge_after(model_name, loaded),
+                timings=timings
             )
+        )
+        metrics.generations.inc(model=model_name, source="live" if is_leader else "shared")
+        progress.span.set(shared=not is_leader, followUp=bool(context))
+        
+        response_chars = 0
+        chunk_count = 0
+        first_token_at = None
+        last_token_at = None
+        stats = {}
+        finished = False
+        truncated = False
+        # Ends the stream once the answer is as long as the setting asks for; a
+        # conversation's next turn needs the context that only the done chunk carries
+        stop_hint = None if conversation_id else token_budgets.stop_hint_for(response_length, custom_length)
+        stopped_at_target = False
+        eval_count = None
+        hit_limit = False
+        # (seconds since request, text) per chunk so cache hits can replay at the recorded pace
+        recorded_chunks = []
+        started = time.monotonic()
+        
+        max_gap = 0.0
+        # A stalled model is given up on after a multiple of its usual latency
+        # instead of the full generation timeout
+        deadline = Deadline()
+        deadline.extend(model_health.first_token_timeout(model_name, loaded), "first token")
+        gap_timeout = model_health.gap_timeout(model_name)
+        
+        # Late joiners of a shared generation get the prefix first, then the live tail
+        events = flight.subscribe()
+        try:
+            async for data in events:
+                content = data.get("response")
+                if content:
+                    progress.token()
+                    now = time.monotonic()
+                    if first_token_at is None:
+                        first_token_at = now
+                        metrics.time_to_first_token.observe(first_token_at - started, model=model_name)
+                    else:
+                        max_gap = max(max_gap, now - last_token_at)
+                    last_token_at = now
+                    deadline.extend(gap_timeout, "next token")
+                    chunk_count += 1
+                    response_chars += len(content)
+                    recorded_chunks.append((round(last_token_at - started, 4), content))
+                    await writer.push(content)
+                    if stop_hint is not None and stop_hint.push(content):
+                        # Closing the stream makes Ollama stop generating
+                        stopped_at_target = True
+                        break
+                
+                if data.get("done", False):
+                    finished = True
+                    # Shared generations report Ollama's timings once, from the leader
+                    stats = metrics.ollama_timings(model_name, data, record=is_leader)
+                    eval_count = data.get("eval_count")
+                    hit_limit = data.get("done_reason") == "length"
+                    if conversation_id and data.get("context"):
+                        conversations.put(conversation_id, model_name, data["context"])
+                    if context:
+                        stats.update(conversations.record_follow_up(model_name, len(context), data, record=is_leader))
+                    if is_leader and "load_duration" in data:
+                        progress.load_seconds = data["load_duration"] / 1e9
+                    continue
+                    
+                # Safety check - don't let responses get too long
+                if response_chars > 10000:
+                    truncated = True
+                    break
+        except asyncio.CancelledError:
+            deadline.check()
+            raise
+        finally:
+            deadline.cancel()
+            await events.aclose()
+        progress.finish()
+        span = progress.span
+        if timings.get("connected") is not None:
+            span.record("connect", started, timings["connected"], host=timings["host"], hostsTried=timings["hosts_tried"])
+        if first_token_at is not None:
+            span.record("ttft", started, first_token_at, loadSeconds=progress.load_seconds)
+            span.record("stream", first_token_at, last_token_at, chunks=chunk_count, chars=response_chars)
+        if not (finished or stopped_at_target or truncated):
+            # The host closed the stream without a done chunk; counting that as a
+            # success would keep a host that drops connections from opening the circuit
+            model_health.failure(model_name, "incomplete stream: ended without a done chunk")
+        elif is_leader and first_token_at is not None:
+            # Load time says nothing about how fast the model answers once it's in memory
+            model_health.success(model_name, first_token_at - started - (progress.load_seconds or 0.0), max_gap)
+        else:
+            model_health.success(model_name)
+        
+        if first_token_at is not None:
+            stats["timeToFirstToken"] = round(first_token_at - started, 3)
+            if last_token_at > first_token_at:
+                stats["chunksPerSecond"] = round(chunk_count / (last_token_at - first_token_at), 2)
+                metrics.chunk_rate.observe(stats["chunksPerSecond"], model=model_name)
+        if progress.queue_wait is not None:
+            stats["queueWait"] = round(progress.queue_wait, 3)
+        stats["numPredict"] = num_predict
+        if stopped_at_target:
+            stats["stoppedAtTarget"] = True
+        if is_leader and (finished or stopped_at_target):
+            # Ollama only counts tokens in the done chunk, which a stopped stream never reads
+            tokens = eval_count if finished and eval_count else chunk_count
+            token_budgets.record(model_name, response_length, custom_length, tokens, num_predict,
+                                 truncated=hit_limit, stopped=stopped_at_target)
+        
+        full_response = writer.text
+        if truncated:
+            full_response += "\n\n[Response truncated - maximum length reached]"
+        progress.stats = stats
+        await writer.complete(full_response, stats=stats)
+        span.record("send", last_token_at or started, truncated=truncated)
+        
+        # Only complete generations are worth replaying; joiners' timings start mid-stream
+        if cache_key and is_leader and (finished or stopped_at_target) and full_response:
+            await response_cache.put(cache_key, {
+                "model": model_name,
+                "response": full_response,
+                "chunks": recorded_chunks
+            })
+        
+        return full_response
             
-            if response.status_code != 200:
-                raise Exception(f"Ollama API returned status {response.status_code}")
-            
-            full_response = ""
-            line_count = 0
-            
-            async for line in response.aiter_lines():
-                if line.strip():  # Only process non-empty lines
-                    try:
-                        data = json.loads(line)
-                        
-                        if "response" in data and data["response"]:
-                            content = data["response"]
-                            full_response += content
-                            line_count += 1
-                            
-                            # Send update every few chunks to avoid flooding
-                            if line_count % 3 == 0 or data.get("done", False):
-                                await websocket.send_text(json.dumps({
-                                    "model": display_name,
-                                    "status": "streaming",
-                                    "content": content,
-                                    "full_response": full_response,
-                                    "sessionId": session_id
-                                }))
-                        
-                        if data.get("done", False):
-                            break
-                            
-                        # Safety check - don't let responses get too long
-                        if len(full_response) > 10000:
-                            full_response += "\n\n[Response truncated - maximum length reached]"
-                            break
-                            
-                    except json.JSONDecodeError:
-                        # Skip malformed JSON lines
-                        continue
-            
-            await websocket.send_text(json.dumps({
-                "model": display_name,
-                "status": "completed",
-                "content": "",
-                "full_response": full_response if full_response else "No response received",
-                "sessionId": session_id
-            }))
-            
-            return full_response
-            
-    except asyncio.TimeoutError:
-        error_msg = f"Model {display_name} timed out after 2 minutes"
+    except (asyncio.TimeoutError, httpx.TimeoutException) as e:
+        metrics.errors.inc(model=model_name, kind="timeout")
+        error_msg = f"Model {display_name} timed out waiting for Ollama"
+        if isinstance(e, StallTimeout):
+            error_msg += f" ({e})"
+        model_health.failure(model_name, error_msg, stall=e.kind if isinstance(e, StallTimeout) else "read")
+        log.warning("generation_timed_out", session=session_id, model=model_name, error=error_msg)
+        progress.span.set(error=error_msg)
         await websocket.send_text(json.dumps({
             "model": display_name,
             "status": "error",
@@ -312,7 +619,11 @@ async def stream_ollama_response(model_name: str, question: str, websocket: WebS
         }))
         return f"Error: {error_msg}"
     except Exception as e:
+        metrics.errors.inc(model=model_name, kind="error")
         error_msg = str(e)
+        model_health.failure(model_name, error_msg)
+        log.warning("generation_failed", session=session_id, model=model_name, error=error_msg)
+        progress.span.set(error=error_msg)
         await websocket.send_text(json.dumps({
             "model": display_name,
             "status": "error",
@@ -320,17 +631,42 @@ async def stream_ollama_response(model_name: str, question: str, websocket: WebS
             "sessionId": session_id
         }))
         return f"Error: {error_msg}"
+    finally:
+        writer.close()
 
-async def run_model_with_timeout(model_name: str, question: str, websocket: WebSocket, display_name: str = None, response_length: str = "medium", session_id: str = "", timeout: int = 180):
-    """Run a single model with individual timeout"""
+async def run_model_with_timeout(model_name: str, question: str, websocket: WebSocket, display_name: str = None, response_length: str = "medium", session_id: str = "", timeout: float = GENERATION_TIMEOUT, use_cache: bool = True, replay_pace: str = RESPONSE_CACHE_REPLAY, protocol: int = 1, progress: GenerationProgress = None, conversation_id: str = None, similar: SemanticMatch = None, custom_length: str = "10"):
+    """Run a single model with individual timeout, unless its circuit is open"""
     display_name = display_name or model_name.split(':')[0]
+    allowed, reason = model_health.allow(model_name)
+    if not allowed:
+        error_msg = f"Model {display_name} {reason}"
+        if progress is not None:
+            progress.span.set(skipped=True, error=error_msg)
+        await websocket.send_text(json.dumps({
+            "model": display_name,
+            "status": "error",
+            "error": error_msg,
+            "skipped": True,
+            "sessionId": session_id
+        }))
+        return f"Error: {error_msg}"
+    num_predict = token_budgets.num_predict(model_name, response_length, custom_length)
+    expected = model_profiles.expected_seconds(model_name, num_predict, ollama_pool.is_loaded(model_name))
+    if expected is not None:
+        # A profiled slow model (or slow load) shouldn't hit the generic limit
+        timeout = max(timeout, round(3 * expected))
     try:
         return await asyncio.wait_for(
-            stream_ollama_response(model_name, question, websocket, display_name, response_length, session_id),
+            stream_ollama_response(model_name, question, websocket, display_name, response_length, session_id, use_cache, replay_pace, protocol, progress, conversation_id, similar, custom_length),
             timeout=timeout
         )
     except asyncio.TimeoutError:
+        metrics.errors.inc(model=model_name, kind="timeout")
         error_msg = f"Model {display_name} timed out after {timeout} seconds"
+        model_health.failure(model_name, error_msg, stall="total")
+        log.warning("generation_timed_out", session=session_id, model=model_name, error=error_msg)
+        if progress is not None:
+            progress.span.set(error=error_msg)
         await websocket.send_text(json.dumps({
             "model": display_name,
             "status": "error",
@@ -338,178 +674,432 @@ async def run_model_with_timeout(model_name: str, question: str, websocket: WebS
             "sessionId": session_id
         }))
         return f"Error: {error_msg}"
+    finally:
+        model_health.release(model_name)
+
+async def cancel_session(websocket: WebSocket, run: SessionRun, model: str = None, reason: str = "cancelled", notify: bool = True):
+    """Stop a session's generations (or one model's) and report the work saved"""
+    reports = await run.cancel(model)
+    if model is None:
+        if reason == "preempted":
+            cancel_stats.preempted_sessions += 1
+        else:
+            cancel_stats.cancelled_sessions += 1
+    log.info("generations_cancelled", session=run.session_id, model=model, count=len(reports), reason=reason)
+    
+    if notify:
+        for report in reports:
+            await websocket.send_text(json.dumps({
+                **report,
+                "status": "cancelled",
+                "reason": reason,
+                "sessionId": run.session_id
+            }))
+        if model is None:
+            await websocket.send_text(json.dumps({
+                "status": "session_cancelled",
+                "reason": reason,
+                "models": len(reports),
+                "tokensSaved": sum(r["tokensSaved"] for r in reports),
+                "secondsSaved": round(sum(r["secondsSaved"] or 0 for r in reports), 2),
+                "sessionId": run.session_id
+            }))
+    return reports
+
+async def process_question(websocket: WebSocket, request_data: dict, run: SessionRun, protocol: int = 1):
+    """Run one question against every model through the scheduler"""
+    question = request_data.get("question", "").strip()
+    processing_mode = request_data.get("mode", "batch")  # batch, parallel, sequential, race, top_k, quorum
+    response_length = request_data.get("responseLength", "medium")
+    custom_length = request_data.get("customLength", "10")
+    session_id = run.session_id
+    use_cache = not request_data.get("bypassCache", False)
+    replay_pace = request_data.get("cacheReplay", RESPONSE_CACHE_REPLAY)
+    # Questions sharing a conversation ID are follow-ups to each other
+    conversation_id = request_data.get("conversationId") or None
+    # "serve" or "offer" the answers to a similar earlier question; false skips the lookup
+    semantic_mode = request_data.get("semanticCache", SEMANTIC_CACHE_MODE)
+    
+    # Create enhanced prompt with length instructions
+    enhanced_question = create_enhanced_prompt(question, response_length, custom_length)
+    
+    # Embedding the question overlaps with the model and residency lookups below
+    semantic_task = None
+    if semantic_cache.enabled and response_cache.enabled and use_cache and not conversation_id \
+            and semantic_mode in ("serve", "offer"):
+        semantic_task = asyncio.ensure_future(
+            semantic_cache.lookup(question, semantic_cache.group(response_length, custom_length))
+        )
+    
+    # Get all available models
+    await model_registry.wait_ready()
+    available_models = list(model_registry.models.items())
+    models_by_name = dict(available_models)
+    
+    # Models already in memory go first, the rest in groups that fit together
+    plan = await residency.plan(available_models, target_tokens(response_length, custom_length))
+    available_models = plan.sort(available_models)
+    
+    # Modes only tell the scheduler how many of this session's models may run at once
+    if processing_mode not in MODE_SESSION_LIMITS:
+        processing_mode = "batch"
+    session_limit = MODE_SESSION_LIMITS[processing_mode]
+    run.span.set(mode=processing_mode, responseLength=response_length, models=len(available_models),
+                 followUp=bool(conversation_id))
+    log.info("question_started", session=session_id, mode=processing_mode, length=response_length,
+             models=len(available_models), chars=len(question))
+    log.debug("question_models", session=session_id, models=[config["model_name"] for _, config in available_models])
+    
+    if not available_models:
+        await websocket.send_text(json.dumps({
+            "status": "error",
+            "message": "No models available"
+        }))
+        return
+    
+    try:
+        scheduler.check_capacity(len(available_models))
+    except QueueFullError as e:
+        await websocket.send_text(json.dumps({
+            "status": "error",
+            "message": str(e),
+            "sessionId": session_id
+        }))
+        return
+    
+    # Send initial status; the token lets a reconnected client resume this session
+    await websocket.send_text(json.dumps({
+        "status": "starting",
+        "message": f"Starting processing with {len(available_models)} models in {processing_mode} mode",
+        "sessionId": session_id,
+        "resumeToken": websocket.token
+    }))
+    
+    similar = None
+    semantic_lookup = await semantic_task if semantic_task is not None else None
+    if semantic_lookup is not None and semantic_lookup.match is not None:
+        match = semantic_lookup.match
+        if match.question != question:
+            match.prompt = create_enhanced_prompt(match.question, response_length, custom_length)
+            if semantic_mode == "serve":
+                similar = match
+            else:
+                semantic_cache.offered += 1
+            run.span.set(similarTo=match.question, similarity=round(match.similarity, 3))
+            await websocket.send_text(json.dumps({
+                "status": "similar_question",
+                **match.report(),
+                "served": similar is not None,
+                "sessionId": session_id
+            }))
+    
+    scheduler_session = f"{id(websocket)}:{session_id}"
+    started_count = 0
+    # Completed responses are kept server-side for /api/meta-summary
+    summary_session = summary_sessions.open(session_id, question, [name for name, _ in available_models])
+    history.record_session(session_id, question, {
+        "mode": processing_mode,
+        "responseLength": response_length,
+        "customLength": custom_length,
+        "bypassCache": not use_cache,
+        "conversationId": conversation_id,
+    }, [name for name, _ in available_models])
+    scorer = ResponseScorer(response_length, custom_length)
+    
+    async def score_response(model_name, result):
+        """Rescore every response with the new one and send the ranking"""
+        if not isinstance(result, str) or not result or result.startswith("Error:"):
+            return
+        scores = await scorer.add(model_name, result)
+        summary_session.best = scorer.best()
+        await websocket.send_text(json.dumps({
+            "status": "scores",
+            "scores": rank(scores),
+            "best": summary_session.best,
+            "sessionId": session_id
+        }))
+    
+    async def run_scheduled(model_name, config, progress):
+        nonlocal started_count
+        
+        async def notify_queued(position):
+            await websocket.send_text(json.dumps({
+                "status": "batch_update",
+                "message": f"{model_name} queued at position {position}",
+                "sessionId": session_id
+            }))
+        
+        status = "cancelled"
+        recorded = False
+        queued_at = time.monotonic()
+        try:
+            async with scheduler.slot(scheduler_session, config["model_name"], session_limit, on_queued=notify_queued) as waited:
+                progress.queue_wait = waited
+                progress.span.record("queue_wait", queued_at)
+                metrics.queue_wait.observe(waited, model=config["model_name"])
+                started_count += 1
+                residency.started(plan, model_name, models_by_name)
+                await websocket.send_text(json.dumps({
+                    "status": "batch_update",
+                    "message": f"Processing model {started_count}/{len(available_models)}: {model_name}",
+                    "sessionId": session_id
+                }))
+                result = await run_model_with_timeout(
+                    config["model_name"], enhanced_question, websocket,
+                    display_name=model_name, response_length=response_length, session_id=session_id,
+                    use_cache=use_cache, replay_pace=replay_pace, protocol=protocol, progress=progress,
+                    conversation_id=conversation_id, similar=similar, custom_length=custom_length
+                )
+                finish_started = time.monotonic()
+                summary_session.record(model_name, result)
+                history.record_response(session_id, model_name, config["model_name"], result,
+                                        stats=progress.stats, cached=progress.cached)
+                recorded = True
+                residency.record_load(plan, model_name, config["model_name"], progress.load_seconds)
+            await score_response(model_name, result)
+            progress.span.record("finish", finish_started)
+            status = "error" if result.startswith("Error:") else "ok"
+            return result
+        except QueueFullError as e:
+            status = "error"
+            progress.span.set(error=str(e))
+            summary_session.record(model_name, None)
+            history.record_response(session_id, model_name, config["model_name"], f"Error: {e}")
+            await websocket.send_text(json.dumps({
+                "model": model_name,
+                "status": "error",
+                "error": str(e),
+                "sessionId": session_id
+            }))
+            return f"Error: {e}"
+        except BaseException:
+            if not recorded:
+                # Cancelled before it had an answer; one cancelled while scoring keeps it
+                summary_session.record(model_name, None)
+                history.record_response(session_id, model_name, config["model_name"], "Error: cancelled")
+            raise
+        finally:
+            progress.span.end(status=status, tokens=progress.tokens, cached=progress.cached)
+    
+    if run.cancelled:
+        summary_session.finish()
+        history.finish_session(session_id, "cancelled")
+        return
+    tasks = []
+    for model_name, config in available_models:
+        log.debug("model_started", session=session_id, model=config["model_name"])
+        model_run = run.add_model(model_name)
+        # Known up front so a model cancelled while still queued is priced too
+        model_run.progress.num_predict = token_budgets.num_predict(config["model_name"], response_length, custom_length)
+        model_run.task = asyncio.create_task(run_scheduled(model_name, config, model_run.progress))
+        tasks.append(model_run.task)
+    
+    stop = EarlyStop(processing_mode, request_data.get("k")) if processing_mode in EARLY_STOP_MODES else None
+    try:
+        if stop is not None:
+            await stop_when_answered(websocket, run, stop, scorer)
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+    finally:
+        summary_session.finish()
+        history.finish_session(session_id, "cancelled" if run.cancelled else "completed", summary_session.best)
+    if stop is not None:
+        early_stop_stats.record(stop)
+    if semantic_lookup is not None and any(
+        isinstance(result, str) and not result.startswith("Error:") and not run.models[name].progress.cached
+        for (name, _), result in zip(available_models, results)
+    ):
+        # Some answers were generated (and cached) for this wording; index it
+        if semantic_lookup.match is None or semantic_lookup.match.question != question:
+            await semantic_cache.add(semantic_lookup, question)
+    if run.cancelled:
+        # cancel_session already reported what was stopped
+        return
+    completed_count = sum(1 for r in results if not isinstance(r, BaseException) and not str(r).startswith("Error:"))
+    cancelled_count = sum(1 for r in results if isinstance(r, asyncio.CancelledError))
+    log.info("question_completed", session=session_id, succeeded=completed_count, models=len(results),
+             cancelled=cancelled_count)
+    
+    message = f"{processing_mode.replace('_', '-').capitalize()} processing complete. {completed_count}/{len(available_models)} models responded successfully."
+    if cancelled_count:
+        message += f" {cancelled_count} cancelled."
+    completion = {
+        "status": "all_completed",
+        "message": message,
+        "residency": plan.report(),
+        "sessionId": session_id
+    }
+    if stop is not None:
+        completion["earlyStop"] = stop.report()
+        if stop.reached:
+            completion["message"] += (
+                f" Answered in {completion['earlyStop']['secondsToAnswer']}s by {', '.join(stop.answered_by)};"
+                f" ~{completion['earlyStop']['gpuSecondsSaved']}s of generation saved."
+            )
+    await websocket.send_text(json.dumps(completion))
+
+async def stop_when_answered(websocket: WebSocket, run: SessionRun, stop: EarlyStop, scorer: ResponseScorer):
+    """Count answers as models finish and cancel the rest once the mode has enough"""
+    pending = {model_run.task: name for name, model_run in run.models.items()}
+    while pending and not run.cancelled:
+        done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            name = pending.pop(task)
+            if task.cancelled() or task.exception() is not None:
+                continue
+            result = task.result()
+            if isinstance(result, str) and result and not result.startswith("Error:"):
+                stop.add(name, scorer)
+        if stop.reached:
+            break
+    if not stop.reached or not pending or run.cancelled:
+        return
+    log.info("early_stop", session=run.session_id, mode=stop.mode, answered_by=stop.answered_by, cancelling=len(pending))
+    reports = await asyncio.gather(*(
+        cancel_session(websocket, run, model=name, reason="early_stop") for name in pending.values()
+    ))
+    stop.stopped([report for model_reports in reports for report in model_reports])
 
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
-    print("WebSocket connection attempt")
-    await websocket.accept()
-    print("WebSocket connection accepted")
+    protocol = negotiate_protocol(websocket)
+    await websocket.accept(subprotocol=PROTOCOL_V2 if PROTOCOL_V2 in websocket.scope.get("subprotocols", []) else None)
+    # Everything sent on this socket goes through one writer task, so a slow
+    # client never holds up the generations streaming to it
+    outbox = connections.open(websocket)
+    log.info("ws_connected", connection=outbox.id, protocol=protocol)
+    
+    # Questions run as background tasks so cancel messages can be read while they
+    # stream; each sends through a channel that can move to a reconnected socket
+    active_runs = {}  # session ID -> SessionChannel
+    
+    def track(channel):
+        active_runs[channel.session_id] = channel
+        
+        def untrack(task):
+            if active_runs.get(channel.session_id) is channel:
+                del active_runs[channel.session_id]
+        channel.run.task.add_done_callback(untrack)
     
     try:
         while True:
-            print("Waiting for message...")
             data = await websocket.receive_text()
-            print(f"Received data: {data}")
             
             try:
                 request_data = json.loads(data)
-                question = request_data.get("question", "").strip()
-                processing_mode = request_data.get("mode", "batch")  # batch, parallel, sequential
-                response_length = request_data.get("responseLength", "medium")
-                custom_length = request_data.get("customLength", "10")
                 session_id = request_data.get("sessionId", "")
+                # Sizes, not payloads: questions can be long and don't belong in logs
+                log.debug("ws_message", connection=outbox.id, session=session_id,
+                          type=request_data.get("type", "question"), bytes=len(data))
                 
-                if not question:
-                    await websocket.send_text(json.dumps({
-                        "status": "error",
-                        "message": "No question provided",
-                        "sessionId": session_id
-                    }))
+                if request_data.get("type") == "cancel":
+                    channel = active_runs.get(session_id)
+                    if channel is None:
+                        await outbox.send_text(json.dumps({
+                            "status": "error",
+                            "message": f"No running session {session_id}",
+                            "sessionId": session_id
+                        }))
+                        continue
+                    await cancel_session(channel, channel.run, model=request_data.get("model"))
                     continue
                 
-                # Create enhanced prompt with length instructions
-                enhanced_question = create_enhanced_prompt(question, response_length, custom_length)
-                print(f"Processing question: {question} (mode: {processing_mode}, length: {response_length})")
-                
-                # Get all available models
-                all_models = list(model_config.models.items())
-                
-                if processing_mode == "parallel":
-                    # Run all models in parallel
-                    available_models = all_models
-                elif processing_mode == "sequential":
-                    # Run models one by one
-                    available_models = all_models
-                else:  # batch mode (default)
-                    # Run in batches of 3
-                    available_models = all_models
-                
-                print(f"Selected models: {[(name, config['model_name']) for name, config in available_models]}")
-                print(f"Total models to process: {len(available_models)}")
-                
-                if not available_models:
-                    await websocket.send_text(json.dumps({
-                        "status": "error",
-                        "message": "No models available"
+                if request_data.get("type") == "resume":
+                    # Replays what the client missed, then the session streams here
+                    channel = await session_buffers.resume(
+                        session_id, outbox, request_data.get("offsets") or {}, request_data.get("done") or (),
+                        token=request_data.get("token")
+                    )
+                    if channel is None:
+                        await outbox.send_text(json.dumps({
+                            "status": "error",
+                            "message": f"Session {session_id} can no longer be resumed",
+                            "sessionId": session_id
+                        }))
+                        continue
+                    if channel.running:
+                        track(channel)
+                    await outbox.send_text(json.dumps({
+                        "status": "resumed",
+                        "running": channel.running,
+                        "sessionId": session_id
                     }))
                     continue
                 
-                print(f"Using models: {[model[0] for model in available_models]}")
+                if not session_id:
+                    # Clients without an ID mustn't share one; every frame tells them this one
+                    session_id = uuid.uuid4().hex
                 
-                # Send initial status
-                await websocket.send_text(json.dumps({
-                    "status": "starting",
-                    "message": f"Starting processing with {len(available_models)} models in {processing_mode} mode",
-                    "sessionId": session_id
-                }))
-                
-                if processing_mode == "sequential":
-                    # Process models one by one
-                    completed_count = 0
-                    for i, (model_name, config) in enumerate(available_models):
-                        await websocket.send_text(json.dumps({
-                            "status": "batch_update",
-                            "message": f"Processing model {i+1}/{len(available_models)}: {model_name}"
-                        }))
-                        
-                        result = await run_model_with_timeout(
-                            config["model_name"], enhanced_question, websocket, 
-                            display_name=model_name, response_length=response_length, session_id=session_id, timeout=120
-                        )
-                        
-                        if not isinstance(result, Exception) and not str(result).startswith("Error:"):
-                            completed_count += 1
-                    
-                    await websocket.send_text(json.dumps({
-                        "status": "all_completed",
-                        "message": f"Sequential processing complete. {completed_count}/{len(available_models)} models responded successfully.",
+                question = request_data.get("question", "").strip()
+                if not question:
+                    await outbox.send_text(json.dumps({
+                        "status": "error",
+                        "message": "No question provided",
                         "sessionId": session_id
                     }))
+                    continue
                 
-                elif processing_mode == "batch":
-                    # Process in batches of 3
-                    batch_size = 3
-                    total_completed = 0
-                    
-                    for batch_idx in range(0, len(available_models), batch_size):
-                        batch = available_models[batch_idx:batch_idx + batch_size]
-                        batch_num = (batch_idx // batch_size) + 1
-                        total_batches = (len(available_models) + batch_size - 1) // batch_size
-                        
-                        await websocket.send_text(json.dumps({
-                            "status": "batch_update",
-                            "message": f"Processing batch {batch_num}/{total_batches}: {', '.join([m[0] for m in batch])}"
-                        }))
-                        
-                        # Run this batch in parallel
-                        tasks = []
-                        for model_name, config in batch:
-                            print(f"Starting task for model: {config['model_name']} (display: {model_name})")
-                            task = asyncio.create_task(
-                                run_model_with_timeout(config["model_name"], enhanced_question, websocket, display_name=model_name, response_length=response_length, session_id=session_id, timeout=120)
-                            )
-                            tasks.append(task)
-                        
-                        # Wait for this batch to complete
-                        results = await asyncio.gather(*tasks, return_exceptions=True)
-                        batch_completed = sum(1 for r in results if not isinstance(r, Exception) and not str(r).startswith("Error:"))
-                        total_completed += batch_completed
-                        
-                        print(f"Batch {batch_num} completed: {batch_completed}/{len(batch)} models succeeded")
-                    
-                    await websocket.send_text(json.dumps({
-                        "status": "all_completed",
-                        "message": f"Batch processing complete. {total_completed}/{len(available_models)} models responded successfully.",
-                        "sessionId": session_id
-                    }))
+                # A new question pre-empts whatever this socket was still generating
+                if request_data.get("preempt", True):
+                    for previous in list(active_runs.values()):
+                        await cancel_session(previous, previous.run, reason="preempted")
+                elif session_id in active_runs:
+                    await cancel_session(active_runs[session_id], active_runs[session_id].run, reason="preempted")
                 
-                else:  # parallel mode
-                    # Run all models in parallel
-                    tasks = []
-                    for model_name, config in available_models:
-                        print(f"Starting task for model: {config['model_name']} (display: {model_name})")
-                        task = asyncio.create_task(
-                            run_model_with_timeout(config["model_name"], enhanced_question, websocket, display_name=model_name, response_length=response_length, session_id=session_id, timeout=120)
-                        )
-                        tasks.append(task)
-                    
-                    # Wait for all tasks to complete or timeout
-                    print("Waiting for all tasks to complete...")
-                    results = await asyncio.gather(*tasks, return_exceptions=True)
-                    print(f"All tasks completed. Results: {len(results)}")
-                    
-                    # Send completion message
-                    completed_count = sum(1 for r in results if not isinstance(r, Exception) and not str(r).startswith("Error:"))
-                    await websocket.send_text(json.dumps({
-                        "status": "all_completed",
-                        "message": f"Parallel processing complete. {completed_count}/{len(available_models)} models responded successfully.",
-                        "sessionId": session_id
-                    }))
+                channel = session_buffers.open(session_id, protocol, outbox)
+                channel.run = SessionRun(session_id)
+                channel.run.span = tracer.start_trace("question", session_id, protocol=protocol)
+                channel.run.task = asyncio.create_task(process_question(channel, request_data, channel.run, protocol))
+                channel.run.task.add_done_callback(lambda task, channel=channel: finish_run(channel, task))
+                track(channel)
                 
             except json.JSONDecodeError as e:
-                print(f"JSON decode error: {e}")
-                await websocket.send_text(json.dumps({
+                log.warning("ws_invalid_json", connection=outbox.id, error=str(e))
+                await outbox.send_text(json.dumps({
                     "status": "error",
                     "message": "Invalid JSON format"
                 }))
             except Exception as e:
-                print(f"Processing error: {e}")
-                await websocket.send_text(json.dumps({
+                log.error("ws_message_failed", connection=outbox.id, error=str(e))
+                await outbox.send_text(json.dumps({
                     "status": "error",
                     "message": f"Processing error: {str(e)}"
                 }))
     
     except WebSocketDisconnect:
-        print("Client disconnected")
+        log.info("ws_disconnected", connection=outbox.id, running=len(active_runs))
     except Exception as e:
-        print(f"WebSocket error: {e}")
+        log.error("ws_failed", connection=outbox.id, error=str(e))
         try:
-            await websocket.send_text(json.dumps({
+            await outbox.send_text(json.dumps({
                 "status": "error", 
                 "message": f"Server error: {str(e)}"
             }))
         except:
             pass
+    finally:
+        # Generations keep going for the resume grace period, then stop
+        for channel in list(active_runs.values()):
+            await session_buffers.detach(channel, outbox)
+        await connections.close(outbox)
+
+def finish_run(channel, task: asyncio.Task):
+    """A question's task ended, however it ended"""
+    session_buffers.finished(channel)
+    if channel.run.cancelled or task.cancelled():
+        status = "cancelled"
+    elif task.exception() is not None:
+        status = "error"
+        log.error("question_failed", session=channel.session_id, error=repr(task.exception()))
+    else:
+        status = "ok"
+    channel.run.span.end(status=status)
+
+async def expire_session(channel, reason: str):
+    """Nobody resumed a detached session in time - stop the upstream generations"""
+    await cancel_session(channel, channel.run, reason=reason, notify=False)
+    channel.run.task.cancel()
+
+session_buffers.on_expire = expire_session
 
 frontend_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), "frontend")
 app.mount("/", StaticFiles(directory=frontend_dir, html=True), name="static")
@@ -0,0 +1,261 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict
+
+from logger import log
+from model_registry import model_registry
+from ollama_client import ollama_pool, stream_generate
+from scheduler import scheduler
+
+META_SUMMARY_MAX_CONTEXT = int(os.environ.get("META_SUMMARY_MAX_CONTEXT", "8192"))
+META_SUMMARY_DEFAULT_CONTEXT = int(os.environ.get("META_SUMMARY_DEFAULT_CONTEXT", "2048"))
+META_SUMMARY_NUM_PREDICT = int(os.environ.get("META_SUMMARY_NUM_PREDICT", "1500"))
+META_SUMMARY_MAP_NUM_PREDICT = int(os.environ.get("META_SUMMARY_MAP_NUM_PREDICT", "400"))
+# Completed responses needed before the first draft starts
+META_SUMMARY_MIN_RESPONSES = int(os.environ.get("META_SUMMARY_MIN_RESPONSES", "2"))
+META_SUMMARY_MAX_SESSIONS = int(os.environ.get("META_SUMMARY_MAX_SESSIONS", "200"))
+META_SUMMARY_SESSION_TTL = float(os.environ.get("META_SUMMARY_SESSION_TTL", "3600"))
+
+ANALYSIS_PROMPT = """You are tasked with creating a comprehensive analysis and summary of multiple AI model responses to a question. Please provide a detailed analysis in approximately 30-50 lines that covers:
+
+1. **Question Overview**: Brief restatement of the original question
+2. **Response Analysis**: Key insights and approaches taken by different models
+3. **Common Themes**: What most models agreed on
+4. **Unique Perspectives**: Interesting differences in approaches or answers
+5. **Quality Assessment**: Which responses were most comprehensive, accurate, or helpful
+6. **Synthesis**: A combined answer that incorporates the best elements from all responses
+7. **Conclusion**: Final thoughts and recommendations
+
+Original Question: "{question}"
+
+{heading}:{sections}
+
+Please provide your comprehensive analysis below:"""
+
+MAP_PROMPT = """You are summarizing some of several AI model responses to the same question. Another pass will combine your notes with notes on the other responses.
+
+Original Question: "{question}"
+
+Model Responses:{sections}
+
+Write compact notes covering each response's key points, where they agree, where they differ, and any mistakes. Always name the model each point comes from."""
+
+# Rough chars-per-token for English text; only used to pack prompts under num_ctx
+CHARS_PER_TOKEN = 4
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def format_sections(items, label: str = "Response") -> str:
+    return "".join(
+        f"\n\n--- {label} {index} ({model}) ---\n{text}"
+        for index, (model, text) in enumerate(items, start=1)
+    )
+
+
+def pack_items(items, budget_tokens: int):
+    """Greedily pack (model, text) pairs into chunks that each fit budget_tokens"""
+    chunks = []
+    current = []
+    used = 0
+    for model, text in items:
+        cost = estimate_tokens(text) + 16  # section header
+        if cost > budget_tokens:
+            # One response alone overflows the window - keep its head
+            keep = max(0, (budget_tokens - 32) * CHARS_PER_TOKEN)
+            text = text[:keep] + "\n[...truncated to fit the summarizer's context...]"
+            cost = budget_tokens
+        if current and used + cost > budget_tokens:
+            chunks.append(current)
+            current, used = [], 0
+        current.append((model, text))
+        used += cost
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+class SummarySession:
+    """Completed responses for one comparison, kept for the server-side summary"""
+
+    def __init__(self, session_id: str, question: str, expected_models):
+        self.session_id = session_id
+        self.question = question
+        self.expected = list(expected_models)
+        self.responses = OrderedDict()  # model -> text, in completion order
+        self.failed = set()
+        self.best = None  # highest-scoring model so far
+        self.finished = False
+        self.updated_at = time.time()
+        self._changed = asyncio.Event()
+
+    def _notify(self):
+        self.updated_at = time.time()
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    def record(self, model: str, text):
+        if isinstance(text, str) and text and not text.startswith("Error:"):
+            self.responses[model] = text
+        else:
+            self.failed.add(model)
+        self._notify()
+
+    def finish(self):
+        self.finished = True
+        self._notify()
+
+    def pending(self):
+        return [m for m in self.expected if m not in self.responses and m not in self.failed]
+
+    async def wait_changed(self):
+        await self._changed.wait()
+
+
+class SummarySessionStore:
+    """LRU of recent comparison sessions, addressable by session ID"""
+
+    def __init__(self, max_sessions: int = META_SUMMARY_MAX_SESSIONS, ttl: float = META_SUMMARY_SESSION_TTL):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self._sessions = OrderedDict()
+
+    def open(self, session_id: str, question: str, expected_models) -> SummarySession:
+        session = SummarySession(session_id, question, expected_models)
+        self._sessions[session_id] = session
+        self._sessions.move_to_end(session_id)
+        self._evict()
+        return session
+
+    def get(self, session_id: str):
+        session = self._sessions.get(session_id)
+        if session is not None and time.time() - session.updated_at > self.ttl:
+            del self._sessions[session_id]
+            return None
+        return session
+
+    def _evict(self):
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+
+
+class MetaSummarizer:
+    """Context-aware map-reduce summary over a session's responses"""
+
+    def __init__(self):
+        self._context_lengths = {}
+
+    def models_changed(self, changes: dict):
+        """Re-read the context window of models that were replaced or removed"""
+        for model_tag in changes["changed"] + changes["removed"]:
+            self._context_lengths.pop(model_tag, None)
+
+    async def context_length(self, model_tag: str) -> int:
+        """Model's trained context window from /api/show, capped for memory"""
+        if model_tag not in self._context_lengths:
+            length = META_SUMMARY_DEFAULT_CONTEXT
+            try:
+                response = await ollama_pool.request(
+                    model_tag, "POST", "/api/show", json={"model": model_tag}, timeout=ollama_pool.timeout(read=10.0)
+                )
+                if response.status_code == 200:
+                    model_info = response.json().get("model_info") or {}
+                    for key, value in model_info.items():
+                        if key.endswith(".context_length"):
+                            length = int(value)
+                            break
+            except Exception as e:
+                log.warning("context_length_failed", model=model_tag, error=str(e))
+            self._context_lengths[model_tag] = length
+        return min(self._context_lengths[model_tag], META_SUMMARY_MAX_CONTEXT)
+
+    async def _generate(self, session: SummarySession, model_tag: str, prompt: str, options: dict):
+        """Yield response text from one generation, inside a scheduler slot"""
+        async with scheduler.slot(f"meta:{session.session_id}", model_tag):
+            events = stream_generate(model_tag, prompt, options)
+            try:
+                async for data in events:
+                    if data.get("response"):
+                        yield data["response"]
+            finally:
+                await events.aclose()
+
+    async def _map(self, session, model_tag, chunk, options) -> str:
+        prompt = MAP_PROMPT.format(question=session.question, sections=format_sections(chunk))
+        parts = []
+        async for content in self._generate(session, model_tag, prompt, options):
+            parts.append(content)
+        return "".join(parts)
+
+    async def summarize(self, session: SummarySession, model_tag: str, min_responses: int = META_SUMMARY_MIN_RESPONSES):
+        """Yield SSE payloads: a draft as soon as enough responses exist, then refinements"""
+        num_ctx = await self.context_length(model_tag)
+        reduce_predict = min(META_SUMMARY_NUM_PREDICT, num_ctx // 3)
+        map_predict = min(META_SUMMARY_MAP_NUM_PREDICT, num_ctx // 4)
+        template_tokens = estimate_tokens(ANALYSIS_PROMPT + session.question) + 32
+        reduce_budget = num_ctx - reduce_predict - template_tokens
+        map_budget = num_ctx - map_predict - estimate_tokens(MAP_PROMPT + session.question) - 32
+        reduce_options = {"temperature": 0.3, "top_p": 0.9, "num_predict": reduce_predict, "num_ctx": num_ctx}
+        map_options = {"temperature": 0.2, "top_p": 0.9, "num_predict": map_predict, "num_ctx": num_ctx}
+
+        while not session.finished and len(session.responses) < min(min_responses, len(session.expected)):
+            await session.wait_changed()
+
+        partials = OrderedDict()  # tuple of models -> notes on those responses
+        mapped = set()
+        revision = 0
+        while True:
+            items = list(session.responses.items())
+            if not items:
+                yield {"error": "No successful responses to summarize"}
+                return
+            revision += 1
+            yield {"revision": revision, "models": [m for m, _ in items], "pending": session.pending()}
+
+            if sum(estimate_tokens(text) + 16 for _, text in items) <= reduce_budget:
+                # Everything fits in one prompt - no map step needed
+                heading, sections = "Model Responses", format_sections(items)
+            else:
+                new_items = [(m, t) for m, t in items if m not in mapped]
+                chunks = pack_items(new_items, map_budget)
+                if chunks:
+                    yield {"stage": "map", "chunks": len(chunks)}
+                    notes = await asyncio.gather(*(self._map(session, model_tag, chunk, map_options) for chunk in chunks))
+                    for chunk, note in zip(chunks, notes):
+                        partials[tuple(m for m, _ in chunk)] = note
+                    mapped.update(m for m, _ in new_items)
+                notes = [(", ".join(models), note) for models, note in partials.items()]
+                # Notes can overflow too when there are many chunks; fold them until they fit
+                while sum(estimate_tokens(t) + 16 for _, t in notes) > reduce_budget and len(notes) > 1:
+                    folded = pack_items(notes, map_budget)
+                    if len(folded) >= len(notes):
+                        # Window too small to merge anything; trim each note to a fair share
+                        share = max(1, reduce_budget // len(notes) - 16) * CHARS_PER_TOKEN
+                        notes = [(label, note[:share]) for label, note in notes]
+                        break
+                    notes = list(zip(
+                        (f"group {i}" for i in range(1, len(folded) + 1)),
+                        await asyncio.gather(*(self._map(session, model_tag, chunk, map_options) for chunk in folded)),
+                    ))
+                heading, sections = "Notes on the model responses", format_sections(notes, label="Notes")
+
+            prompt = ANALYSIS_PROMPT.format(question=session.question, heading=heading, sections=sections)
+            async for content in self._generate(session, model_tag, prompt, reduce_options):
+                yield {"content": content}
+
+            if session.finished and len(session.responses) == len(items):
+                break
+            while not session.finished and len(session.responses) == len(items):
+                await session.wait_changed()
+            if len(session.responses) == len(items):
+                break
+
+        yield {"done": True}
+
+
+summary_sessions = SummarySessionStore()
+meta_summarizer = MetaSummarizer()
+model_registry.subscribe(meta_summarizer.models_changed)
@@ -0,0 +1,237 @@
+import asyncio
+import bisect
+import math
+import os
+
+# How often the event loop lag probe wakes up, in seconds
+LOOP_LAG_INTERVAL = float(os.environ.get("LOOP_LAG_INTERVAL", "0.1"))
+
+# Bucket bounds in seconds for latencies, and in tokens/s for rates
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+SEND_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1.0)
+RATE_BUCKETS = (1, 2.5, 5, 10, 20, 35, 50, 75, 100, 150, 250, 500, 1000)
+
+
+def _format_value(value) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels.get(name, "") for name in self.labelnames)
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.kind}"
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name, help_text, labelnames=()):
+        super().__init__(name, help_text, labelnames)
+        self._values = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        yield from super().render()
+        for key, value in self._values.items():
+            yield f"{self.name}{_labels(self.labelnames, key)} {_format_value(value)}"
+
+
+class Gauge(_Metric):
+    """Value read from a callback at scrape time"""
+
+    kind = "gauge"
+
+    def __init__(self, name, help_text, read):
+        super().__init__(name, help_text)
+        self._read = read
+
+    def render(self):
+        yield from super().render()
+        yield f"{self.name} {_format_value(self._read())}"
+
+
+class Histogram(_Metric):
+    """Fixed-bucket histogram; observe() is one bisect and two additions"""
+
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}  # label values -> [bucket counts..., sum, count]
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = [0] * (len(self.buckets) + 2)
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def render(self):
+        yield from super().render()
+        for key, series in self._series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), series):
+                cumulative += count
+                le = 'le="' + _format_value(float(bound)) + '"'
+                yield f"{self.name}_bucket{_labels(self.labelnames, key, le)} {cumulative}"
+            yield f"{self.name}_sum{_labels(self.labelnames, key)} {_format_value(series[-2])}"
+            yield f"{self.name}_count{_labels(self.labelnames, key)} {series[-1]}"
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help_text, labelnames=()) -> Counter:
+        return self.register(Counter(name, help_text, labelnames))
+
+    def histogram(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help_text, labelnames, buckets))
+
+    def gauge(self, name, help_text, read) -> Gauge:
+        return self.register(Gauge(name, help_text, read))
+
+    def render(self) -> str:
+        """Prometheus text exposition format"""
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+# Server-side measurements
+time_to_first_token = registry.histogram(
+    "compare_time_to_first_token_seconds", "Time from sending a generation to its first token", ("model",))
+chunk_rate = registry.histogram(
+    "compare_stream_chunks_per_second", "Chunks received per second of streaming, per generation", ("model",), RATE_BUCKETS)
+send_latency = registry.histogram(
+    "compare_websocket_send_seconds", "Time to hand one frame to the WebSocket", buckets=SEND_BUCKETS)
+queue_wait = registry.histogram(
+    "compare_scheduler_wait_seconds", "Time a generation waited for a scheduler slot", ("model",))
+generations = registry.counter(
+    "compare_generations_total", "Generations by how they were served (live, shared, cached)", ("model", "source"))
+errors = registry.counter(
+    "compare_generation_errors_total", "Failed generations by kind (error, timeout)", ("model", "kind"))
+
+loop_lag = registry.histogram(
+    "compare_event_loop_lag_seconds", "How late the event loop ran a task that asked to wake up", buckets=SEND_BUCKETS)
+
+# Ollama's own timings from the final done chunk
+eval_rate = registry.histogram(
+    "ollama_eval_tokens_per_second", "eval_count / eval_duration per generation", ("model",), RATE_BUCKETS)
+prompt_eval_rate = registry.histogram(
+    "ollama_prompt_eval_tokens_per_second", "prompt_eval_count / prompt_eval_duration per generation", ("model",),
+    RATE_BUCKETS + (2500, 5000, 10000))
+load_duration = registry.histogram(
+    "ollama_load_duration_seconds", "Time Ollama spent loading the model", ("model",))
+total_duration = registry.histogram(
+    "ollama_total_duration_seconds", "Ollama's total_duration per generation", ("model",))
+eval_tokens = registry.counter(
+    "ollama_eval_tokens_total", "Tokens generated", ("model",))
+prompt_eval_tokens = registry.counter(
+    "ollama_prompt_eval_tokens_total", "Prompt tokens evaluated", ("model",))
+
+
+def ollama_timings(model: str, done: dict, record: bool = True) -> dict:
+    """Read the timings from a done chunk, recording them unless record is False"""
+    seconds = {
+        key: done[key] / 1e9
+        for key in ("total_duration", "load_duration", "prompt_eval_duration", "eval_duration")
+        if isinstance(done.get(key), (int, float))
+    }
+    eval_count = done.get("eval_count") or 0
+    prompt_eval_count = done.get("prompt_eval_count") or 0
+    timings = {"evalCount": eval_count, "promptEvalCount": prompt_eval_count}
+
+    if "total_duration" in seconds:
+        timings["totalSeconds"] = round(seconds["total_duration"], 3)
+    if "load_duration" in seconds:
+        timings["loadSeconds"] = round(seconds["load_duration"], 3)
+    if eval_count and seconds.get("eval_duration"):
+        timings["tokensPerSecond"] = round(eval_count / seconds["eval_duration"], 2)
+    if prompt_eval_count and seconds.get("prompt_eval_duration"):
+        timings["promptTokensPerSecond"] = round(prompt_eval_count / seconds["prompt_eval_duration"], 2)
+    if not record:
+        return timings
+
+    if "total_duration" in seconds:
+        total_duration.observe(seconds["total_duration"], model=model)
+    if "load_duration" in seconds:
+        load_duration.observe(seconds["load_duration"], model=model)
+    if "tokensPerSecond" in timings:
+        eval_rate.observe(eval_count / seconds["eval_duration"], model=model)
+    if "promptTokensPerSecond" in timings:
+        prompt_eval_rate.observe(prompt_eval_count / seconds["prompt_eval_duration"], model=model)
+    eval_tokens.inc(eval_count, model=model)
+    prompt_eval_tokens.inc(prompt_eval_count, model=model)
+    return timings
+
+
+class LoopLagMonitor:
+    """Sleeps in a loop and records how late each wake-up was"""
+
+    def __init__(self, interval: float = LOOP_LAG_INTERVAL):
+        self.interval = interval
+        self.max_lag = 0.0
+        self._task = None
+
+    async def start(self):
+        if self._task is None and self.interval > 0:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - started - self.interval)
+            loop_lag.observe(lag)
+            self.max_lag = max(self.max_lag, lag)
+
+
+loop_lag_monitor = LoopLagMonitor()
+registry.gauge("compare_event_loop_lag_max_seconds", "Worst event loop lag seen since start",
+               lambda: loop_lag_monitor.max_lag)
@@ -0,0 +1,280 @@
+import asyncio
+import collections
+import os
+import time
+
+import numpy as np
+
+import metrics
+from logger import log
+from model_profile import model_profiles
+
+# Upper bound on one whole generation; the adaptive limits below usually end a stuck one sooner
+GENERATION_TIMEOUT = float(os.environ.get("GENERATION_TIMEOUT", "180"))
+
+# Adaptive limits are a multiple of the model's p95 over its recent generations,
+# clamped to [MIN, MAX]. Until there are enough samples the model's profiled p95
+# stands in for them (see model_profile.py), or MAX if it has no profile
+ADAPTIVE_TIMEOUT_WINDOW = int(os.environ.get("ADAPTIVE_TIMEOUT_WINDOW", "100"))
+ADAPTIVE_TIMEOUT_MIN_SAMPLES = int(os.environ.get("ADAPTIVE_TIMEOUT_MIN_SAMPLES", "5"))
+ADAPTIVE_TIMEOUT_MULTIPLIER = float(os.environ.get("ADAPTIVE_TIMEOUT_MULTIPLIER", "4"))
+FIRST_TOKEN_TIMEOUT_MIN = float(os.environ.get("FIRST_TOKEN_TIMEOUT_MIN", "15"))
+FIRST_TOKEN_TIMEOUT_MAX = float(os.environ.get("FIRST_TOKEN_TIMEOUT_MAX", "120"))
+TOKEN_GAP_TIMEOUT_MIN = float(os.environ.get("TOKEN_GAP_TIMEOUT_MIN", "10"))
+TOKEN_GAP_TIMEOUT_MAX = float(os.environ.get("TOKEN_GAP_TIMEOUT_MAX", "60"))
+
+# Start a second copy of a generation on another host once the first token is this
+# many times the model's p95 late (and at least HEDGE_MIN_SECONDS); 0 turns hedging off
+HEDGE_MULTIPLIER = float(os.environ.get("HEDGE_MULTIPLIER", "2"))
+HEDGE_MIN_SECONDS = float(os.environ.get("HEDGE_MIN_SECONDS", "2"))
+
+# Consecutive failures that open a model's circuit, and how long it stays open
+# (doubling on each failed probe, up to CIRCUIT_OPEN_MAX_SECONDS)
+CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get("CIRCUIT_FAILURE_THRESHOLD", "3"))
+CIRCUIT_OPEN_SECONDS = float(os.environ.get("CIRCUIT_OPEN_SECONDS", "30"))
+CIRCUIT_OPEN_MAX_SECONDS = float(os.environ.get("CIRCUIT_OPEN_MAX_SECONDS", "300"))
+
+stall_timeouts = metrics.registry.counter(
+    "compare_stall_timeouts_total", "Generations ended for a late first token or a long gap between tokens",
+    labelnames=("model", "kind"))
+circuit_skips = metrics.registry.counter(
+    "compare_circuit_skips_total", "Generations skipped because the model's circuit was open",
+    labelnames=("model",))
+
+
+class StallTimeout(asyncio.TimeoutError):
+    """The first token or the next one took longer than the model's adaptive limit"""
+
+    def __init__(self, kind: str, seconds: float):
+        self.kind = kind
+        self.seconds = seconds
+        super().__init__(f"no {kind} within {seconds:.1f}s")
+
+
+class Deadline:
+    """Cancels the current task unless it is pushed back in time
+
+    Pushing it back is an assignment; the one timer only re-arms when it fires
+    before the current deadline, so this is cheap to call for every chunk.
+    """
+
+    def __init__(self):
+        self._loop = asyncio.get_running_loop()
+        self._task = asyncio.current_task()
+        self._when = None
+        self._handle = None
+        self._kind = None
+        self._seconds = 0.0
+        self.expired = None  # the StallTimeout, once it has cancelled the task
+
+    def extend(self, seconds: float, kind: str):
+        self._when = self._loop.time() + seconds
+        self._kind = kind
+        self._seconds = seconds
+        if self._handle is None:
+            self._handle = self._loop.call_at(self._when, self._fire)
+
+    def _fire(self):
+        self._handle = None
+        if self._when is None:
+            return
+        if self._loop.time() < self._when:
+            self._handle = self._loop.call_at(self._when, self._fire)
+            return
+        self.expired = StallTimeout(self._kind, self._seconds)
+        self._task.cancel()
+
+    def cancel(self):
+        self._when = None
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def check(self):
+        """Turn the cancellation this deadline caused into its StallTimeout"""
+        if self.expired is None:
+            return
+        uncancel = getattr(self._task, "uncancel", None)
+        if uncancel is not None:
+            uncancel()
+        raise self.expired
+
+
+class _ModelStats:
+    __slots__ = ("first_token", "gaps", "failures", "state", "opened_at", "open_seconds", "probing",
+                 "successes", "total_failures", "skipped", "stalls", "last_error")
+
+    def __init__(self, window: int):
+        self.first_token = collections.deque(maxlen=window)  # seconds, model load excluded
+        self.gaps = collections.deque(maxlen=window)  # longest gap between tokens per generation
+        self.failures = 0  # consecutive
+        self.state = "closed"
+        self.opened_at = None
+        self.open_seconds = CIRCUIT_OPEN_SECONDS
+        self.probing = False
+        self.successes = 0
+        self.total_failures = 0
+        self.skipped = 0
+        self.stalls = 0
+        self.last_error = None
+
+
+def _p95(samples) -> float:
+    return float(np.percentile(np.fromiter(samples, dtype=np.float64, count=len(samples)), 95))
+
+
+class ModelHealth:
+    """Rolling latency per model, the timeouts derived from it, and a circuit breaker
+
+    A model's circuit opens after CIRCUIT_FAILURE_THRESHOLD failures in a row;
+    its generations are skipped until the open period ends. Then one
+    generation goes through as a probe: success closes the circuit, failure
+    opens it again for twice as long.
+    """
+
+    def __init__(self, window: int = ADAPTIVE_TIMEOUT_WINDOW, min_samples: int = ADAPTIVE_TIMEOUT_MIN_SAMPLES,
+                 multiplier: float = ADAPTIVE_TIMEOUT_MULTIPLIER):
+        self.window = window
+        self.min_samples = min_samples
+        self.multiplier = multiplier
+        self._models = {}
+
+    def _stats(self, model: str) -> _ModelStats:
+        stats = self._models.get(model)
+        if stats is None:
+            stats = self._models[model] = _ModelStats(self.window)
+        return stats
+
+    def _p95(self, samples, profiled):
+        """p95 of the live samples, the profiled p95 while there are too few, else None"""
+        if len(samples) >= self.min_samples:
+            return _p95(samples)
+        return profiled
+
+    def _limit(self, samples, profiled, low: float, high: float) -> float:
+        p95 = self._p95(samples, profiled)
+        if p95 is None:
+            return high
+        return min(high, max(low, p95 * self.multiplier))
+
+    def first_token_timeout(self, model: str, loaded: bool = True) -> float:
+        """Seconds to wait for the first token, including the load when the model isn't in memory"""
+        warm = self._limit(self._stats(model).first_token, model_profiles.first_token_p95(model),
+                           FIRST_TOKEN_TIMEOUT_MIN, FIRST_TOKEN_TIMEOUT_MAX)
+        if loaded:
+            return warm
+        cold_load = model_profiles.cold_load_seconds(model)
+        if cold_load is None:
+            return FIRST_TOKEN_TIMEOUT_MAX
+        # A model profiled as slow to load may need longer than the usual maximum
+        return max(FIRST_TOKEN_TIMEOUT_MAX, 2 * cold_load + warm)
+
+    def gap_timeout(self, model: str) -> float:
+        return self._limit(self._stats(model).gaps, model_profiles.gap_p95(model),
+                           TOKEN_GAP_TIMEOUT_MIN, TOKEN_GAP_TIMEOUT_MAX)
+
+    def hedge_after(self, model: str, loaded: bool = True):
+        """Seconds without a first token before a second host is tried, or None
+
+        A model that isn't in memory first has to load, which the first-token
+        samples leave out; its profiled load time is added, and without one it
+        isn't hedged, since the second host would most likely be loading it too.
+        """
+        p95 = self._p95(self._stats(model).first_token, model_profiles.first_token_p95(model))
+        if HEDGE_MULTIPLIER <= 0 or p95 is None:
+            return None
+        hedge_after = max(HEDGE_MIN_SECONDS, p95 * HEDGE_MULTIPLIER)
+        if loaded:
+            return hedge_after
+        cold_load = model_profiles.cold_load_seconds(model)
+        if cold_load is None:
+            return None
+        return cold_load + hedge_after
+
+    def allow(self, model: str):
+        """(allowed, reason) for starting a generation, per the circuit breaker"""
+        stats = self._stats(model)
+        if stats.state == "closed":
+            return True, None
+        now = time.monotonic()
+        if stats.state == "open":
+            remaining = stats.opened_at + stats.open_seconds - now
+            if remaining > 0:
+                stats.skipped += 1
+                circuit_skips.inc(model=model)
+                return False, (f"skipped after {stats.failures} failures in a row "
+                               f"(retrying in {remaining:.0f}s; last error: {stats.last_error})")
+            stats.state = "half_open"
+        if stats.probing:
+            stats.skipped += 1
+            circuit_skips.inc(model=model)
+            return False, "skipped while a probe generation checks whether it has recovered"
+        stats.probing = True
+        return True, None
+
+    def release(self, model: str):
+        """The generation allow() let through ended without a verdict (cancelled, cached)"""
+        self._stats(model).probing = False
+
+    def success(self, model: str, first_token: float = None, max_gap: float = None):
+        stats = self._stats(model)
+        if first_token is not None:
+            stats.first_token.append(first_token)
+        if max_gap is not None:
+            stats.gaps.append(max_gap)
+        stats.successes += 1
+        stats.failures = 0
+        stats.probing = False
+        if stats.state != "closed":
+            log.info("circuit_closed", model=model)
+            stats.state = "closed"
+            stats.open_seconds = CIRCUIT_OPEN_SECONDS
+
+    def failure(self, model: str, error: str, stall: str = None):
+        stats = self._stats(model)
+        stats.failures += 1
+        stats.total_failures += 1
+        stats.last_error = error
+        if stall is not None:
+            stats.stalls += 1
+            stall_timeouts.inc(model=model, kind=stall)
+        was_probe = stats.probing
+        stats.probing = False
+        if stats.state == "half_open" and was_probe:
+            stats.open_seconds = min(CIRCUIT_OPEN_MAX_SECONDS, stats.open_seconds * 2)
+            stats.state = "open"
+            stats.opened_at = time.monotonic()
+            log.warning("circuit_probe_failed", model=model, open_seconds=stats.open_seconds)
+        elif stats.state == "closed" and stats.failures >= CIRCUIT_FAILURE_THRESHOLD:
+            stats.state = "open"
+            stats.opened_at = time.monotonic()
+            log.warning("circuit_opened", model=model, failures=stats.failures, error=error)
+
+    def stats(self) -> dict:
+        models = {}
+        for model, stats in self._models.items():
+            models[model] = {
+                "state": stats.state,
+                "consecutiveFailures": stats.failures,
+                "successes": stats.successes,
+                "failures": stats.total_failures,
+                "stalls": stats.stalls,
+                "skipped": stats.skipped,
+                "lastError": stats.last_error,
+                "samples": len(stats.first_token),
+                "firstTokenP95": round(_p95(stats.first_token), 3) if stats.first_token else None,
+                "gapP95": round(_p95(stats.gaps), 3) if stats.gaps else None,
+                "firstTokenTimeout": round(self.first_token_timeout(model), 1),
+                "gapTimeout": round(self.gap_timeout(model), 1),
+                "hedgeAfter": round(self.hedge_after(model), 1) if self.hedge_after(model) else None,
+            }
+        return {
+            "generation_timeout": GENERATION_TIMEOUT,
+            "multiplier": self.multiplier,
+            "min_samples": self.min_samples,
+            "circuit_failure_threshold": CIRCUIT_FAILURE_THRESHOLD,
+            "models": models,
+        }
+
+
+model_health = ModelHealth()
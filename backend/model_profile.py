@@ -0,0 +1,250 @@
+import asyncio
+import json
+import os
+import time
+
+import numpy as np
+
+from logger import log
+from model_registry import model_registry
+from ollama_client import ollama_pool, stream_generate
+
+# Written by `python check_ollama.py profile`, read at startup
+MODEL_PROFILE_PATH = os.environ.get("MODEL_PROFILE_PATH", os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "model_profile.json"))
+PROFILE_VERSION = 1
+
+# Fixed, so profiles taken on different days or machines are comparable
+PROFILE_PROMPTS = (
+    "Explain in one paragraph how a hash table handles collisions.",
+    "Write a haiku about autumn rain.",
+    "List three differences between TCP and UDP.",
+)
+PROFILE_NUM_PREDICT = 128
+# Seconds to wait for an unloaded model to leave /api/ps before a cold load is timed
+PROFILE_UNLOAD_TIMEOUT = 60.0
+
+
+def _percentile(samples, q: float):
+    return round(float(np.percentile(np.asarray(samples, dtype=np.float64), q)), 3) if samples else None
+
+
+async def _generate_once(model: str, prompt: str, num_predict: int, pool) -> dict:
+    """Time one streamed generation: first token, longest gap and Ollama's own counters"""
+    started = time.monotonic()
+    first = last = None
+    max_gap = 0.0
+    done = {}
+    options = {"temperature": 0, "num_predict": num_predict}
+    async for data in stream_generate(model, prompt, options, pool=pool):
+        if data.get("response"):
+            now = time.monotonic()
+            if first is None:
+                first = now
+            else:
+                max_gap = max(max_gap, now - last)
+            last = now
+        if data.get("done"):
+            done = data
+    return {
+        "first_token": first - started if first is not None else None,
+        "max_gap": max_gap,
+        "eval_count": done.get("eval_count") or 0,
+        "eval_seconds": (done.get("eval_duration") or 0) / 1e9,
+        "prompt_count": done.get("prompt_eval_count") or 0,
+        "prompt_seconds": (done.get("prompt_eval_duration") or 0) / 1e9,
+        "load_seconds": (done.get("load_duration") or 0) / 1e9,
+    }
+
+
+async def _unload(model: str, pool, timeout: float = PROFILE_UNLOAD_TIMEOUT):
+    """Unload model from every host that has it, and wait until /api/ps agrees"""
+    deadline = time.monotonic() + timeout
+    asked = set()
+    while True:
+        # Re-reads /api/ps on every healthy host
+        await pool.running_models()
+        loaded = [host for host in pool.hosts if host.healthy and model in host.loaded]
+        if not loaded:
+            return
+        if time.monotonic() > deadline:
+            raise Exception(f"{model} was still loaded {timeout:g}s after unloading it")
+        for host in loaded:
+            if host in asked:
+                continue
+            asked.add(host)
+            response = await host.client.post("/api/generate", json={"model": model, "keep_alive": 0, "stream": False},
+                                              timeout=pool.timeout(read=60.0))
+            if response.status_code != 200:
+                raise Exception(f"Unloading {model} from {host.base_url} failed with HTTP {response.status_code}")
+        await asyncio.sleep(0.5)
+
+
+async def profile_model(model: str, prompts=PROFILE_PROMPTS, runs: int = 1, cold: bool = True,
+                        num_predict: int = PROFILE_NUM_PREDICT, pool=None) -> dict:
+    """Measure one model: cold load, memory once loaded, then warm runs of every prompt
+
+    cold=False skips unloading the model first (it may be serving someone), so
+    the profile has no load time.
+    """
+    pool = pool or ollama_pool
+    profile = {"digest": model_registry.digest_for(model), "profiledAt": time.time()}
+    if cold:
+        # Unloaded first, an empty prompt only loads the weights; a model still
+        # resident would be timed warm and profiled as loading almost instantly
+        await _unload(model, pool)
+        started = time.monotonic()
+        response = await pool.request(model, "POST", "/api/generate", json={"model": model, "prompt": "", "stream": False},
+                                      timeout=pool.timeout(read=600.0))
+        if response.status_code != 200:
+            raise Exception(f"Loading {model} failed with HTTP {response.status_code}")
+        load = (response.json().get("load_duration") or 0) / 1e9
+        profile["coldLoadSeconds"] = round(load or time.monotonic() - started, 3)
+    else:
+        # Not measured: makes sure the timed runs below don't include a load
+        await _generate_once(model, PROFILE_PROMPTS[0], 1, pool)
+
+    for running in await pool.running_models():
+        if (running.get("name") or running.get("model")) == model:
+            profile["sizeBytes"] = running.get("size") or None
+            profile["vramBytes"] = running.get("size_vram")
+            break
+
+    first_tokens, gaps, rates, prompt_rates = [], [], [], []
+    errors = 0
+    for _ in range(runs):
+        for prompt in prompts:
+            try:
+                run = await _generate_once(model, prompt, num_predict, pool)
+            except Exception as e:
+                errors += 1
+                log.warning("profile_run_failed", model=model, error=str(e))
+                continue
+            if run["first_token"] is not None:
+                first_tokens.append(run["first_token"] - run["load_seconds"])
+                gaps.append(run["max_gap"])
+            if run["eval_seconds"] > 0:
+                rates.append(run["eval_count"] / run["eval_seconds"])
+            if run["prompt_seconds"] > 0:
+                prompt_rates.append(run["prompt_count"] / run["prompt_seconds"])
+    profile.update({
+        "firstTokenP50": _percentile(first_tokens, 50),
+        "firstTokenP95": _percentile(first_tokens, 95),
+        "gapP95": _percentile(gaps, 95),
+        "tokensPerSecond": _percentile(rates, 50),
+        "promptTokensPerSecond": _percentile(prompt_rates, 50),
+        "runs": len(first_tokens),
+        "errors": errors,
+    })
+    return profile
+
+
+def read_profile(path: str = MODEL_PROFILE_PATH):
+    """The profile file's contents, or None if it is missing or from another version"""
+    try:
+        with open(path, encoding="utf-8") as f:
+            profile = json.load(f)
+    except FileNotFoundError:
+        return None
+    if not isinstance(profile, dict) or profile.get("version") != PROFILE_VERSION:
+        raise ValueError(f"{path} is not a version {PROFILE_VERSION} model profile")
+    return profile
+
+
+def write_profile(models: dict, path: str = MODEL_PROFILE_PATH, hosts=None) -> dict:
+    """Merge models into the profile at path (models not re-profiled are kept)"""
+    try:
+        existing = read_profile(path) or {}
+    except ValueError:
+        existing = {}
+    profile = {
+        "version": PROFILE_VERSION,
+        "createdAt": time.time(),
+        "hosts": hosts if hosts is not None else [host.base_url for host in ollama_pool.hosts],
+        "prompts": list(PROFILE_PROMPTS),
+        "numPredict": PROFILE_NUM_PREDICT,
+        "models": {**existing.get("models", {}), **models},
+    }
+    temporary = path + ".tmp"
+    with open(temporary, "w", encoding="utf-8") as f:
+        json.dump(profile, f, indent=2)
+    os.replace(temporary, path)
+    return profile
+
+
+class ModelProfiles:
+    """Measured per-model latency, speed and memory, used until live samples take over
+
+    A model's entry is ignored once its weights digest no longer matches the
+    one it was profiled with.
+    """
+
+    def __init__(self, path: str = MODEL_PROFILE_PATH):
+        self.path = path
+        self.created_at = None
+        self.error = None
+        self._models = {}
+
+    def load(self):
+        try:
+            profile = read_profile(self.path)
+        except (OSError, ValueError) as e:
+            self.error = str(e)
+            log.warning("model_profile_unreadable", path=self.path, error=self.error)
+            return
+        if profile is None:
+            return
+        self._models = profile.get("models") or {}
+        self.created_at = profile.get("createdAt")
+        self.error = None
+        log.info("model_profile_loaded", path=self.path, models=len(self._models))
+
+    def get(self, model: str):
+        entry = self._models.get(model)
+        if entry is None:
+            return None
+        digest = model_registry.digest_for(model)
+        if digest and entry.get("digest") and digest != entry["digest"]:
+            # Re-pulled since it was profiled
+            return None
+        return entry
+
+    def _value(self, model: str, key: str):
+        entry = self.get(model)
+        return entry.get(key) if entry is not None else None
+
+    def first_token_p95(self, model: str):
+        return self._value(model, "firstTokenP95")
+
+    def gap_p95(self, model: str):
+        return self._value(model, "gapP95")
+
+    def cold_load_seconds(self, model: str):
+        return self._value(model, "coldLoadSeconds")
+
+    def size(self, model: str):
+        return self._value(model, "sizeBytes")
+
+    def expected_seconds(self, model: str, num_predict: int, loaded: bool = True):
+        """Seconds a generation of up to num_predict tokens should take, or None if unprofiled"""
+        entry = self.get(model)
+        if entry is None or not entry.get("tokensPerSecond"):
+            return None
+        seconds = (entry.get("firstTokenP50") or 0.0) + num_predict / entry["tokensPerSecond"]
+        if not loaded:
+            seconds += entry.get("coldLoadSeconds") or 0.0
+        return round(seconds, 1)
+
+    def stats(self) -> dict:
+        return {
+            "path": self.path,
+            "version": PROFILE_VERSION,
+            "createdAt": self.created_at,
+            "error": self.error,
+            "models": {
+                model: {**entry, "stale": self.get(model) is None}
+                for model, entry in self._models.items()
+            },
+        }
+
+
+model_profiles = ModelProfiles()
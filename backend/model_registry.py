@@ -0,0 +1,185 @@
+import asyncio
+import os
+import time
+
+from logger import log
+from ollama_client import ollama_pool
+
+MODEL_REFRESH_INTERVAL = float(os.environ.get("MODEL_REFRESH_INTERVAL", "60"))
+# Back-off while Ollama is unreachable, so models show up soon after it starts
+MODEL_RETRY_INTERVAL = float(os.environ.get("MODEL_RETRY_INTERVAL", "5"))
+MODEL_REFRESH_TIMEOUT = float(os.environ.get("MODEL_REFRESH_TIMEOUT", "10"))
+# Manual refreshes closer together than this reuse the last result
+MODEL_REFRESH_MIN_INTERVAL = float(os.environ.get("MODEL_REFRESH_MIN_INTERVAL", "2"))
+
+
+def display_names(tags) -> dict:
+    """Map full tags to display names, keeping names unique
+
+    A tag shows as its base name ("phi3") unless another tag shares that base,
+    in which case only the ":latest" one keeps it and the rest use the full tag
+    ("llama3:8b", "llama3:70b").
+    """
+    bases = {}
+    for tag in tags:
+        bases.setdefault(tag.split(":")[0], []).append(tag)
+    names = {}
+    for base, group in bases.items():
+        for tag in group:
+            if len(group) == 1 or tag == f"{base}:latest":
+                names[tag] = base
+            else:
+                names[tag] = tag
+    return names
+
+
+class ModelRegistry:
+    """Installed Ollama models, refreshed in the background and diffed by digest"""
+
+    def __init__(self, interval: float = MODEL_REFRESH_INTERVAL):
+        self.interval = interval
+        self._by_name = {}  # display name -> entry
+        self._by_tag = {}  # full tag -> entry
+        self._listeners = []
+        self._ready = asyncio.Event()  # a listing has been installed
+        self._attempted = asyncio.Event()  # the first refresh has finished, either way
+        self._task = None
+        self._refreshing = None
+        self.version = 0
+        self.refreshed_at = None
+        self.last_error = None
+        self.refreshes = 0
+        self.failures = 0
+
+    @property
+    def models(self) -> dict:
+        """Display name -> entry. Refreshes swap in a new dict, so iterating a snapshot is safe"""
+        return self._by_name
+
+    def get(self, name: str):
+        """Entry by display name or full tag"""
+        return self._by_name.get(name) or self._by_tag.get(name)
+
+    def digest_for(self, model_tag: str) -> str:
+        """Weights digest for a full model tag, used to key cached responses"""
+        entry = self._by_tag.get(model_tag)
+        return entry["digest"] if entry else ""
+
+    def subscribe(self, callback):
+        """Call callback(changes) after every refresh that changed the model set"""
+        self._listeners.append(callback)
+
+    async def start(self):
+        """Refresh in the background; startup does not wait for Ollama"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._refresh_loop())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def wait_ready(self, timeout: float = MODEL_REFRESH_TIMEOUT) -> bool:
+        """Wait for the first refresh to finish, so early requests don't see an empty list"""
+        try:
+            await asyncio.wait_for(self._attempted.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return self._ready.is_set()
+
+    async def _refresh_loop(self):
+        while True:
+            await self.refresh()
+            await asyncio.sleep(self.interval if self.last_error is None else MODEL_RETRY_INTERVAL)
+
+    async def refresh(self, max_age: float = 0.0) -> dict:
+        """Re-read /api/tags and apply the difference
+
+        Concurrent callers share one request, and a listing younger than
+        max_age seconds is reused as is.
+        """
+        if max_age and self.refreshed_at is not None and time.time() - self.refreshed_at < max_age:
+            return {"added": [], "removed": [], "changed": []}
+        if self._refreshing is None:
+            self._refreshing = asyncio.ensure_future(self._refresh())
+            self._refreshing.add_done_callback(self._refresh_done)
+        # Shielded so one caller giving up doesn't cancel the others' refresh
+        return await asyncio.shield(self._refreshing)
+
+    def _refresh_done(self, future):
+        self._refreshing = None
+
+    async def _refresh(self) -> dict:
+        self.refreshes += 1
+        try:
+            # Every host's models, so a tag on any of them can be routed to
+            listing = await ollama_pool.list_models(MODEL_REFRESH_TIMEOUT)
+        except Exception as e:
+            self.failures += 1
+            self.last_error = str(e) or type(e).__name__
+            log.error("models_refresh_failed", error=self.last_error)
+            # Keep serving the last known models
+            return {"added": [], "removed": [], "changed": [], "error": self.last_error}
+        finally:
+            self._attempted.set()
+        self.last_error = None
+        self.refreshed_at = time.time()
+        return self.apply(listing)
+
+    def apply(self, listing) -> dict:
+        """Install /api/tags entries and notify listeners of what changed"""
+        names = display_names(model["name"] for model in listing)
+        by_tag = {}
+        for model in listing:
+            tag = model["name"]
+            by_tag[tag] = {
+                "provider": "ollama",
+                "model_name": tag,
+                "display_name": names[tag],
+                "digest": model.get("digest", ""),
+                "size": model.get("size", 0),
+            }
+
+        old = self._by_tag
+        changes = {
+            "added": sorted(tag for tag in by_tag if tag not in old),
+            "removed": sorted(tag for tag in old if tag not in by_tag),
+            "changed": sorted(
+                tag for tag in by_tag
+                if tag in old and (old[tag]["digest"] != by_tag[tag]["digest"]
+                                   or old[tag]["display_name"] != by_tag[tag]["display_name"])
+            ),
+        }
+
+        first = not self._ready.is_set()
+        self._ready.set()
+        if not first and not any(changes.values()):
+            return changes
+
+        # Swap whole tables so requests iterating the old ones are unaffected
+        self._by_tag = by_tag
+        self._by_name = {entry["display_name"]: entry for entry in by_tag.values()}
+        self.version += 1
+        log.info("models_changed", models=list(self._by_name.keys()))
+        for callback in self._listeners:
+            try:
+                callback(changes)
+            except Exception as e:
+                log.error("model_listener_failed", error=str(e))
+        return changes
+
+    def stats(self) -> dict:
+        return {
+            "models": len(self._by_tag),
+            "version": self.version,
+            "ready": self._ready.is_set(),
+            "refreshed_at": self.refreshed_at,
+            "refresh_interval": self.interval,
+            "refreshes": self.refreshes,
+            "failures": self.failures,
+            "last_error": self.last_error,
+        }
+
+
+model_registry = ModelRegistry()
@@ -0,0 +1,494 @@
+import asyncio
+import json
+import os
+import time
+import httpx
+
+from logger import log
+
+OLLAMA_URL = os.environ.get("OLLAMA_URL", "http://localhost:11434").rstrip("/")
+# Comma-separated Ollama hosts sharing the load; defaults to OLLAMA_URL alone
+OLLAMA_URLS = [url.strip().rstrip("/") for url in os.environ.get("OLLAMA_URLS", OLLAMA_URL).split(",") if url.strip()]
+# How often every host's /api/tags and /api/ps are re-read
+OLLAMA_HEALTH_INTERVAL = float(os.environ.get("OLLAMA_HEALTH_INTERVAL", "10"))
+OLLAMA_HEALTH_TIMEOUT = float(os.environ.get("OLLAMA_HEALTH_TIMEOUT", "3"))
+
+# Pool sizing, per Ollama host. Generations hold a connection for their whole
+# stream, so max_connections is effectively the upstream concurrency ceiling.
+POOL_MAX_CONNECTIONS = int(os.environ.get("OLLAMA_POOL_MAX_CONNECTIONS", "32"))
+POOL_MAX_KEEPALIVE = int(os.environ.get("OLLAMA_POOL_MAX_KEEPALIVE", "16"))
+POOL_KEEPALIVE_EXPIRY = float(os.environ.get("OLLAMA_POOL_KEEPALIVE_EXPIRY", "30"))
+
+CONNECT_TIMEOUT = float(os.environ.get("OLLAMA_CONNECT_TIMEOUT", "5"))
+READ_TIMEOUT = float(os.environ.get("OLLAMA_READ_TIMEOUT", "120"))
+WRITE_TIMEOUT = float(os.environ.get("OLLAMA_WRITE_TIMEOUT", "30"))
+POOL_TIMEOUT = float(os.environ.get("OLLAMA_POOL_TIMEOUT", "60"))
+
+
+class _TrackedStream(httpx.AsyncByteStream):
+    """Response body wrapper that releases its pool slot exactly once"""
+
+    def __init__(self, stream, on_close):
+        self._stream = stream
+        self._on_close = on_close
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            yield chunk
+
+    async def aclose(self):
+        try:
+            await self._stream.aclose()
+        finally:
+            if self._on_close is not None:
+                on_close, self._on_close = self._on_close, None
+                on_close()
+
+
+class _InstrumentedTransport(httpx.AsyncBaseTransport):
+    """Wraps the pooled transport to count connections in use and pool waits"""
+
+    def __init__(self, transport: httpx.AsyncHTTPTransport, max_connections: int):
+        self._transport = transport
+        self.max_connections = max_connections
+        self.in_use = 0
+        self.peak_in_use = 0
+        self.waits = 0
+        self.requests = 0
+
+    def _release(self):
+        self.in_use -= 1
+
+    async def handle_async_request(self, request):
+        self.requests += 1
+        if self.in_use >= self.max_connections:
+            # Every connection is busy, this request queues inside httpcore
+            self.waits += 1
+        self.in_use += 1
+        self.peak_in_use = max(self.peak_in_use, self.in_use)
+        try:
+            response = await self._transport.handle_async_request(request)
+        except BaseException:
+            self._release()
+            raise
+        response.stream = _TrackedStream(response.stream, self._release)
+        return response
+
+    def open_connections(self):
+        pool = getattr(self._transport, "_pool", None)
+        return list(getattr(pool, "connections", []) or [])
+
+    async def aclose(self):
+        await self._transport.aclose()
+
+
+class OllamaClientPool:
+    """App-scoped httpx client shared by every upstream Ollama call"""
+
+    def __init__(self, base_url: str = OLLAMA_URL,
+                 max_connections: int = POOL_MAX_CONNECTIONS,
+                 max_keepalive: int = POOL_MAX_KEEPALIVE,
+                 keepalive_expiry: float = POOL_KEEPALIVE_EXPIRY):
+        self.base_url = base_url
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self._client = None
+        self._transport = None
+
+    def timeout(self, read: float = READ_TIMEOUT) -> httpx.Timeout:
+        """Separate connect/read/write/pool timeouts; read is the gap between chunks"""
+        return httpx.Timeout(connect=CONNECT_TIMEOUT, read=read, write=WRITE_TIMEOUT, pool=POOL_TIMEOUT)
+
+    async def start(self):
+        if self._client is not None:
+            return
+        self._transport = _InstrumentedTransport(
+            httpx.AsyncHTTPTransport(limits=self.limits),
+            self.limits.max_connections,
+        )
+        self._client = httpx.AsyncClient(
+            base_url=self.base_url,
+            transport=self._transport,
+            timeout=self.timeout(),
+        )
+
+    async def close(self):
+        if self._client is None:
+            return
+        client, self._client = self._client, None
+        await client.aclose()
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            raise RuntimeError("Ollama client pool is not started")
+        return self._client
+
+    def stats(self) -> dict:
+        """Pool usage numbers for sizing max_connections/keep-alive"""
+        if self._transport is None:
+            return {"started": False, "base_url": self.base_url}
+        connections = self._transport.open_connections()
+        idle = sum(1 for conn in connections if conn.is_idle())
+        return {
+            "started": True,
+            "base_url": self.base_url,
+            "max_connections": self.limits.max_connections,
+            "max_keepalive_connections": self.limits.max_keepalive_connections,
+            "keepalive_expiry": self.limits.keepalive_expiry,
+            "in_use": self._transport.in_use,
+            "peak_in_use": self._transport.peak_in_use,
+            "open_connections": len(connections),
+            "idle": idle,
+            "waits": self._transport.waits,
+            "requests": self._transport.requests,
+        }
+
+
+class OllamaStatusError(Exception):
+    """Ollama answered, but not with 200"""
+
+    def __init__(self, status_code: int):
+        super().__init__(f"Ollama API returned status {status_code}")
+        self.status_code = status_code
+
+
+class OllamaHost:
+    """One Ollama server: its connection pool, health and the models it has"""
+
+    def __init__(self, base_url: str):
+        self.base_url = base_url
+        self.pool = OllamaClientPool(base_url)
+        self.healthy = True  # until a check or request says otherwise
+        self.models = None  # tag -> /api/tags entry, None until first listed
+        self.loaded = set()  # tags in memory, from /api/ps and finished generations
+        self.active = 0  # generations streaming from this host
+        self.requests = 0
+        self.failures = 0
+        self.last_error = None
+        self.checked_at = None
+        self.running = []  # last /api/ps entries
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        return self.pool.client
+
+    def has(self, model: str) -> bool:
+        # A host that was never listed might have it; let a request find out
+        return self.models is None or model in self.models
+
+    def mark_failed(self, error: Exception):
+        self.healthy = False
+        self.failures += 1
+        self.last_error = str(error) or type(error).__name__
+
+    async def check(self, read_timeout: float = OLLAMA_HEALTH_TIMEOUT) -> bool:
+        """Re-read /api/tags (health and models) and /api/ps (what is loaded)"""
+        timeout = self.pool.timeout(read=read_timeout)
+        try:
+            response = await self.client.get("/api/tags", timeout=timeout)
+            if response.status_code != 200:
+                raise OllamaStatusError(response.status_code)
+            self.models = {model["name"]: model for model in response.json().get("models", [])}
+        except Exception as e:
+            if self.healthy:
+                log.warning("ollama_host_down", host=self.base_url, error=str(e))
+            self.mark_failed(e)
+            self.checked_at = time.time()
+            return False
+        if not self.healthy:
+            log.info("ollama_host_up", host=self.base_url)
+        self.healthy = True
+        self.checked_at = time.time()
+        try:
+            response = await self.client.get("/api/ps", timeout=timeout)
+            if response.status_code == 200:
+                self.running = response.json().get("models", [])
+                self.loaded = {model.get("name") or model.get("model") for model in self.running}
+        except Exception as e:
+            # Health comes from /api/tags; a missing /api/ps only costs routing hints
+            log.warning("ollama_ps_failed", host=self.base_url, error=str(e))
+        return True
+
+    def stats(self) -> dict:
+        return {
+            "url": self.base_url,
+            "healthy": self.healthy,
+            "models": sorted(self.models) if self.models is not None else None,
+            "loaded": sorted(self.loaded),
+            "active": self.active,
+            "requests": self.requests,
+            "failures": self.failures,
+            "last_error": self.last_error,
+            "checked_at": self.checked_at,
+            "pool": self.pool.stats(),
+        }
+
+
+class OllamaHosts:
+    """Every configured Ollama host, health-checked, with requests routed by model"""
+
+    def __init__(self, urls=OLLAMA_URLS, health_interval: float = OLLAMA_HEALTH_INTERVAL):
+        self.hosts = [OllamaHost(url) for url in (urls or [OLLAMA_URL])]
+        self.health_interval = health_interval
+        self.failovers = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self._task = None
+
+    @property
+    def base_url(self) -> str:
+        return self.hosts[0].base_url
+
+    def timeout(self, read: float = READ_TIMEOUT) -> httpx.Timeout:
+        return self.hosts[0].pool.timeout(read)
+
+    async def start(self):
+        for host in self.hosts:
+            await host.pool.start()
+        if self._task is None and self.health_interval > 0:
+            self._task = asyncio.create_task(self._health_loop())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for host in self.hosts:
+            await host.pool.close()
+
+    async def _health_loop(self):
+        while True:
+            await self.check()
+            await asyncio.sleep(self.health_interval)
+
+    async def check(self, read_timeout: float = OLLAMA_HEALTH_TIMEOUT):
+        await asyncio.gather(*(host.check(read_timeout) for host in self.hosts))
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        """Client of the first healthy host, for calls that aren't about one model"""
+        for host in self.hosts:
+            if host.healthy:
+                return host.client
+        return self.hosts[0].client
+
+    def route(self, model: str, exclude=()):
+        """Least busy host with the model, preferring ones that already have it loaded"""
+        candidates = [host for host in self.hosts if host not in exclude and host.has(model)]
+        if not candidates:
+            return None
+        # Down hosts are a last resort; one may have come back since its last check
+        return min(candidates, key=lambda host: (not host.healthy, model not in host.loaded, host.active, host.requests))
+
+    def is_loaded(self, model: str) -> bool:
+        """Whether a healthy host has the model in memory, as of its last check"""
+        return any(host.healthy and model in host.loaded for host in self.hosts)
+
+    async def request(self, model: str, method: str, path: str, **kwargs) -> httpx.Response:
+        """One non-streaming call about model, retried on another host if its host is unreachable"""
+        tried = []
+        while True:
+            host = self.route(model, exclude=tried)
+            if host is None:
+                raise Exception(f"No Ollama host has model {model}")
+            tried.append(host)
+            host.requests += 1
+            try:
+                response = await host.client.request(method, path, **kwargs)
+            except httpx.TransportError as e:
+                host.mark_failed(e)
+                if self.route(model, exclude=tried) is None:
+                    raise
+                self.failovers += 1
+                continue
+            if response.status_code == 200 and path in ("/api/generate", "/api/chat", "/api/embeddings"):
+                host.loaded.add(model)
+            return response
+
+    async def list_models(self, read_timeout: float = OLLAMA_HEALTH_TIMEOUT) -> list:
+        """/api/tags of every host, merged; raises only when no host answers"""
+        await self.check(read_timeout)
+        listing = {}
+        for host in self.hosts:
+            for tag, model in (host.models or {}).items():
+                listing.setdefault(tag, model)
+        if not any(host.healthy for host in self.hosts):
+            raise Exception(f"No Ollama host is reachable: {self.hosts[0].last_error}")
+        return list(listing.values())
+
+    async def running_models(self) -> list:
+        """/api/ps of every healthy host, merged by tag"""
+        await asyncio.gather(*(host.check() for host in self.hosts if host.healthy))
+        running = {}
+        for host in self.hosts:
+            if host.healthy:
+                for model in host.running:
+                    running.setdefault(model.get("name") or model.get("model"), model)
+        if not any(host.healthy for host in self.hosts):
+            raise Exception("No Ollama host is reachable")
+        return list(running.values())
+
+    def stats(self) -> dict:
+        hosts = [host.stats() for host in self.hosts]
+        return {
+            "started": any(host["pool"]["started"] for host in hosts),
+            "healthy": sum(1 for host in hosts if host["healthy"]),
+            "in_use": sum(host["pool"].get("in_use", 0) for host in hosts),
+            "failovers": self.failovers,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "hosts": hosts,
+        }
+
+
+ollama_pool = OllamaHosts()
+
+
+async def _generate_on(host: OllamaHost, model: str, payload: dict, timeout: httpx.Timeout, connected: dict):
+    """Parsed NDJSON chunks of one streaming /api/generate call on one host
+
+    connected[host] is set to when the response headers arrived.
+    """
+    host.requests += 1
+    host.active += 1
+    try:
+        async with host.client.stream(
+            "POST",
+            "/api/generate",
+            json=payload,
+            timeout=timeout or host.pool.timeout(),
+        ) as response:
+            connected[host] = time.monotonic()
+            if response.status_code != 200:
+                raise OllamaStatusError(response.status_code)
+            # done is the final line; reading to EOF lets the keep-alive
+            # connection go back to the pool
+            async for line in response.aiter_lines():
+                if not line.strip():
+                    continue
+                try:
+                    data = json.loads(line)
+                except json.JSONDecodeError:
+                    # Skip malformed JSON lines
+                    continue
+                yield data
+        host.loaded.add(model)
+    finally:
+        host.active -= 1
+
+
+async def stream_generate(model: str, prompt: str, options: dict, pool: OllamaHosts = None, timeout: httpx.Timeout = None,
+                          context: list = None, hedge_after: float = None, timings: dict = None):
+    """Yield each parsed NDJSON chunk of a streaming /api/generate call
+
+    The call goes to the host route() picks. If that host fails before the
+    first chunk arrives, the generation starts over on the next best host;
+    after that, errors are raised to the caller. With hedge_after, a host
+    that hasn't sent its first chunk by then gets a second copy of the call
+    racing it on another host; the first to answer is kept and the other
+    is closed. context is the array an earlier call's done chunk returned,
+    to continue that conversation. timings, if given, gets the answering
+    host, when its response headers arrived and whether it was a hedge.
+    """
+    pool = pool or ollama_pool
+    payload = {
+        "model": model,
+        "prompt": prompt,
+        "stream": True,
+        "options": options
+    }
+    if context:
+        payload["context"] = context
+    tried = []
+    racing = {}  # pending first read -> (host, stream)
+    connected = {}
+    hedge_hosts = set()  # hosts started as a hedge, not as a failover
+    
+    def launch() -> bool:
+        host = pool.route(model, exclude=tried)
+        if host is None:
+            return False
+        tried.append(host)
+        stream = _generate_on(host, model, payload, timeout, connected)
+        racing[asyncio.ensure_future(stream.__anext__())] = (host, stream)
+        return True
+    
+    if not launch():
+        raise Exception(f"No Ollama host has model {model}")
+    hedged = hedge_after is None
+    winner = None
+    try:
+        try:
+            while winner is None:
+                done, _ = await asyncio.wait(
+                    racing, timeout=None if hedged else hedge_after, return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    hedged = True
+                    if launch():
+                        hedge_hosts.add(tried[-1])
+                        pool.hedges += 1
+                        log.info("generation_hedged", model=model, after=round(hedge_after, 1), host=tried[-1].base_url)
+                    continue
+                for task in done:
+                    host, stream = racing.pop(task)
+                    try:
+                        first = task.result()
+                    except StopAsyncIteration:
+                        return
+                    except (httpx.TransportError, OllamaStatusError) as e:
+                        if isinstance(e, OllamaStatusError):
+                            if e.status_code == 404 and host.models is not None:
+                                # Listing was stale; the next health check corrects it
+                                host.models.pop(model, None)
+                        else:
+                            host.mark_failed(e)
+                        if racing:
+                            # The other copy is still in the race
+                            continue
+                        if not launch():
+                            raise
+                        pool.failovers += 1
+                        log.warning("generation_failover", model=model, host=host.base_url, error=repr(e),
+                                    next_host=tried[-1].base_url)
+                        continue
+                    winner = (host, stream)
+                    if host in hedge_hosts:
+                        pool.hedge_wins += 1
+                    if timings is not None:
+                        timings.update(host=host.base_url, connected=connected.get(host), hosts_tried=len(tried),
+                                       hedged=host in hedge_hosts)
+                    break
+        finally:
+            # Close the copy that lost the race (or everything, if the caller went away)
+            for task in racing:
+                task.cancel()
+            try:
+                # Unlike awaiting each task, gather still raises if the caller is cancelled meanwhile
+                await asyncio.gather(*racing, return_exceptions=True)
+            finally:
+                for task, (_, stream) in racing.items():
+                    if task.done():
+                        # A read still unwinding its cancellation closes its own stream
+                        await stream.aclose()
+                racing.clear()
+    except BaseException:
+        if winner is not None:
+            # Cancelled while the loser was being closed; the winner is never read
+            await winner[1].aclose()
+        raise
+    
+    host, stream = winner
+    try:
+        yield first
+        async for data in stream:
+            yield data
+    finally:
+        await stream.aclose()
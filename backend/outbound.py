@@ -0,0 +1,271 @@
+import asyncio
+import collections
+import itertools
+import json
+import os
+import time
+
+import metrics
+from logger import log
+
+# Frames queued for one connection before producers count it as full
+OUTBOUND_MAX_FRAMES = int(os.environ.get("OUTBOUND_MAX_FRAMES", "256"))
+# "disconnect" drops a client whose oldest queued frame (or current send) is older
+# than OUTBOUND_SLOW_SECONDS; "wait" makes producers wait on a full queue instead
+OUTBOUND_SLOW_POLICY = os.environ.get("OUTBOUND_SLOW_POLICY", "disconnect")
+OUTBOUND_SLOW_SECONDS = float(os.environ.get("OUTBOUND_SLOW_SECONDS", "15"))
+
+# Close code for "Try Again Later"
+SLOW_CLIENT_CLOSE_CODE = 1013
+
+queue_depth = metrics.registry.histogram(
+    "compare_outbound_queue_depth", "Frames queued for a connection when another is added",
+    buckets=(0, 1, 2, 4, 8, 16, 32, 64, 128, 256, 512))
+coalesced_frames = metrics.registry.counter(
+    "compare_outbound_coalesced_total", "Stream frames merged into one still waiting in a connection's queue")
+slow_disconnects = metrics.registry.counter(
+    "compare_slow_client_disconnects_total", "Connections closed for falling too far behind")
+
+
+class SlowClientError(ConnectionError):
+    """The connection was closed because the client stopped keeping up"""
+
+
+class _Frame:
+    __slots__ = ("message", "payload", "key", "queued_at")
+
+    def __init__(self, message, payload, key, queued_at):
+        self.message = message
+        self.payload = payload
+        self.key = key
+        self.queued_at = queued_at
+
+
+def _merge(queued: dict, message: dict) -> bool:
+    """Fold a stream frame into the same model's frame that hasn't been sent yet"""
+    status = message.get("status")
+    if status != queued.get("status"):
+        return False
+    if status == "delta":
+        # The queued frame keeps its offset; the text now runs up to the new seq
+        queued["delta"] += message["delta"]
+        queued["seq"] = message["seq"]
+        return True
+    if status == "streaming" and "full_response" in message and "full_response" in queued:
+        # v1 frames are snapshots, not deltas: the later one supersedes the queued one
+        queued["content"] = message["content"]
+        queued["full_response"] = message["full_response"]
+        return True
+    return False
+
+
+class Outbox:
+    """One connection's outbound queue, drained by a single writer task
+
+    Producers never await the socket. Stream frames for a model that is still
+    waiting in the queue are merged into it, so a slow client gets fewer,
+    larger frames instead of stalling the generations feeding it.
+    """
+
+    _ids = itertools.count(1)
+
+    def __init__(self, websocket, policy: str = OUTBOUND_SLOW_POLICY,
+                 max_frames: int = OUTBOUND_MAX_FRAMES, slow_seconds: float = OUTBOUND_SLOW_SECONDS):
+        self.id = next(Outbox._ids)
+        self.websocket = websocket
+        self.policy = policy if policy in ("disconnect", "wait") else "disconnect"
+        self.max_frames = max_frames
+        self.slow_seconds = slow_seconds
+        self._queue = collections.deque()
+        self._latest = {}  # (session, model) -> its stream frame still in the queue
+        self._ready = asyncio.Event()
+        self._space = asyncio.Event()
+        self._task = None
+        self._error = None
+        self._send_started = None
+        self.opened_at = time.monotonic()
+        self.frames_queued = 0
+        self.frames_sent = 0
+        self.bytes_sent = 0
+        self.coalesced = 0
+        self.max_depth = 0
+        self.send_seconds = 0.0
+        self.max_send_seconds = 0.0
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._error is None:
+            self._error = ConnectionError("Connection closed")
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self._queue.clear()
+        self._latest.clear()
+        self._space.set()
+
+    @property
+    def closed(self) -> bool:
+        return self._error is not None
+
+    async def send_text(self, payload: str):
+        await self._put(None, payload, None)
+
+    async def send_message(self, message: dict):
+        """Queue a frame as a dict; stream frames may be merged before it's serialized"""
+        model = message.get("model")
+        key = (message.get("sessionId"), model) if model is not None else None
+        if key is not None:
+            queued = self._latest.get(key)
+            if queued is not None and _merge(queued.message, message):
+                self.coalesced += 1
+                coalesced_frames.inc()
+                return
+            if message.get("status") not in ("delta", "streaming"):
+                # Later frames for this model mustn't be merged in front of this one
+                self._latest.pop(key, None)
+                key = None
+        await self._put(message, None, key)
+
+    async def _put(self, message, payload, key):
+        if self._error is not None:
+            raise self._error
+        now = time.monotonic()
+        if self.policy == "wait":
+            while len(self._queue) >= self.max_frames and self._error is None:
+                self._space.clear()
+                await self._space.wait()
+            if self._error is not None:
+                raise self._error
+        elif self._queue and now - self._queue[0].queued_at > self.slow_seconds:
+            await self._disconnect_slow(f"oldest frame queued {now - self._queue[0].queued_at:.1f}s ago")
+            raise self._error
+        elif len(self._queue) >= self.max_frames:
+            await self._disconnect_slow(f"{len(self._queue)} frames queued")
+            raise self._error
+
+        depth = len(self._queue)
+        queue_depth.observe(depth)
+        self.max_depth = max(self.max_depth, depth + 1)
+        frame = _Frame(message, payload, key, now)
+        self._queue.append(frame)
+        if key is not None:
+            self._latest[key] = frame
+        self.frames_queued += 1
+        self._ready.set()
+
+    async def _run(self):
+        try:
+            while True:
+                if not self._queue:
+                    self._ready.clear()
+                    await self._ready.wait()
+                    continue
+                frame = self._queue.popleft()
+                if frame.key is not None and self._latest.get(frame.key) is frame:
+                    del self._latest[frame.key]
+                self._space.set()
+                # Serialized here, once, after any merging
+                payload = frame.payload if frame.message is None else json.dumps(frame.message)
+                self._send_started = time.perf_counter()
+                if self.policy == "disconnect":
+                    try:
+                        await asyncio.wait_for(self.websocket.send_text(payload), self.slow_seconds)
+                    except asyncio.TimeoutError:
+                        await self._disconnect_slow(f"one send took over {self.slow_seconds}s")
+                        return
+                else:
+                    await self.websocket.send_text(payload)
+                elapsed = time.perf_counter() - self._send_started
+                self._send_started = None
+                metrics.send_latency.observe(elapsed)
+                self.frames_sent += 1
+                self.bytes_sent += len(payload)
+                self.send_seconds += elapsed
+                self.max_send_seconds = max(self.max_send_seconds, elapsed)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # The socket is gone; producers get the same error on their next send
+            self._error = e
+            self._queue.clear()
+            self._latest.clear()
+            self._space.set()
+
+    async def _disconnect_slow(self, reason: str):
+        if self._error is not None:
+            return
+        log.warning("slow_client_disconnected", connection=self.id, reason=reason)
+        slow_disconnects.inc()
+        self._error = SlowClientError(f"Client too slow: {reason}")
+        self._queue.clear()
+        self._latest.clear()
+        self._space.set()
+        try:
+            await self.websocket.close(code=SLOW_CLIENT_CLOSE_CODE, reason="Client too slow")
+        except Exception:
+            pass
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        return {
+            "id": self.id,
+            "policy": self.policy,
+            "connectedSeconds": round(now - self.opened_at, 1),
+            "queued": len(self._queue),
+            "maxDepth": self.max_depth,
+            "oldestQueuedSeconds": round(now - self._queue[0].queued_at, 3) if self._queue else 0.0,
+            "framesQueued": self.frames_queued,
+            "framesSent": self.frames_sent,
+            "bytesSent": self.bytes_sent,
+            "coalesced": self.coalesced,
+            "avgSendSeconds": round(self.send_seconds / self.frames_sent, 6) if self.frames_sent else None,
+            "maxSendSeconds": round(self.max_send_seconds, 6),
+            "sendingSeconds": round(time.perf_counter() - self._send_started, 3) if self._send_started else 0.0,
+            "closed": self.closed,
+        }
+
+
+class Connections:
+    """Live outboxes, for per-connection stats"""
+
+    def __init__(self):
+        self._open = {}
+        self.opened = 0
+        self.slow_disconnects = 0
+
+    def open(self, websocket) -> Outbox:
+        outbox = Outbox(websocket)
+        outbox.start()
+        self._open[outbox.id] = outbox
+        self.opened += 1
+        return outbox
+
+    async def close(self, outbox: Outbox):
+        if isinstance(outbox._error, SlowClientError):
+            self.slow_disconnects += 1
+        self._open.pop(outbox.id, None)
+        await outbox.close()
+
+    @property
+    def count(self) -> int:
+        return len(self._open)
+
+    def stats(self) -> dict:
+        return {
+            "policy": OUTBOUND_SLOW_POLICY,
+            "max_frames": OUTBOUND_MAX_FRAMES,
+            "slow_seconds": OUTBOUND_SLOW_SECONDS,
+            "open": len(self._open),
+            "opened": self.opened,
+            "slow_disconnects": self.slow_disconnects,
+            "connections": [outbox.stats() for outbox in self._open.values()],
+        }
+
+
+connections = Connections()
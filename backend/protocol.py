@@ -0,0 +1,154 @@
+import asyncio
+import os
+import time
+import zlib
+
+# WebSocket subprotocol a client offers to get delta frames; clients that offer
+# nothing keep the original (v1) full_response messages
+PROTOCOL_V2 = "compare.v2"
+
+STREAM_COALESCE_MS = float(os.environ.get("STREAM_COALESCE_MS", "50"))
+STREAM_COALESCE_BYTES = int(os.environ.get("STREAM_COALESCE_BYTES", "2048"))
+
+
+def negotiate_protocol(websocket) -> int:
+    """Pick the protocol version from the subprotocols the client offered"""
+    offered = websocket.scope.get("subprotocols") or []
+    if PROTOCOL_V2 in offered:
+        return 2
+    query = websocket.scope.get("query_string", b"").decode("latin-1")
+    return 2 if "protocol=2" in query.split("&") else 1
+
+
+def utf16_length(text: str) -> int:
+    """Length as JavaScript counts it, so offsets line up with String.length"""
+    return len(text.encode("utf-16-le")) // 2
+
+
+def checksum(text: str) -> str:
+    return format(zlib.crc32(text.encode("utf-8")) & 0xFFFFFFFF, "08x")
+
+
+class ModelStreamWriter:
+    """Formats one model's stream as v1 or v2 frames and sends them in order
+
+    send takes each frame as a dict; serializing is left to the connection so
+    frames it merges are only encoded once.
+    """
+
+    def __init__(self, send, model: str, session_id: str = "", version: int = 1,
+                 coalesce_ms: float = STREAM_COALESCE_MS, coalesce_bytes: int = STREAM_COALESCE_BYTES,
+                 clock=time.monotonic):
+        self._send = send
+        self._clock = clock
+        self.model = model
+        self.session_id = session_id
+        self.version = version
+        self.coalesce_window = coalesce_ms / 1000.0
+        self.coalesce_bytes = coalesce_bytes
+        self._parts = []
+        self._chunk_count = 0
+        self._length = 0  # UTF-16 units already framed
+        self._seq = 0
+        self._pending = []
+        self._pending_bytes = 0
+        self._pending_since = None
+        self._flush_handle = None
+        self._lock = asyncio.Lock()
+        self.frames_sent = 0
+
+    @property
+    def text(self) -> str:
+        return "".join(self._parts)
+
+    async def _emit(self, message: dict):
+        self.frames_sent += 1
+        await self._send(message)
+
+    def _base(self, status: str, **extra) -> dict:
+        message = {"model": self.model, "status": status, "sessionId": self.session_id}
+        if self.version == 2:
+            message["v"] = 2
+        message.update(extra)
+        return message
+
+    async def start(self, **extra):
+        if self.version == 2:
+            await self._emit(self._base("streaming", **extra))
+        else:
+            await self._emit(self._base("streaming", content="", **extra))
+
+    async def push(self, content: str):
+        if not content:
+            return
+        self._parts.append(content)
+        self._chunk_count += 1
+
+        if self.version == 1:
+            # Send update every few chunks to avoid flooding
+            if self._chunk_count % 3 == 0:
+                await self._emit(self._base(
+                    "streaming", content=content, full_response=self.text
+                ))
+            return
+
+        self._pending.append(content)
+        self._pending_bytes += len(content)
+        now = self._clock()
+        if self._pending_since is None:
+            self._pending_since = now
+        if self._pending_bytes >= self.coalesce_bytes or now - self._pending_since >= self.coalesce_window:
+            await self.flush()
+        elif self._flush_handle is None:
+            # Upstream may stall mid-window; don't sit on tokens the client could show
+            loop = asyncio.get_running_loop()
+            self._flush_handle = loop.call_later(
+                self.coalesce_window, lambda: loop.create_task(self._timed_flush())
+            )
+
+    async def _timed_flush(self):
+        self._flush_handle = None
+        try:
+            await self.flush()
+        except Exception:
+            # The socket is gone; the producer hits the same error on its next send
+            pass
+
+    async def flush(self):
+        """Send pending text as one delta frame"""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        async with self._lock:
+            if not self._pending:
+                return
+            delta = "".join(self._pending)
+            self._pending.clear()
+            self._pending_bytes = 0
+            self._pending_since = None
+            self._seq += 1
+            offset = self._length
+            self._length += utf16_length(delta)
+            await self._emit(self._base("delta", seq=self._seq, offset=offset, delta=delta))
+
+    async def complete(self, full_response: str = None, **extra):
+        """Final frame; v2 carries the full text exactly once, with a checksum"""
+        if full_response is None:
+            full_response = self.text
+        if self.version == 1:
+            await self._emit(self._base(
+                "completed", content="",
+                full_response=full_response if full_response else "No response received", **extra
+            ))
+            return
+        await self.flush()
+        full_response = full_response if full_response else "No response received"
+        await self._emit(self._base(
+            "completed", seq=self._seq + 1, full_response=full_response,
+            length=utf16_length(full_response), checksum=checksum(full_response), **extra
+        ))
+
+    def close(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
@@ -0,0 +1,229 @@
+import asyncio
+import os
+import time
+
+from logger import log
+from model_profile import model_profiles
+from ollama_client import ollama_pool
+
+# Memory Ollama can keep models in, in GB. 0 learns it from the largest set of
+# models /api/ps has shown loaded at the same time.
+RESIDENCY_MEMORY_GB = float(os.environ.get("RESIDENCY_MEMORY_GB", "0"))
+RESIDENCY_PS_TTL = float(os.environ.get("RESIDENCY_PS_TTL", "2"))
+RESIDENCY_PREFETCH = os.environ.get("RESIDENCY_PREFETCH", "1") == "1"
+RESIDENCY_KEEP_ALIVE = os.environ.get("RESIDENCY_KEEP_ALIVE", "5m")
+# A load_duration above this means the weights were read in, not already resident
+RESIDENCY_LOAD_THRESHOLD = float(os.environ.get("RESIDENCY_LOAD_THRESHOLD", "0.5"))
+
+# Loaded models need more than their file size (KV cache, buffers)
+MEMORY_OVERHEAD = 1.2
+
+
+def group_by_memory(tags, size_of, budget: int):
+    """First-fit-decreasing packing of tags into groups that fit in budget bytes"""
+    groups = []
+    for tag in sorted(tags, key=size_of, reverse=True):
+        for group in groups:
+            if group["bytes"] + size_of(tag) <= budget:
+                group["tags"].append(tag)
+                group["bytes"] += size_of(tag)
+                break
+        else:
+            groups.append({"tags": [tag], "bytes": size_of(tag)})
+    return [group["tags"] for group in groups]
+
+
+class ResidencyPlan:
+    """Execution order for one comparison, plus what loading it cost"""
+
+    def __init__(self, order, resident, groups):
+        self.order = order  # display names, resident models first
+        self.resident = resident
+        self.groups = groups
+        self.started = set()
+        self.warmed = []
+        self.loads = {}  # display name -> seconds spent loading
+
+    def sort(self, models):
+        """(display name, entry) pairs in plan order"""
+        position = {name: index for index, name in enumerate(self.order)}
+        return sorted(models, key=lambda item: position.get(item[0], len(position)))
+
+    def next_pending(self):
+        for name in self.order:
+            if name not in self.started:
+                return name
+        return None
+
+    def report(self) -> dict:
+        return {
+            "order": self.order,
+            "resident": self.resident,
+            "groups": self.groups,
+            "warmed": self.warmed,
+            "modelSwitches": sum(1 for s in self.loads.values() if s >= RESIDENCY_LOAD_THRESHOLD),
+            "loadSeconds": round(sum(self.loads.values()), 2),
+        }
+
+
+class ResidencyTracker:
+    """Which models Ollama has in memory, from /api/ps and observed load times"""
+
+    def __init__(self, memory_bytes: int = int(RESIDENCY_MEMORY_GB * 1e9), prefetch: bool = RESIDENCY_PREFETCH):
+        self.configured_memory = memory_bytes
+        self.prefetch = prefetch
+        self.loaded = {}  # tag -> bytes in memory
+        self.sizes = {}  # tag -> bytes when loaded, as last reported by /api/ps
+        self.peak_resident = 0
+        self.refreshed_at = 0.0
+        self._refreshing = None
+        self._warming = {}
+        self._prefetching = set()
+        self.load_times = {}  # tag -> running average load seconds
+        self.model_switches = 0
+        self.load_seconds = 0.0
+        self.warmups = 0
+        self.warm_hits = 0
+        self.ps_errors = 0
+
+    @property
+    def memory_budget(self) -> int:
+        return self.configured_memory or self.peak_resident
+
+    def size_of(self, entry: dict) -> int:
+        tag = entry["model_name"]
+        return self.sizes.get(tag) or model_profiles.size(tag) or int(entry.get("size", 0) * MEMORY_OVERHEAD)
+
+    async def refresh(self, max_age: float = RESIDENCY_PS_TTL):
+        """Re-read /api/ps unless the last reading is recent enough"""
+        if time.monotonic() - self.refreshed_at < max_age:
+            return
+        if self._refreshing is None:
+            self._refreshing = asyncio.ensure_future(self._refresh())
+            self._refreshing.add_done_callback(self._refresh_done)
+        await asyncio.shield(self._refreshing)
+
+    def _refresh_done(self, future):
+        self._refreshing = None
+
+    async def _refresh(self):
+        try:
+            # With several hosts, memory and residency are tracked for them as a whole
+            running = await ollama_pool.running_models()
+        except Exception as e:
+            # Ordering falls back to what this process has observed itself
+            self.ps_errors += 1
+            log.warning("residency_ps_failed", error=str(e))
+            self.refreshed_at = time.monotonic()
+            return
+        self.loaded = {}
+        for model in running:
+            tag = model.get("name") or model.get("model")
+            size = model.get("size") or model.get("size_vram") or 0
+            self.loaded[tag] = size
+            if size:
+                self.sizes[tag] = size
+        self.peak_resident = max(self.peak_resident, sum(self.loaded.values()))
+        self.refreshed_at = time.monotonic()
+
+    async def plan(self, models, num_predict: int = 500) -> ResidencyPlan:
+        """Order (display name, entry) pairs: resident models, then groups that fit in memory
+
+        Within each, profiled models go fastest first so early answers arrive sooner;
+        unprofiled ones keep their registry order after them.
+        """
+        await self.refresh()
+        entries = dict(models)
+
+        def fastest_first(names):
+            return sorted(names, key=lambda name: model_profiles.expected_seconds(
+                entries[name]["model_name"], num_predict) or float("inf"))
+
+        resident = fastest_first([name for name, entry in models if entry["model_name"] in self.loaded])
+        rest = [name for name, entry in models if entry["model_name"] not in self.loaded]
+
+        budget = self.memory_budget
+        if budget:
+            groups = group_by_memory(rest, lambda name: self.size_of(entries[name]), budget)
+        else:
+            # Nothing known about memory yet; one model at a time
+            groups = [[name] for name in fastest_first(rest)]
+        groups = [fastest_first(group) for group in groups]
+        order = resident + [name for group in groups for name in group]
+        return ResidencyPlan(order, resident, ([resident] if resident else []) + groups)
+
+    def started(self, plan: ResidencyPlan, name: str, models: dict):
+        """Note a model started and, in the background, warm the next one if it fits beside what is loaded
+
+        Re-reading /api/ps asks every host, so the generation that just started
+        never waits on it.
+        """
+        plan.started.add(name)
+        if not self.prefetch or not self.memory_budget:
+            return
+        self.loaded.setdefault(models[name]["model_name"], self.size_of(models[name]))
+        task = asyncio.create_task(self._prefetch(plan, name, models))
+        self._prefetching.add(task)
+        task.add_done_callback(self._prefetching.discard)
+
+    async def _prefetch(self, plan: ResidencyPlan, name: str, models: dict):
+        await self.refresh()
+        # /api/ps may not show the model that just started yet
+        self.loaded.setdefault(models[name]["model_name"], self.size_of(models[name]))
+        upcoming = plan.next_pending()
+        if upcoming is None:
+            return
+        tag = models[upcoming]["model_name"]
+        if tag in self.loaded or tag in self._warming:
+            return
+        if sum(self.loaded.values()) + self.size_of(models[upcoming]) > self.memory_budget:
+            # Loading it now would evict a model that is still streaming
+            return
+        plan.warmed.append(upcoming)
+        self._warming[tag] = asyncio.create_task(self._warm(tag, self.size_of(models[upcoming])))
+
+    async def _warm(self, tag: str, size: int):
+        """Load a model's weights with an empty prompt so its turn starts generating at once"""
+        self.warmups += 1
+        try:
+            # Routed like a generation, so the warmed host is the one it will prefer
+            response = await ollama_pool.request(
+                tag, "POST", "/api/generate",
+                json={"model": tag, "prompt": "", "keep_alive": RESIDENCY_KEEP_ALIVE, "stream": False},
+                timeout=ollama_pool.timeout(read=300.0),
+            )
+            if response.status_code == 200:
+                self.loaded[tag] = self.sizes.get(tag, size)
+        except Exception as e:
+            log.warning("warm_up_failed", model=tag, error=str(e))
+        finally:
+            del self._warming[tag]
+
+    def record_load(self, plan: ResidencyPlan, name: str, model_tag: str, seconds):
+        """Account a finished generation's load_duration (None when nothing was generated)"""
+        if seconds is None:
+            return
+        plan.loads[name] = seconds
+        if seconds >= RESIDENCY_LOAD_THRESHOLD:
+            self.model_switches += 1
+            self.load_seconds += seconds
+            previous = self.load_times.get(model_tag)
+            self.load_times[model_tag] = seconds if previous is None else 0.7 * previous + 0.3 * seconds
+        elif name in plan.warmed:
+            self.warm_hits += 1
+
+    def stats(self) -> dict:
+        return {
+            "loaded": sorted(self.loaded),
+            "memory_budget_bytes": self.memory_budget,
+            "memory_budget_source": "configured" if self.configured_memory else "observed",
+            "model_switches": self.model_switches,
+            "load_seconds": round(self.load_seconds, 2),
+            "warmups": self.warmups,
+            "warm_hits": self.warm_hits,
+            "ps_errors": self.ps_errors,
+            "average_load_seconds": {tag: round(s, 2) for tag, s in self.load_times.items()},
+        }
+
+
+residency = ResidencyTracker()
@@ -0,0 +1,171 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+RESPONSE_CACHE_ENABLED = os.environ.get("RESPONSE_CACHE_ENABLED", "1") == "1"
+RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get("RESPONSE_CACHE_MAX_ENTRIES", "500"))
+RESPONSE_CACHE_TTL = float(os.environ.get("RESPONSE_CACHE_TTL", "86400"))
+# SQLite file for a cache that survives restarts; empty keeps it in memory only
+RESPONSE_CACHE_PATH = os.environ.get("RESPONSE_CACHE_PATH", "")
+RESPONSE_CACHE_MAX_DISK_ENTRIES = int(os.environ.get("RESPONSE_CACHE_MAX_DISK_ENTRIES", "5000"))
+# "instant" replays a hit at full speed, "recorded" at the pace it was generated
+RESPONSE_CACHE_REPLAY = os.environ.get("RESPONSE_CACHE_REPLAY", "instant")
+
+
+def make_cache_key(model_tag: str, digest: str, prompt: str, options: dict) -> str:
+    """Exact-match key: model tag and weights digest, final prompt and generation options"""
+    payload = json.dumps([model_tag, digest or "", prompt, options], sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class _SQLiteStore:
+    """Optional on-disk backing for the in-memory LRU"""
+
+    def __init__(self, path: str, max_entries: int):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS response_cache ("
+            "key TEXT PRIMARY KEY, created REAL NOT NULL, payload TEXT NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS response_cache_created ON response_cache (created)")
+        self._conn.commit()
+
+    def get(self, key: str):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT created, payload FROM response_cache WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            return None
+        return row[0], json.loads(row[1])
+
+    def put(self, key: str, created: float, entry: dict, expire_before: float):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO response_cache (key, created, payload) VALUES (?, ?, ?)",
+                (key, created, json.dumps(entry)),
+            )
+            self._conn.execute("DELETE FROM response_cache WHERE created < ?", (expire_before,))
+            self._conn.execute(
+                "DELETE FROM response_cache WHERE key IN ("
+                "SELECT key FROM response_cache ORDER BY created DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+            self._conn.commit()
+
+    def delete(self, key: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM response_cache WHERE key = ?", (key,))
+            self._conn.commit()
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM response_cache")
+            self._conn.commit()
+
+    def count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM response_cache").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class ResponseCache:
+    """LRU/TTL cache of completed generations, including their chunk timing for replay"""
+
+    def __init__(self, enabled: bool = RESPONSE_CACHE_ENABLED,
+                 max_entries: int = RESPONSE_CACHE_MAX_ENTRIES,
+                 ttl: float = RESPONSE_CACHE_TTL,
+                 path: str = RESPONSE_CACHE_PATH):
+        self.enabled = enabled
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (created, entry)
+        self._store = _SQLiteStore(path, RESPONSE_CACHE_MAX_DISK_ENTRIES) if enabled and path else None
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.stores = 0
+        self.evictions = 0
+
+    def _expired(self, created: float) -> bool:
+        return self.ttl > 0 and time.time() - created > self.ttl
+
+    def _remember(self, key: str, created: float, entry: dict):
+        self._entries[key] = (created, entry)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    async def get(self, key: str, record: bool = True):
+        """The entry under key, or None; record=False leaves the hit/miss counts alone"""
+        if not self.enabled:
+            return None
+        item = self._entries.get(key)
+        if item is None and self._store is not None:
+            item = await asyncio.to_thread(self._store.get, key)
+            if item is not None:
+                self._remember(key, *item)
+        if item is not None and self._expired(item[0]):
+            self._entries.pop(key, None)
+            if self._store is not None:
+                await asyncio.to_thread(self._store.delete, key)
+            item = None
+        if item is None:
+            self.misses += record
+            return None
+        self._entries.move_to_end(key)
+        self.hits += record
+        return item[1]
+
+    async def put(self, key: str, entry: dict):
+        if not self.enabled:
+            return
+        created = time.time()
+        self._remember(key, created, entry)
+        self.stores += 1
+        if self._store is not None:
+            expire_before = created - self.ttl if self.ttl > 0 else 0
+            await asyncio.to_thread(self._store.put, key, created, entry, expire_before)
+
+    def record_bypass(self):
+        self.bypassed += 1
+
+    async def clear(self):
+        self._entries.clear()
+        if self._store is not None:
+            await asyncio.to_thread(self._store.clear)
+
+    def close(self):
+        if self._store is not None:
+            self._store.close()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "entries": len(self._entries),
+            "disk_entries": self._store.count() if self._store is not None else None,
+            "max_entries": self.max_entries,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            "bypassed": self.bypassed,
+            "stores": self.stores,
+            "evictions": self.evictions,
+        }
+
+
+response_cache = ResponseCache()
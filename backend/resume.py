@@ -0,0 +1,341 @@
+import asyncio
+import collections
+import json
+import os
+import secrets
+import time
+
+from protocol import utf16_length
+
+# Seconds a session keeps generating after its socket drops, waiting for a resume
+SESSION_RESUME_GRACE = float(os.environ.get("SESSION_RESUME_GRACE", "60"))
+# Seconds a finished session's output stays available to resume
+SESSION_RESUME_TTL = float(os.environ.get("SESSION_RESUME_TTL", "300"))
+# Buffered output across every session; least recently used sessions go first
+SESSION_BUFFER_MAX_MB = float(os.environ.get("SESSION_BUFFER_MAX_MB", "64"))
+
+# Frames that end a model's stream
+TERMINAL_STATUSES = ("completed", "error", "cancelled")
+
+
+def utf16_slice(text: str, offset: int) -> str:
+    """text from a JavaScript (UTF-16) offset on"""
+    if offset <= 0:
+        return text
+    return text.encode("utf-16-le")[offset * 2:].decode("utf-16-le", errors="ignore")
+
+
+class _ModelBuffer:
+    __slots__ = ("parts", "length", "seq", "final")
+
+    def __init__(self):
+        self.parts = []
+        self.length = 0  # UTF-16 units
+        self.seq = 0
+        self.final = None  # terminal frame, as sent
+
+    @property
+    def text(self) -> str:
+        if len(self.parts) > 1:
+            self.parts = ["".join(self.parts)]
+        return self.parts[0] if self.parts else ""
+
+
+class SessionChannel:
+    """Stands in for the socket of one session so it can outlive the connection
+
+    Everything sent is recorded (per-model text with offsets, final frames and
+    the latest of each session-level status) and forwarded to whichever
+    connection is attached. A client that reconnects gets what it missed,
+    then the live stream.
+    """
+
+    def __init__(self, session_id: str, protocol: int, outbox=None, owner=None):
+        self.session_id = session_id
+        self.owner = owner
+        # Sent in the starting frame; resuming from another connection needs it
+        self.token = secrets.token_urlsafe(16)
+        self.connection = getattr(outbox, "id", None)
+        self.protocol = protocol
+        self.run = None
+        self.outbox = outbox
+        self.models = {}
+        self.control = collections.OrderedDict()  # status -> latest session-level payload
+        self.bytes = 0
+        self.detached_at = None
+        self.finished_at = None
+        self.touched_at = time.monotonic()
+        self.resumes = 0
+        self._lock = asyncio.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self.run is not None and self.run.task is not None and not self.run.task.done()
+
+    def _grow(self, count: int):
+        self.bytes += count
+        if self.owner is not None:
+            self.owner.grew(count)
+
+    def _model(self, model: str) -> _ModelBuffer:
+        buffer = self.models.get(model)
+        if buffer is None:
+            buffer = self.models[model] = _ModelBuffer()
+        return buffer
+
+    def _record(self, message: dict, payload: str = None):
+        model = message.get("model")
+        status = message.get("status")
+        if model is None:
+            if status is not None:
+                payload = payload or json.dumps(message)
+                self._grow(len(payload) - len(self.control.pop(status, "")))
+                self.control[status] = payload
+            return
+        buffer = self._model(model)
+        if status == "delta":
+            buffer.parts.append(message["delta"])
+            buffer.length += utf16_length(message["delta"])
+            buffer.seq = message.get("seq", buffer.seq)
+            self._grow(len(message["delta"]))
+        elif status == "streaming" and "full_response" in message:
+            # v1 frames carry the whole text so far
+            text = message["full_response"]
+            self._grow(len(text) - len(buffer.text))
+            buffer.parts = [text]
+            buffer.length = utf16_length(text)
+        elif status in TERMINAL_STATUSES:
+            buffer.final = message
+            if status == "completed" and message.get("full_response") is not None:
+                # The final text can differ from the stream (truncation note)
+                text = message["full_response"]
+                self._grow(len(text) - len(buffer.text))
+                buffer.parts = [text]
+                buffer.length = utf16_length(text)
+
+    async def send_message(self, message: dict):
+        async with self._lock:
+            self._record(message)
+            if self.outbox is not None:
+                await self._forward(self.outbox.send_message, message)
+
+    async def send_text(self, payload: str):
+        async with self._lock:
+            self._record(json.loads(payload), payload)
+            if self.outbox is not None:
+                await self._forward(self.outbox.send_text, payload)
+
+    async def _forward(self, send, frame):
+        try:
+            await send(frame)
+        except ConnectionError:
+            # The socket is going away; keep recording for a resume
+            self.outbox = None
+
+    def replay(self, offsets: dict, done=()) -> list:
+        """Frames that bring a client holding offsets (model -> UTF-16 length) up to date"""
+        frames = []
+        tail = []
+        for status, payload in self.control.items():
+            (frames if status == "starting" else tail).append(payload)
+        for model, buffer in self.models.items():
+            if model in done:
+                continue
+            offset = max(0, int(offsets.get(model, 0) or 0))
+            if buffer.length > offset:
+                missing = utf16_slice(buffer.text, offset)
+                message = {"model": model, "status": "streaming", "sessionId": self.session_id, "replay": True}
+                if self.protocol == 2:
+                    message.update(v=2, status="delta", seq=buffer.seq, offset=offset, delta=missing)
+                else:
+                    message.update(content=missing, full_response=buffer.text)
+                frames.append(message)
+            if buffer.final is not None:
+                frames.append(buffer.final)
+        # all_completed and the final scores come after the models they describe
+        tail.sort(key=lambda payload: '"all_completed"' in payload)
+        return frames + tail
+
+    async def attach(self, outbox, offsets: dict, done=()) -> int:
+        """Send what the client missed and forward live frames to it from now on"""
+        async with self._lock:
+            frames = self.replay(offsets, done)
+            self.outbox = outbox
+            self.connection = getattr(outbox, "id", None)
+            self.detached_at = None
+            self.resumes += 1
+            self.touched_at = time.monotonic()
+            for frame in frames:
+                if isinstance(frame, dict):
+                    await outbox.send_message(frame)
+                else:
+                    await outbox.send_text(frame)
+            return len(frames)
+
+    def detach(self):
+        self.outbox = None
+        self.detached_at = time.monotonic()
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        return {
+            "sessionId": self.session_id,
+            "running": self.running,
+            "attached": self.outbox is not None,
+            "detachedSeconds": round(now - self.detached_at, 1) if self.detached_at is not None else None,
+            "models": len(self.models),
+            "bytes": self.bytes,
+            "resumes": self.resumes,
+        }
+
+
+class SessionBuffers:
+    """Resumable sessions by ID, with a grace period for detached ones and an LRU memory cap"""
+
+    def __init__(self, grace: float = SESSION_RESUME_GRACE, ttl: float = SESSION_RESUME_TTL,
+                 max_bytes: int = int(SESSION_BUFFER_MAX_MB * 1024 * 1024)):
+        self.grace = grace
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._sessions = collections.OrderedDict()
+        self._timers = {}
+        self.bytes = 0
+        self.on_expire = None  # async (channel, reason) -> stops the session's generation
+        self.resumed = 0
+        self.resume_misses = 0
+        self.resume_rejected = 0
+        self.expired = 0
+        self.evicted = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.grace > 0
+
+    def open(self, session_id: str, protocol: int, outbox) -> SessionChannel:
+        self._purge()
+        self._drop(session_id)
+        channel = SessionChannel(session_id, protocol, outbox, owner=self)
+        self._sessions[session_id] = channel
+        return channel
+
+    def get(self, session_id: str):
+        self._purge()
+        channel = self._sessions.get(session_id)
+        if channel is not None:
+            self._sessions.move_to_end(session_id)
+            channel.touched_at = time.monotonic()
+        return channel
+
+    async def resume(self, session_id: str, outbox, offsets: dict, done=(), token: str = None):
+        """Reattach a session to a new connection; None if it is gone or token isn't its own
+
+        The connection that started or last resumed the session may resume it
+        without the token; any other has to show it.
+        """
+        channel = self.get(session_id)
+        if channel is None:
+            self.resume_misses += 1
+            return None
+        same_connection = channel.connection is not None and channel.connection == getattr(outbox, "id", None)
+        if not same_connection and not secrets.compare_digest(str(token or ""), channel.token):
+            self.resume_rejected += 1
+            return None
+        self._cancel_timer(channel)
+        await channel.attach(outbox, offsets or {}, done)
+        self.resumed += 1
+        return channel
+
+    def finished(self, channel: SessionChannel):
+        channel.finished_at = time.monotonic()
+        self._cancel_timer(channel)
+        self._enforce_budget()
+
+    async def detach(self, channel: SessionChannel, outbox):
+        """outbox's socket dropped: keep generating for the grace period, then give up"""
+        if channel.outbox not in (outbox, None):
+            # Already resumed on another connection
+            return
+        channel.detach()
+        if self._sessions.get(channel.session_id) is not channel:
+            # Evicted or replaced; nobody can resume it
+            await self._expire(channel, "disconnected")
+            return
+        if not channel.running:
+            return
+        if not self.enabled:
+            await self._expire(channel, "disconnected")
+            return
+        self._cancel_timer(channel)
+        loop = asyncio.get_running_loop()
+        self._timers[channel.session_id] = loop.call_later(
+            self.grace, lambda: loop.create_task(self._expire(channel, "disconnected"))
+        )
+
+    async def _expire(self, channel: SessionChannel, reason: str):
+        self._timers.pop(channel.session_id, None)
+        if channel.outbox is not None or not channel.running:
+            return
+        self.expired += 1
+        if self._sessions.get(channel.session_id) is channel:
+            # Its output stops partway; a late resume gets an error instead
+            self._drop(channel.session_id)
+        if self.on_expire is not None:
+            await self.on_expire(channel, reason)
+
+    def _drop(self, session_id: str):
+        channel = self._sessions.pop(session_id, None)
+        if channel is not None:
+            self._cancel_timer(channel)
+            channel.owner = None
+            self.bytes -= channel.bytes
+        return channel
+
+    def grew(self, count: int):
+        self.bytes += count
+        if count > 0 and self.bytes > self.max_bytes:
+            self._enforce_budget()
+
+    def _cancel_timer(self, channel: SessionChannel):
+        timer = self._timers.pop(channel.session_id, None)
+        if timer is not None:
+            timer.cancel()
+
+    def _purge(self):
+        now = time.monotonic()
+        for session_id, channel in list(self._sessions.items()):
+            if channel.finished_at is not None and (channel.outbox is None or channel.outbox.closed) and now - channel.finished_at > self.ttl:
+                self._drop(session_id)
+
+    def _enforce_budget(self):
+        """Drop least recently used buffers: finished ones, then detached running ones"""
+        for evict_running in (False, True):
+            for session_id, channel in list(self._sessions.items()):
+                if self.bytes <= self.max_bytes:
+                    return
+                if channel.running and (not evict_running or channel.outbox is not None):
+                    continue
+                self._drop(session_id)
+                self.evicted += 1
+                if channel.running:
+                    # Nobody can resume it any more; stop paying for it
+                    asyncio.get_running_loop().create_task(self._expire(channel, "evicted"))
+
+    def stats(self) -> dict:
+        sessions = list(self._sessions.values())
+        return {
+            "grace_seconds": self.grace,
+            "ttl_seconds": self.ttl,
+            "max_bytes": self.max_bytes,
+            "bytes": self.bytes,
+            "sessions": len(sessions),
+            "detached": sum(1 for channel in sessions if channel.outbox is None and channel.running),
+            "resumed": self.resumed,
+            "resume_misses": self.resume_misses,
+            "resume_rejected": self.resume_rejected,
+            "expired": self.expired,
+            "evicted": self.evicted,
+            "buffered": [channel.stats() for channel in sessions],
+        }
+
+
+session_buffers = SessionBuffers()
@@ -0,0 +1,207 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict, defaultdict, deque
+from contextlib import asynccontextmanager
+
+SCHEDULER_GLOBAL_LIMIT = int(os.environ.get("SCHEDULER_GLOBAL_LIMIT", "6"))
+SCHEDULER_PER_MODEL_LIMIT = int(os.environ.get("SCHEDULER_PER_MODEL_LIMIT", "2"))
+SCHEDULER_MAX_QUEUE = int(os.environ.get("SCHEDULER_MAX_QUEUE", "100"))
+SCHEDULER_BATCH_SIZE = int(os.environ.get("SCHEDULER_BATCH_SIZE", "3"))
+
+# Processing modes are per-session concurrency hints; None means "as many as
+# the global and per-model limits allow"
+MODE_SESSION_LIMITS = {
+    "sequential": 1,
+    "batch": SCHEDULER_BATCH_SIZE,
+    "parallel": None,
+    # Early-stop modes start everything and cancel what's left once they have an answer
+    "race": None,
+    "top_k": None,
+    "quorum": None,
+}
+
+
+class QueueFullError(Exception):
+    """Raised when a request would push the wait queue past its bound"""
+
+    def __init__(self, position: int, max_queue: int):
+        self.position = position
+        self.max_queue = max_queue
+        super().__init__(f"Queue full: position {position} exceeds the limit of {max_queue} waiting generations")
+
+
+class _Waiter:
+    __slots__ = ("model", "session_limit", "future")
+
+    def __init__(self, model, session_limit, future):
+        self.model = model
+        self.session_limit = session_limit
+        self.future = future
+
+
+class FairScheduler:
+    """Process-wide generation slots with per-model limits and round-robin across sessions"""
+
+    def __init__(self, global_limit: int = SCHEDULER_GLOBAL_LIMIT,
+                 per_model_limit: int = SCHEDULER_PER_MODEL_LIMIT,
+                 max_queue: int = SCHEDULER_MAX_QUEUE):
+        self.global_limit = global_limit
+        self.per_model_limit = per_model_limit
+        self.max_queue = max_queue
+        self.active = 0
+        self.active_by_model = defaultdict(int)
+        self.active_by_session = defaultdict(int)
+        # session -> FIFO of waiters; dict order is the round-robin rotation
+        self._queues = OrderedDict()
+        self._waiting = 0
+        self.granted = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+
+    def _can_run(self, session, model, session_limit) -> bool:
+        if self.active >= self.global_limit:
+            return False
+        if self.active_by_model.get(model, 0) >= self.per_model_limit:
+            return False
+        if session_limit is not None and self.active_by_session.get(session, 0) >= session_limit:
+            return False
+        return True
+
+    def _grant(self, session, model):
+        self.active += 1
+        self.active_by_model[model] += 1
+        self.active_by_session[session] += 1
+        self.granted += 1
+
+    def check_capacity(self, count: int):
+        """Reject a whole comparison up front instead of failing it half-way"""
+        free = max(0, self.global_limit - self.active)
+        would_wait = max(0, count - free)
+        if self._waiting + would_wait > self.max_queue:
+            self.rejected += 1
+            raise QueueFullError(self._waiting + would_wait, self.max_queue)
+
+    async def acquire(self, session, model: str, session_limit=None, on_queued=None) -> float:
+        """Wait for a slot and return the seconds spent queued"""
+        if self._waiting == 0 and self._can_run(session, model, session_limit):
+            self._grant(session, model)
+            return 0.0
+
+        if self._waiting >= self.max_queue:
+            self.rejected += 1
+            raise QueueFullError(self._waiting + 1, self.max_queue)
+
+        waiter = _Waiter(model, session_limit, asyncio.get_running_loop().create_future())
+        self._queues.setdefault(session, deque()).append(waiter)
+        self._waiting += 1
+        self._dispatch()
+
+        started = time.monotonic()
+        try:
+            if not waiter.future.done() and on_queued is not None:
+                await on_queued(self.position(session, waiter))
+            await waiter.future
+        except BaseException:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # Granted and cancelled in the same tick - give the slot back
+                self.release(session, model)
+            else:
+                waiter.future.cancel()
+                self._remove(session, waiter)
+            raise
+        waited = time.monotonic() - started
+        self.total_wait += waited
+        return waited
+
+    def position(self, session, waiter) -> int:
+        """1-based place of a waiter in round-robin dispatch order, ignoring per-model limits
+
+        Every session's first waiter goes before any session's second one, and
+        within a round sessions go in rotation order.
+        """
+        queue = self._queues.get(session)
+        if queue is None or waiter not in queue:
+            return 0
+        index = queue.index(waiter)
+        position = 1 + index
+        before = True
+        for other, waiters in self._queues.items():
+            if other == session:
+                before = False
+                continue
+            # Sessions ahead in the rotation also go first in this waiter's own round
+            position += min(len(waiters), index + before)
+        return position
+
+    def _remove(self, session, waiter):
+        queue = self._queues.get(session)
+        if queue is None or waiter not in queue:
+            return
+        queue.remove(waiter)
+        self._waiting -= 1
+        if not queue:
+            del self._queues[session]
+        # A blocked head may have been holding back runnable waiters
+        self._dispatch()
+
+    def release(self, session, model: str):
+        self.active -= 1
+        self.active_by_model[model] -= 1
+        if self.active_by_model[model] <= 0:
+            del self.active_by_model[model]
+        self.active_by_session[session] -= 1
+        if self.active_by_session[session] <= 0:
+            del self.active_by_session[session]
+        self._dispatch()
+
+    def _dispatch(self):
+        """Hand free slots to waiting sessions in round-robin order"""
+        while self._queues and self.active < self.global_limit:
+            granted = False
+            for session in list(self._queues):
+                queue = self._queues[session]
+                for waiter in queue:
+                    if waiter.future.done():
+                        # Cancelled; its own task removes it from the queue
+                        continue
+                    if self._can_run(session, waiter.model, waiter.session_limit):
+                        queue.remove(waiter)
+                        self._waiting -= 1
+                        self._grant(session, waiter.model)
+                        waiter.future.set_result(None)
+                        granted = True
+                        break
+                if granted:
+                    if queue:
+                        self._queues.move_to_end(session)
+                    else:
+                        del self._queues[session]
+                    break
+            if not granted:
+                return
+
+    @asynccontextmanager
+    async def slot(self, session, model: str, session_limit=None, on_queued=None):
+        waited = await self.acquire(session, model, session_limit, on_queued)
+        try:
+            yield waited
+        finally:
+            self.release(session, model)
+
+    def stats(self) -> dict:
+        return {
+            "global_limit": self.global_limit,
+            "per_model_limit": self.per_model_limit,
+            "max_queue": self.max_queue,
+            "active": self.active,
+            "active_by_model": dict(self.active_by_model),
+            "queued": self._waiting,
+            "queued_sessions": len(self._queues),
+            "granted": self.granted,
+            "rejected": self.rejected,
+            "total_wait_seconds": round(self.total_wait, 3),
+        }
+
+
+scheduler = FairScheduler()
@@ -0,0 +1,187 @@
+import asyncio
+import os
+import re
+
+import numpy as np
+
+from logger import log
+from ollama_client import ollama_pool
+
+# "tfidf" hashes words into fixed-size vectors; "embeddings" asks Ollama for
+# SCORING_EMBED_MODEL vectors and falls back to TF-IDF when that fails
+SCORING_BACKEND = os.environ.get("SCORING_BACKEND", "tfidf")
+SCORING_EMBED_MODEL = os.environ.get("SCORING_EMBED_MODEL", "nomic-embed-text")
+SCORING_HASH_BITS = int(os.environ.get("SCORING_HASH_BITS", "14"))
+
+# Weights of the combined score
+CONSENSUS_WEIGHT = 0.5
+LENGTH_FIT_WEIGHT = 0.3
+ORIGINALITY_WEIGHT = 0.2
+
+# Expected answer size in words for each response length setting
+LENGTH_TARGETS = {
+    "brief": (10, 60),
+    "short": (40, 130),
+    "medium": (90, 320),
+    "long": (220, 550),
+    "detailed": (380, 1100),
+}
+WORDS_PER_LINE = 12
+
+_WORD = re.compile(r"[a-z0-9]+(?:'[a-z]+)?")
+
+
+def length_range(response_length: str, custom_length="10"):
+    if response_length == "custom":
+        try:
+            lines = max(1, int(custom_length))
+        except (TypeError, ValueError):
+            lines = 10
+        return lines * WORDS_PER_LINE * 0.6, lines * WORDS_PER_LINE * 1.5
+    return LENGTH_TARGETS.get(response_length, LENGTH_TARGETS["medium"])
+
+
+class ResponseScorer:
+    """Scores one session's responses against each other as they complete
+
+    Each response is tokenized and hashed once, when it arrives. Adding one
+    re-weights the cached term rows with the new IDF and takes one matrix
+    product for all pairwise cosine similarities.
+    """
+
+    def __init__(self, response_length: str = "medium", custom_length="10",
+                 backend: str = SCORING_BACKEND, hash_bits: int = SCORING_HASH_BITS):
+        self.backend = backend
+        self.dimensions = 1 << hash_bits
+        self.low, self.high = length_range(response_length, custom_length)
+        self.models = []
+        self._tf = np.zeros((0, self.dimensions), dtype=np.float32)
+        self._df = np.zeros(self.dimensions, dtype=np.float32)
+        self._embeddings = []
+        self._words = []
+        self._redundancy = []
+        self._similarity = np.zeros((0, 0), dtype=np.float32)
+        self._lock = asyncio.Lock()
+
+    def _hash_terms(self, tokens):
+        return np.fromiter((hash(t) for t in tokens), dtype=np.int64, count=len(tokens)) & (self.dimensions - 1)
+
+    def _analyze(self, text: str):
+        tokens = _WORD.findall(text.lower())
+        counts = np.bincount(self._hash_terms(tokens), minlength=self.dimensions).astype(np.float32) if tokens \
+            else np.zeros(self.dimensions, dtype=np.float32)
+        # Sublinear term frequency so one repeated word can't dominate
+        np.log1p(counts, out=counts, where=counts > 0)
+        trigrams = [" ".join(tokens[i:i + 3]) for i in range(len(tokens) - 2)]
+        redundancy = 1.0 - len(set(trigrams)) / len(trigrams) if trigrams else 0.0
+        return counts, len(tokens), redundancy
+
+    async def _embed(self, text: str):
+        try:
+            response = await ollama_pool.request(
+                SCORING_EMBED_MODEL, "POST", "/api/embeddings", json={"model": SCORING_EMBED_MODEL, "prompt": text},
+                timeout=ollama_pool.timeout(read=30.0)
+            )
+            if response.status_code == 200:
+                vector = np.asarray(response.json().get("embedding") or [], dtype=np.float32)
+                norm = float(np.linalg.norm(vector))
+                if norm:
+                    return vector / norm
+        except Exception as e:
+            log.warning("scoring_embedding_failed", model=SCORING_EMBED_MODEL, error=str(e))
+        # One failure switches the session to TF-IDF so vectors stay comparable
+        self.backend = "tfidf"
+        return None
+
+    async def add(self, model: str, text: str) -> list:
+        """Add a completed response and return the updated scores"""
+        # Embedding requests yield to the loop; keep rows and vectors in step
+        async with self._lock:
+            return await self._add(model, text)
+
+    async def _add(self, model: str, text: str) -> list:
+        counts, words, redundancy = self._analyze(text)
+        self.models.append(model)
+        self._tf = np.vstack([self._tf, counts])
+        self._df += counts > 0
+        self._words.append(words)
+        self._redundancy.append(redundancy)
+
+        if self.backend == "embeddings":
+            vector = await self._embed(text)
+            if vector is not None and (not self._embeddings or vector.shape == self._embeddings[0].shape):
+                self._embeddings.append(vector)
+                # Embeddings don't change when others arrive: only the new row/column is computed
+                row = np.array([float(vector @ other) for other in self._embeddings], dtype=np.float32)
+                n = len(self._embeddings)
+                grown = np.zeros((n, n), dtype=np.float32)
+                grown[:n - 1, :n - 1] = self._similarity
+                grown[n - 1, :] = row
+                grown[:, n - 1] = row
+                self._similarity = grown
+                return self.scores()
+            self.backend = "tfidf"
+        self._similarity = self._tfidf_similarity()
+        return self.scores()
+
+    def _tfidf_similarity(self):
+        n = len(self.models)
+        idf = np.log((1.0 + n) / (1.0 + self._df)) + 1.0
+        weighted = self._tf * idf
+        norms = np.linalg.norm(weighted, axis=1, keepdims=True)
+        weighted /= np.where(norms > 0, norms, 1.0)
+        return weighted @ weighted.T
+
+    def scores(self) -> list:
+        n = len(self.models)
+        if n == 0:
+            return []
+        similarity = self._similarity
+        if n > 1:
+            off_diagonal = similarity.sum(axis=1) - np.diag(similarity)
+            consensus = off_diagonal / (n - 1)
+            masked = similarity - np.eye(n, dtype=np.float32) * 2
+            max_similarity = masked.max(axis=1)
+        else:
+            # Nothing to agree with yet
+            consensus = np.full(1, 0.5, dtype=np.float32)
+            max_similarity = np.zeros(1, dtype=np.float32)
+
+        words = np.asarray(self._words, dtype=np.float32)
+        nearest = np.clip(words, self.low, self.high)
+        # 1 inside the expected range, falling off with the log-ratio outside it
+        length_fit = np.exp(-np.abs(np.log(np.maximum(words, 1.0) / nearest)))
+        redundancy = np.asarray(self._redundancy, dtype=np.float32)
+        total = CONSENSUS_WEIGHT * consensus + LENGTH_FIT_WEIGHT * length_fit + ORIGINALITY_WEIGHT * (1.0 - redundancy)
+
+        return [
+            {
+                "model": model,
+                "score": round(float(total[i]), 4),
+                "consensus": round(float(consensus[i]), 4),
+                "lengthFit": round(float(length_fit[i]), 4),
+                "redundancy": round(float(redundancy[i]), 4),
+                "maxSimilarity": round(float(max_similarity[i]), 4),
+                "words": int(words[i]),
+            }
+            for i, model in enumerate(self.models)
+        ]
+
+    def agreement(self, threshold: float) -> list:
+        """The largest group of responses that agree with one of them, that one first"""
+        n = len(self.models)
+        if n == 0:
+            return []
+        agrees = self._similarity >= threshold
+        np.fill_diagonal(agrees, True)
+        center = int(agrees.sum(axis=1).argmax())
+        others = [self.models[j] for j in np.flatnonzero(agrees[center]) if j != center]
+        return [self.models[center]] + others
+
+    def best(self):
+        scores = self.scores()
+        return max(scores, key=lambda s: s["score"])["model"] if scores else None
+
+
+def rank(scores: list) -> list:
+    return sorted(scores, key=lambda s: s["score"], reverse=True)
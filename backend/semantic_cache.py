@@ -0,0 +1,379 @@
+import asyncio
+import collections
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+import numpy as np
+
+from logger import log
+from ollama_client import ollama_pool
+from scoring import SCORING_EMBED_MODEL
+
+# Rephrased questions ("what is RAG" / "explain RAG") share answers through the
+# response cache; off by default because it needs an embedding model in Ollama
+SEMANTIC_CACHE_ENABLED = os.environ.get("SEMANTIC_CACHE_ENABLED", "0") == "1"
+# "serve" replays a similar question's cached answers; "offer" only tells the client about them
+SEMANTIC_CACHE_MODE = os.environ.get("SEMANTIC_CACHE_MODE", "serve")
+SEMANTIC_CACHE_MODEL = os.environ.get("SEMANTIC_CACHE_MODEL", SCORING_EMBED_MODEL)
+# Cosine similarity between question embeddings that counts as the same question
+SEMANTIC_CACHE_THRESHOLD = float(os.environ.get("SEMANTIC_CACHE_THRESHOLD", "0.9"))
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.environ.get("SEMANTIC_CACHE_MAX_ENTRIES", "100000"))
+SEMANTIC_CACHE_TTL = float(os.environ.get("SEMANTIC_CACHE_TTL", "604800"))
+# Directory for the memory-mapped index; empty keeps it in memory only
+SEMANTIC_CACHE_DIR = os.environ.get("SEMANTIC_CACHE_DIR", os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "semantic_cache"))
+# A question that can't be embedded this fast is treated as a miss
+SEMANTIC_CACHE_EMBED_TIMEOUT = float(os.environ.get("SEMANTIC_CACHE_EMBED_TIMEOUT", "2"))
+
+HASH_BITS = 256
+# Rows with the closest sign hashes, re-ranked by exact cosine
+CANDIDATES = 128
+INDEX_VERSION = 1
+_NO_MATCH = np.iinfo(np.uint16).max
+
+if hasattr(np, "bitwise_count"):
+    _popcount = np.bitwise_count
+else:
+    # NumPy < 2: SWAR bit count, in place on the XOR result
+    _M1, _M2, _M4, _H01 = (np.uint64(mask) for mask in (
+        0x5555555555555555, 0x3333333333333333, 0x0F0F0F0F0F0F0F0F, 0x0101010101010101))
+
+    def _popcount(words):
+        shifted = words >> np.uint64(1)
+        shifted &= _M1
+        words -= shifted
+        shifted = words >> np.uint64(2)
+        shifted &= _M2
+        words &= _M2
+        words += shifted
+        words += words >> np.uint64(4)
+        words &= _M4
+        words *= _H01
+        words >>= np.uint64(56)
+        return words
+
+
+def _unit(values) -> np.ndarray:
+    vector = np.asarray(values, dtype=np.float32)
+    norm = float(np.linalg.norm(vector))
+    return vector / norm if norm else None
+
+
+class VectorIndex:
+    """Fixed number of unit vectors, searched by a sign-hash prefilter and exact cosine
+
+    Every row keeps its vector (float16), a 256-bit sign hash of it (one bit
+    per random hyperplane), when it was added and a group ID. A search
+    takes the Hamming distance to every live row of the group (XOR and
+    popcount over four words a row) and only compares the closest
+    CANDIDATES by cosine, so it reads about 40 bytes per row rather than
+    the whole vector. New rows overwrite the oldest one, which keeps the
+    size fixed and evicts by age. With a directory, the arrays are
+    memory-mapped files that survive restarts.
+    """
+
+    def __init__(self, dimensions: int, capacity: int, directory: str = None, seed: int = 0):
+        self.dimensions = dimensions
+        self.capacity = capacity
+        self.directory = directory
+        words = HASH_BITS // 64
+        self._planes = np.random.default_rng(seed).standard_normal((dimensions, HASH_BITS)).astype(np.float32)
+        if directory:
+            self.vectors = self._array("vectors.f16", np.float16, (capacity, dimensions))
+            self.codes = self._array("codes.u64", np.uint64, (words, capacity))
+            self.created = self._array("created.f64", np.float64, (capacity,))
+            self.groups = self._array("groups.u32", np.uint32, (capacity,))
+        else:
+            self.vectors = np.zeros((capacity, dimensions), dtype=np.float16)
+            self.codes = np.zeros((words, capacity), dtype=np.uint64)
+            self.created = np.zeros(capacity, dtype=np.float64)
+            self.groups = np.zeros(capacity, dtype=np.uint32)
+        used = np.flatnonzero(self.created)
+        # Rows fill in order, then the oldest is replaced
+        self.filled = int(used[-1]) + 1 if len(used) else 0
+        self._lock = threading.Lock()
+
+    def _array(self, name: str, dtype, shape):
+        path = os.path.join(self.directory, name)
+        return np.memmap(path, dtype=dtype, mode="r+" if os.path.exists(path) else "w+", shape=shape)
+
+    def _hash(self, vector: np.ndarray) -> np.ndarray:
+        return np.packbits(vector @ self._planes > 0).view(np.uint64)
+
+    def add(self, vector: np.ndarray, group: int, created: float) -> int:
+        """Store vector and return its row"""
+        code = self._hash(vector)
+        with self._lock:
+            if self.filled < self.capacity:
+                row = self.filled
+                self.filled += 1
+            else:
+                row = int(np.argmin(self.created))
+            self.vectors[row] = vector
+            self.codes[:, row] = code
+            self.created[row] = created
+            self.groups[row] = group
+        return row
+
+    def search(self, vector: np.ndarray, group: int, added_after: float = 0.0):
+        """(row, similarity) of the closest live vector in group, or None"""
+        code = self._hash(vector)
+        with self._lock:
+            count = self.filled
+            if count == 0:
+                return None
+            distance = _popcount(self.codes[0, :count] ^ code[0]).astype(np.uint16)
+            for word in range(1, len(code)):
+                distance += _popcount(self.codes[word, :count] ^ code[word])
+            np.putmask(distance, (self.groups[:count] != group) | (self.created[:count] <= added_after), _NO_MATCH)
+            if count > CANDIDATES:
+                candidates = np.argpartition(distance, CANDIDATES - 1)[:CANDIDATES]
+            else:
+                candidates = np.arange(count)
+            candidates = candidates[distance[candidates] != _NO_MATCH]
+            if not len(candidates):
+                return None
+            similarities = self.vectors[candidates].astype(np.float32) @ vector
+        best = int(np.argmax(similarities))
+        return int(candidates[best]), float(similarities[best])
+
+    def live(self, added_after: float = 0.0) -> int:
+        return int(np.count_nonzero(self.created[:self.filled] > added_after))
+
+    def clear(self):
+        with self._lock:
+            self.created[:] = 0
+            self.filled = 0
+
+    def flush(self):
+        if self.directory:
+            for array in (self.vectors, self.codes, self.created, self.groups):
+                array.flush()
+
+
+class SemanticMatch:
+    __slots__ = ("question", "similarity", "prompt")
+
+    def __init__(self, question: str, similarity: float):
+        self.question = question
+        self.similarity = similarity
+        self.prompt = None  # the matched question's prompt, to look up its cached answers
+
+    def report(self) -> dict:
+        return {"question": self.question, "similarity": round(self.similarity, 3)}
+
+
+class SemanticLookup:
+    """A question's embedding and what it matched, kept to index it afterwards"""
+
+    __slots__ = ("vector", "group", "match")
+
+    def __init__(self, vector: np.ndarray, group: int, match: SemanticMatch = None):
+        self.vector = vector
+        self.group = group
+        self.match = match
+
+
+class SemanticCache:
+    """Questions by embedding, so a rephrasing finds the answers to the original
+
+    Only questions are indexed. Their answers stay in the response cache,
+    under the original question's prompt, and a match is served by
+    replaying those, so an answer the response cache has dropped is a miss
+    here too.
+    """
+
+    def __init__(self, enabled: bool = SEMANTIC_CACHE_ENABLED, mode: str = SEMANTIC_CACHE_MODE,
+                 model: str = SEMANTIC_CACHE_MODEL, threshold: float = SEMANTIC_CACHE_THRESHOLD,
+                 max_entries: int = SEMANTIC_CACHE_MAX_ENTRIES, ttl: float = SEMANTIC_CACHE_TTL,
+                 directory: str = SEMANTIC_CACHE_DIR):
+        self.enabled = enabled
+        self.mode = mode if mode in ("serve", "offer") else "serve"
+        self.model = model
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.directory = directory
+        self._index = None
+        self._questions = {}  # row -> question
+        self._db = None
+        self._db_lock = threading.Lock()
+        self.lookups = 0
+        self.matches = 0
+        self.served = 0
+        self.offered = 0
+        self.added = 0
+        self.embed_errors = 0
+        self.last_error = None
+        self._search_ms = collections.deque(maxlen=1000)
+        self._embed_ms = collections.deque(maxlen=1000)
+
+    async def start(self):
+        if self.enabled and self.directory:
+            await asyncio.to_thread(self._load)
+
+    def _open_db(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self._db = sqlite3.connect(os.path.join(self.directory, "questions.db"), check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS questions (row INTEGER PRIMARY KEY, question TEXT NOT NULL)")
+        self._db.commit()
+
+    def _load(self):
+        """Reopen the index written by an earlier run, unless its settings changed"""
+        self._open_db()
+        header = self._read_header()
+        if header is None:
+            return
+        if header != self._header(header["dimensions"]):
+            log.warning("semantic_cache_reset", reason="index settings changed", previous=header)
+            self._reset_files()
+            return
+        self._index = VectorIndex(header["dimensions"], self.max_entries, self.directory)
+        self._questions = dict(self._db.execute("SELECT row, question FROM questions"))
+        log.info("semantic_cache_loaded", entries=self._index.live(self._cutoff()), path=self.directory)
+
+    def _header(self, dimensions: int) -> dict:
+        return {"version": INDEX_VERSION, "model": self.model, "dimensions": dimensions,
+                "capacity": self.max_entries, "bits": HASH_BITS}
+
+    def _read_header(self):
+        try:
+            with open(os.path.join(self.directory, "index.json")) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _reset_files(self):
+        for name in ("index.json", "vectors.f16", "codes.u64", "created.f64", "groups.u32"):
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+        with self._db_lock:
+            self._db.execute("DELETE FROM questions")
+            self._db.commit()
+
+    def _create_index(self, dimensions: int) -> VectorIndex:
+        directory = self.directory or None
+        if directory:
+            if self._db is None:
+                self._open_db()
+            self._reset_files()
+            index = VectorIndex(dimensions, self.max_entries, directory)
+            with open(os.path.join(directory, "index.json"), "w") as f:
+                json.dump(self._header(dimensions), f)
+            return index
+        return VectorIndex(dimensions, self.max_entries)
+
+    def group(self, response_length: str, custom_length="10") -> int:
+        """Questions only match others asked with the same length setting"""
+        setting = f"{response_length}:{custom_length}" if response_length == "custom" else response_length
+        return zlib.crc32(f"{self.model}|{setting}".encode("utf-8"))
+
+    def _cutoff(self) -> float:
+        return time.time() - self.ttl if self.ttl > 0 else 0.0
+
+    async def _embed(self, question: str):
+        started = time.perf_counter()
+        try:
+            response = await asyncio.wait_for(ollama_pool.request(
+                self.model, "POST", "/api/embeddings", json={"model": self.model, "prompt": question},
+                timeout=ollama_pool.timeout(read=SEMANTIC_CACHE_EMBED_TIMEOUT)
+            ), SEMANTIC_CACHE_EMBED_TIMEOUT)
+            if response.status_code != 200:
+                raise Exception(f"HTTP {response.status_code}")
+            vector = _unit(response.json().get("embedding") or [])
+            if vector is None:
+                raise Exception("empty embedding")
+        except Exception as e:
+            error = str(e) or type(e).__name__
+            self.embed_errors += 1
+            if error != self.last_error:
+                # Once per distinct error, not once per question
+                log.warning("semantic_cache_embed_failed", model=self.model, error=error)
+            self.last_error = error
+            return None
+        self.last_error = None
+        self._embed_ms.append((time.perf_counter() - started) * 1000)
+        return vector
+
+    async def lookup(self, question: str, group: int):
+        """Embed question and find the closest earlier one; None if it can't be embedded"""
+        vector = await self._embed(question)
+        if vector is None:
+            return None
+        self.lookups += 1
+        lookup = SemanticLookup(vector, group)
+        index = self._index
+        if index is None or index.dimensions != len(vector):
+            return lookup
+        started = time.perf_counter()
+        found = await asyncio.to_thread(index.search, vector, group, self._cutoff())
+        self._search_ms.append((time.perf_counter() - started) * 1000)
+        if found is not None and found[1] >= self.threshold and found[0] in self._questions:
+            self.matches += 1
+            lookup.match = SemanticMatch(self._questions[found[0]], found[1])
+        return lookup
+
+    async def add(self, lookup: SemanticLookup, question: str):
+        """Index a question whose answers just went into the response cache"""
+        if self._index is None or self._index.dimensions != len(lookup.vector):
+            self._index = await asyncio.to_thread(self._create_index, len(lookup.vector))
+            self._questions = {}
+        row = await asyncio.to_thread(self._index.add, lookup.vector, lookup.group, time.time())
+        self._questions[row] = question
+        self.added += 1
+        if self._db is not None:
+            await asyncio.to_thread(self._store_question, row, question)
+
+    def _store_question(self, row: int, question: str):
+        with self._db_lock:
+            self._db.execute("INSERT OR REPLACE INTO questions (row, question) VALUES (?, ?)", (row, question))
+            self._db.commit()
+
+    async def clear(self):
+        if self._index is not None:
+            await asyncio.to_thread(self._index.clear)
+        self._questions = {}
+        if self._db is not None:
+            with self._db_lock:
+                self._db.execute("DELETE FROM questions")
+                self._db.commit()
+
+    def close(self):
+        if self._index is not None:
+            self._index.flush()
+        if self._db is not None:
+            with self._db_lock:
+                self._db.close()
+            self._db = None
+
+    def stats(self) -> dict:
+        search = np.fromiter(self._search_ms, dtype=np.float64, count=len(self._search_ms))
+        embed = np.fromiter(self._embed_ms, dtype=np.float64, count=len(self._embed_ms))
+        return {
+            "enabled": self.enabled,
+            "mode": self.mode,
+            "model": self.model,
+            "threshold": self.threshold,
+            "entries": self._index.live(self._cutoff()) if self._index is not None else 0,
+            "max_entries": self.max_entries,
+            "ttl": self.ttl,
+            "path": self.directory or None,
+            "lookups": self.lookups,
+            "matches": self.matches,
+            "served": self.served,
+            "offered": self.offered,
+            "added": self.added,
+            "embed_errors": self.embed_errors,
+            "last_error": self.last_error,
+            "search_ms_p50": round(float(np.percentile(search, 50)), 3) if len(search) else None,
+            "search_ms_p95": round(float(np.percentile(search, 95)), 3) if len(search) else None,
+            "embed_ms_p50": round(float(np.percentile(embed, 50)), 1) if len(embed) else None,
+        }
+
+
+semantic_cache = SemanticCache()
@@ -0,0 +1,127 @@
+import asyncio
+import time
+
+from tracing import NULL_SPAN
+
+
+class GenerationProgress:
+    """Live counters for one model's generation, read when it gets cancelled"""
+
+    # Running average across finished generations, used to price cancelled
+    # work that never produced a token
+    average_tokens_per_second = 0.0
+
+    def __init__(self, num_predict: int = 0):
+        self.num_predict = num_predict
+        self.started_at = time.monotonic()
+        self.first_token_at = None
+        self.tokens = 0
+        self.finished = False
+        self.load_seconds = None  # Ollama's load_duration, when this run loaded the model
+        self.queue_wait = None  # seconds spent waiting for a scheduler slot
+        self.stats = None  # timings sent with the completed frame
+        self.cached = False
+        self.span = NULL_SPAN  # this generation's trace span
+
+    def token(self):
+        if self.first_token_at is None:
+            self.first_token_at = time.monotonic()
+        self.tokens += 1
+
+    def finish(self):
+        self.finished = True
+        rate = self.tokens_per_second()
+        if rate:
+            previous = GenerationProgress.average_tokens_per_second
+            GenerationProgress.average_tokens_per_second = rate if not previous else 0.8 * previous + 0.2 * rate
+
+    def tokens_per_second(self):
+        if self.first_token_at is None or self.tokens < 2:
+            return None
+        elapsed = time.monotonic() - self.first_token_at
+        return self.tokens / elapsed if elapsed > 0 else None
+
+    def savings(self) -> dict:
+        """Estimated tokens/seconds not generated because the run stopped early"""
+        tokens_saved = max(0, self.num_predict - self.tokens)
+        rate = self.tokens_per_second() or GenerationProgress.average_tokens_per_second
+        return {
+            "tokensGenerated": self.tokens,
+            "tokensSaved": tokens_saved,
+            "secondsSaved": round(tokens_saved / rate, 2) if rate else None,
+            "secondsElapsed": round(time.monotonic() - self.started_at, 2),
+        }
+
+
+class ModelRun:
+    __slots__ = ("model", "task", "progress")
+
+    def __init__(self, model: str, progress: GenerationProgress):
+        self.model = model
+        self.task = None
+        self.progress = progress
+
+
+class SessionRun:
+    """Every model task started for one question on one socket"""
+
+    def __init__(self, session_id: str):
+        self.session_id = session_id
+        self.task = None
+        self.models = {}
+        self.cancelled = False
+        self.span = NULL_SPAN  # the question's trace span; each model's is a child
+
+    def add_model(self, model: str) -> ModelRun:
+        run = ModelRun(model, GenerationProgress())
+        run.progress.span = self.span.child("model", model=model)
+        self.models[model] = run
+        return run
+
+    async def cancel(self, model: str = None) -> list:
+        """Cancel one model or the whole session and report what it saved"""
+        if model is None:
+            self.cancelled = True
+            targets = list(self.models.values())
+        else:
+            targets = [self.models[model]] if model in self.models else []
+        targets = [run for run in targets if run.task is not None and not run.task.done()]
+
+        for run in targets:
+            run.task.cancel()
+        # Wait so the upstream httpx streams are really closed before reporting
+        await asyncio.gather(*(run.task for run in targets), return_exceptions=True)
+
+        reports = []
+        for run in targets:
+            report = {"model": run.model, **run.progress.savings()}
+            cancel_stats.record(report)
+            reports.append(report)
+        return reports
+
+
+class CancelStats:
+    def __init__(self):
+        self.cancelled_generations = 0
+        self.cancelled_sessions = 0
+        self.preempted_sessions = 0
+        self.tokens_saved = 0
+        self.seconds_saved = 0.0
+
+    def record(self, report: dict):
+        self.cancelled_generations += 1
+        self.tokens_saved += report["tokensSaved"]
+        self.seconds_saved += report["secondsSaved"] or 0.0
+
+    def stats(self) -> dict:
+        return {
+            "cancelled_generations": self.cancelled_generations,
+            "cancelled_sessions": self.cancelled_sessions,
+            "preempted_sessions": self.preempted_sessions,
+            "tokens_saved": self.tokens_saved,
+            "seconds_saved": round(self.seconds_saved, 2),
+            "average_tokens_per_second": round(GenerationProgress.average_tokens_per_second, 2),
+        }
+
+
+cancel_stats = CancelStats()
@@ -0,0 +1,105 @@
+import asyncio
+import os
+
+SINGLE_FLIGHT_ENABLED = os.environ.get("SINGLE_FLIGHT_ENABLED", "1") == "1"
+
+
+class Flight:
+    """One upstream generation fanned out to every identical request"""
+
+    def __init__(self, key: str, source, on_finish):
+        self.key = key
+        self.events = []
+        self.done = False
+        self.error = None
+        self.subscribers = 0
+        self.cancelling = False
+        self._changed = asyncio.Event()
+        self._on_finish = on_finish
+        self._task = asyncio.create_task(self._run(source))
+
+    def _notify(self):
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def _run(self, source):
+        try:
+            async for event in source:
+                self.events.append(event)
+                self._notify()
+        except asyncio.CancelledError:
+            self.error = asyncio.CancelledError()
+        except Exception as e:
+            self.error = e
+        finally:
+            # Closing the source closes the upstream httpx stream, which is
+            # what makes Ollama abort the generation
+            await source.aclose()
+            self.done = True
+            self._on_finish(self)
+            self._notify()
+
+    async def subscribe(self):
+        """Yield every event so far, then the live tail"""
+        self.subscribers += 1
+        index = 0
+        try:
+            while True:
+                while index < len(self.events):
+                    yield self.events[index]
+                    index += 1
+                if self.done:
+                    if isinstance(self.error, asyncio.CancelledError):
+                        raise Exception("Upstream generation was cancelled")
+                    if self.error is not None:
+                        raise self.error
+                    return
+                await self._changed.wait()
+        finally:
+            self.subscribers -= 1
+            if self.subscribers == 0 and not self.done:
+                # Last listener went away - stop burning GPU on it
+                self.cancelling = True
+                self._task.cancel()
+
+
+class SingleFlight:
+    """Coalesces identical (model, prompt, options) generations that are already running"""
+
+    def __init__(self, enabled: bool = SINGLE_FLIGHT_ENABLED):
+        self.enabled = enabled
+        self._flights = {}
+        self.started = 0
+        self.joined = 0
+        self.cancelled = 0
+
+    def join(self, key: str, source_factory):
+        """Return (flight, is_leader); the leader's factory starts the upstream call"""
+        flight = self._flights.get(key) if self.enabled else None
+        if flight is not None and not flight.done and not flight.cancelling:
+            self.joined += 1
+            return flight, False
+        flight = Flight(key, source_factory(), self._finished)
+        if self.enabled:
+            self._flights[key] = flight
+        self.started += 1
+        return flight, True
+
+    def _finished(self, flight: Flight):
+        if isinstance(flight.error, asyncio.CancelledError):
+            self.cancelled += 1
+        if self._flights.get(flight.key) is flight:
+            del self._flights[flight.key]
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "in_flight": len(self._flights),
+            "subscribers": sum(f.subscribers for f in self._flights.values()),
+            "started": self.started,
+            "joined": self.joined,
+            "cancelled": self.cancelled,
+        }
+
+
+single_flight = SingleFlight()
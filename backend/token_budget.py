@@ -0,0 +1,214 @@
+import collections
+import os
+import re
+
+import numpy as np
+
+from scoring import length_range
+
+# num_predict per response length, learned from the tokens each model actually
+# used for that setting (Ollama's eval_count): a quantile of its recent
+# generations, or the setting's target length if that is more, times headroom.
+# TOKEN_BUDGET_ADAPTIVE=0 keeps the fixed table.
+TOKEN_BUDGET_ADAPTIVE = os.environ.get("TOKEN_BUDGET_ADAPTIVE", "1") == "1"
+TOKEN_BUDGET_WINDOW = int(os.environ.get("TOKEN_BUDGET_WINDOW", "200"))
+TOKEN_BUDGET_MIN_SAMPLES = int(os.environ.get("TOKEN_BUDGET_MIN_SAMPLES", "10"))
+TOKEN_BUDGET_QUANTILE = float(os.environ.get("TOKEN_BUDGET_QUANTILE", "95"))
+TOKEN_BUDGET_HEADROOM = float(os.environ.get("TOKEN_BUDGET_HEADROOM", "1.3"))
+TOKEN_BUDGET_MAX = int(os.environ.get("TOKEN_BUDGET_MAX", "2000"))
+# Stop reading once an answer is past its setting's length range and ends a sentence
+TOKEN_BUDGET_STOP_HINT = os.environ.get("TOKEN_BUDGET_STOP_HINT", "1") == "1"
+
+# Fixed num_predict per response length, for TOKEN_BUDGET_ADAPTIVE=0
+TOKEN_LIMITS = {
+    "brief": 100,
+    "short": 200,
+    "medium": 500,
+    "long": 800,
+    "detailed": 1200,
+    "custom": 600,
+}
+# Rough ratio for English text in the usual tokenizers
+TOKENS_PER_WORD = 1.3
+
+_WORD_START = re.compile(r"\s\S")
+_SENTENCE_END = re.compile(r"[.!?:][\"')\]*]*\s*$|\n")
+
+
+def _lines(custom_length) -> int:
+    try:
+        return max(1, int(custom_length))
+    except (TypeError, ValueError):
+        return 10
+
+
+def target_tokens(response_length: str, custom_length="10") -> int:
+    """Tokens at the top of the setting's length range, the one scoring accepts"""
+    return int(length_range(response_length, custom_length)[1] * TOKENS_PER_WORD)
+
+
+class StopHint:
+    """Says when a streamed answer has reached its requested length
+
+    Words are counted as whitespace-to-text transitions across chunks, so a
+    word split over two tokens counts once.
+    """
+
+    def __init__(self, max_words: float):
+        self.max_words = max_words
+        self.words = 0
+        self._last = " "
+
+    def push(self, content: str) -> bool:
+        """Count a chunk; True once past max_words at the end of a sentence or line"""
+        if not content:
+            return False
+        self.words += len(_WORD_START.findall(self._last + content))
+        self._last = content[-1]
+        return self.words >= self.max_words and _SENTENCE_END.search(content) is not None
+
+
+class _Usage:
+    """Fixed- or adaptive-budget totals, so the two can be compared"""
+
+    def __init__(self):
+        self.generations = 0
+        self.tokens = 0
+        self.wasted = 0  # tokens past the setting's target length
+        self.truncated = 0  # ended by num_predict, usually mid-sentence
+        self.stopped = 0  # ended by the stop hint
+        self.lower_bounds = 0  # simulated answers whose real length isn't known
+
+    def add(self, tokens: int, target: int, truncated: bool, stopped: bool):
+        self.generations += 1
+        self.tokens += tokens
+        self.wasted += max(0, tokens - target)
+        self.truncated += truncated
+        self.stopped += stopped
+
+    def report(self) -> dict:
+        return {
+            "generations": self.generations,
+            "tokens": self.tokens,
+            "wastedTokens": self.wasted,
+            "wastedRate": round(self.wasted / self.tokens, 3) if self.tokens else None,
+            "truncated": self.truncated,
+            "truncatedRate": round(self.truncated / self.generations, 3) if self.generations else None,
+            "stoppedAtTarget": self.stopped,
+            "lowerBounds": self.lower_bounds,
+        }
+
+
+def _other_budget(tokens: int, truncated: bool, other: int):
+    """(tokens, truncated, exact) for the same answer generated under the other num_predict
+
+    The text is the same up to where either budget ends it. Only an answer
+    cut off by its own budget, given a larger one, has an unknown length;
+    what it had used so far is a lower bound.
+    """
+    if other <= tokens:
+        return other, True, True
+    return tokens, False, not truncated
+
+
+class TokenBudgets:
+    """Per (model, length setting) distribution of tokens used, and the budgets it gives
+
+    "custom" answers are learned per requested line, so every line count
+    shares one distribution. A generation cut off by num_predict is recorded
+    at that limit; enough of them push the quantile, and with it the budget,
+    up by the headroom factor. One ended by the stop hint only says the model
+    would have gone on, not for how long, so it counts towards usage but not
+    the distribution.
+    """
+
+    def __init__(self, adaptive: bool = TOKEN_BUDGET_ADAPTIVE, window: int = TOKEN_BUDGET_WINDOW,
+                 min_samples: int = TOKEN_BUDGET_MIN_SAMPLES, stop_hint: bool = TOKEN_BUDGET_STOP_HINT):
+        self.adaptive = adaptive
+        self.window = window
+        self.min_samples = min_samples
+        self.stop_hint = stop_hint
+        self._samples = {}  # (model, setting) -> deque of tokens (per line for custom)
+        self._usage = {"fixed": _Usage(), "adaptive": _Usage()}
+
+    @staticmethod
+    def setting(response_length: str, custom_length="10") -> str:
+        """Label of a length setting, e.g. "medium" or "custom:12" """
+        if response_length == "custom":
+            return f"custom:{_lines(custom_length)}"
+        return response_length if response_length in TOKEN_LIMITS else "medium"
+
+    def num_predict(self, model: str, response_length: str, custom_length="10") -> int:
+        if response_length not in TOKEN_LIMITS:
+            response_length = "medium"
+        if not self.adaptive:
+            return TOKEN_LIMITS[response_length]
+        return self._adaptive(model, response_length, custom_length)
+
+    def _adaptive(self, model: str, response_length: str, custom_length) -> int:
+        target = target_tokens(response_length, custom_length)
+        used = 0.0
+        samples = self._samples.get((model, response_length))
+        if samples is not None and len(samples) >= self.min_samples:
+            used = float(np.percentile(np.fromiter(samples, dtype=np.float64, count=len(samples)), TOKEN_BUDGET_QUANTILE))
+            if response_length == "custom":
+                used *= _lines(custom_length)
+        # Never below the requested length, so terse models aren't cut mid-sentence
+        return min(TOKEN_BUDGET_MAX, int(max(used, target) * TOKEN_BUDGET_HEADROOM))
+
+    def stop_hint_for(self, response_length: str, custom_length="10"):
+        """A StopHint for one generation, or None when hints are off"""
+        if not self.stop_hint:
+            return None
+        return StopHint(length_range(response_length, custom_length)[1])
+
+    def record(self, model: str, response_length: str, custom_length, tokens: int, num_predict: int,
+               truncated: bool = False, stopped: bool = False):
+        """Account one finished live generation of tokens under a num_predict budget
+
+        The policy not in use is accounted too, from what it would have done
+        with the same answer, so one run shows both.
+        """
+        if response_length not in TOKEN_LIMITS:
+            response_length = "medium"
+        target = target_tokens(response_length, custom_length)
+        truncated = truncated or tokens >= num_predict
+        if self.adaptive:
+            other_mode, other = "fixed", TOKEN_LIMITS[response_length]
+        else:
+            # The budget it would have had, learned from the answers before this one
+            other_mode, other = "adaptive", self._adaptive(model, response_length, custom_length)
+        self._usage["adaptive" if self.adaptive else "fixed"].add(tokens, target, truncated, stopped)
+        other_tokens, other_truncated, exact = _other_budget(tokens, truncated, other)
+        usage = self._usage[other_mode]
+        usage.add(other_tokens, target, other_truncated, stopped and not other_truncated)
+        usage.lower_bounds += not exact
+
+        if not stopped:
+            samples = self._samples.get((model, response_length))
+            if samples is None:
+                samples = self._samples[(model, response_length)] = collections.deque(maxlen=self.window)
+            samples.append(tokens / _lines(custom_length) if response_length == "custom" else tokens)
+
+    def stats(self) -> dict:
+        return {
+            "adaptive": self.adaptive,
+            "stop_hint": self.stop_hint,
+            "usage": {
+                mode: {**usage.report(), "simulated": (mode == "adaptive") != self.adaptive}
+                for mode, usage in self._usage.items()
+            },
+            "models": {
+                f"{model} {setting}": {
+                    "samples": len(samples),
+                    "p50": round(float(np.percentile(list(samples), 50)), 1),
+                    "quantile": round(float(np.percentile(list(samples), TOKEN_BUDGET_QUANTILE)), 1),
+                    "perLine": setting == "custom",
+                    "numPredict": None if setting == "custom" else self.num_predict(model, setting),
+                }
+                for (model, setting), samples in self._samples.items()
+            },
+        }
+
+
+token_budgets = TokenBudgets()
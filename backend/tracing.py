@@ -0,0 +1,186 @@
+import collections
+import json
+import os
+import random
+import time
+
+from logger import LineWriter
+
+# JSONL file of finished spans (OTLP/JSON field names, one span per line); empty turns export off
+TRACE_PATH = os.environ.get("TRACE_PATH", os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "traces.jsonl"))
+# Share of sessions traced; the rest get a span that records nothing
+TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", "1.0"))
+# The file is rotated to TRACE_PATH + ".1" past this size
+TRACE_MAX_MB = float(os.environ.get("TRACE_MAX_MB", "50"))
+# Recent traces kept in memory for /api/traces
+TRACE_RECENT = int(os.environ.get("TRACE_RECENT", "100"))
+
+
+def _wall_ns(monotonic: float) -> int:
+    """A time.monotonic() reading as Unix nanoseconds"""
+    return time.time_ns() - int((time.monotonic() - monotonic) * 1e9)
+
+
+class Span:
+    """One timed interval of a trace; children share its trace ID
+
+    Intervals that were already measured elsewhere (a queue wait, the time to
+    the first token) are added with record() instead of a child that has to
+    be ended.
+    """
+
+    __slots__ = ("tracer", "trace_id", "span_id", "parent_id", "name", "start", "attributes", "ended")
+
+    def __init__(self, tracer, trace_id: str, name: str, parent_id: str = None, start: float = None, **attributes):
+        self.tracer = tracer
+        self.trace_id = trace_id
+        self.span_id = "%016x" % random.getrandbits(64)
+        self.parent_id = parent_id
+        self.name = name
+        self.start = time.monotonic() if start is None else start
+        self.attributes = attributes
+        self.ended = False
+
+    def child(self, name: str, **attributes) -> "Span":
+        return Span(self.tracer, self.trace_id, name, self.span_id, **attributes)
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def record(self, name: str, start: float, end: float = None, **attributes):
+        """A finished child interval between two time.monotonic() readings"""
+        if start is None:
+            return
+        span = Span(self.tracer, self.trace_id, name, self.span_id, start, **attributes)
+        span.end(end)
+
+    def end(self, end: float = None, status: str = "ok", **attributes):
+        if self.ended:
+            return
+        self.ended = True
+        self.attributes.update(attributes)
+        self.tracer.export(self, self.start, time.monotonic() if end is None else end, status)
+
+
+class _NullSpan:
+    """Stands in for a span when the session isn't sampled"""
+
+    trace_id = None
+    span_id = None
+
+    def child(self, name: str, **attributes):
+        return self
+
+    def set(self, **attributes):
+        pass
+
+    def record(self, name: str, start: float, end: float = None, **attributes):
+        pass
+
+    def end(self, end: float = None, status: str = "ok", **attributes):
+        pass
+
+
+NULL_SPAN = _NullSpan()
+
+
+class _RotatingFile:
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.file = open(path, "a", encoding="utf-8")
+
+    def write(self, text: str):
+        if self.max_bytes and self.file.tell() + len(text) > self.max_bytes:
+            self.file.close()
+            os.replace(self.path, self.path + ".1")
+            self.file = open(self.path, "a", encoding="utf-8")
+        self.file.write(text)
+
+    def flush(self):
+        self.file.flush()
+
+
+class Tracer:
+    """Per-session and per-model spans, exported as JSONL off the event loop
+
+    Every line is one finished span, with the field names of OTLP's JSON
+    encoding, so the file can be grepped by traceId or converted for a
+    tracing backend.
+    """
+
+    def __init__(self, path: str = TRACE_PATH, sample_rate: float = TRACE_SAMPLE_RATE,
+                 max_bytes: int = int(TRACE_MAX_MB * 1024 * 1024), recent: int = TRACE_RECENT):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.traces = 0
+        self.sampled_out = 0
+        self.spans = 0
+        self._recent = collections.OrderedDict()  # trace ID -> (session ID, [span dicts])
+        self._recent_limit = recent
+        self._sessions = {}  # session ID -> trace ID, for the traces still in memory
+        self._writer = LineWriter("trace-writer", lambda: _RotatingFile(path, max_bytes),
+                                  lambda record: json.dumps(record, default=str)) if path else None
+
+    def start_trace(self, name: str, session_id: str = None, **attributes):
+        """Root span of a new trace, or the null span if this one isn't sampled"""
+        if self.sample_rate <= 0 or (self.sample_rate < 1.0 and random.random() >= self.sample_rate):
+            self.sampled_out += 1
+            return NULL_SPAN
+        self.traces += 1
+        trace_id = "%032x" % random.getrandbits(128)
+        if session_id is not None:
+            attributes["sessionId"] = session_id
+            self._sessions[session_id] = trace_id
+        self._recent[trace_id] = (session_id, [])
+        while len(self._recent) > self._recent_limit:
+            dropped, (dropped_session, spans) = self._recent.popitem(last=False)
+            if self._sessions.get(dropped_session) == dropped:
+                del self._sessions[dropped_session]
+        return Span(self, trace_id, name, **attributes)
+
+    def export(self, span: Span, start: float, end: float, status: str):
+        self.spans += 1
+        start_ns = _wall_ns(start)
+        record = {
+            "traceId": span.trace_id,
+            "spanId": span.span_id,
+            "parentSpanId": span.parent_id,
+            "name": span.name,
+            "startTimeUnixNano": start_ns,
+            "endTimeUnixNano": start_ns + int(max(0.0, end - start) * 1e9),
+            "attributes": span.attributes,
+            "status": status,
+        }
+        recent = self._recent.get(span.trace_id)
+        if recent is not None:
+            recent[1].append(record)
+        if self._writer is not None:
+            self._writer.put(record)
+
+    def trace(self, session_id: str):
+        """Spans of a recent session's trace, earliest first, or None"""
+        recent = self._recent.get(self._sessions.get(session_id))
+        if recent is None:
+            return None
+        return sorted(recent[1], key=lambda span: span["startTimeUnixNano"])
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+
+    def stats(self) -> dict:
+        return {
+            "path": self.path or None,
+            "sample_rate": self.sample_rate,
+            "traces": self.traces,
+            "sampled_out": self.sampled_out,
+            "spans": self.spans,
+            "recent": len(self._recent),
+            "queued": self._writer.queued if self._writer else 0,
+            "written": self._writer.written if self._writer else 0,
+            "dropped": self._writer.dropped if self._writer else 0,
+        }
+
+
+tracer = Tracer()
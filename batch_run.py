@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""Run a JSONL file of questions against every model, without the web UI.
+
+Results are appended to the output as each (question, model) pair finishes.
+Running the same command again resumes: pairs already in the output are skipped.
+
+    python batch_run.py questions.jsonl -o results.jsonl --concurrency 4
+    python batch_run.py questions.jsonl -o results.parquet --models llama3:8b,phi3
+"""
+import argparse
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backend'))
+
+from batch import BATCH_CONCURRENCY, BATCH_TIMEOUT, BatchInputError, BatchJob, load_questions, make_sink, select_models  # noqa: E402
+from main import create_enhanced_prompt, run_model_with_timeout  # noqa: E402
+from model_registry import model_registry  # noqa: E402
+from ollama_client import ollama_pool  # noqa: E402
+from response_cache import response_cache  # noqa: E402
+
+
+def format_progress(progress: dict) -> str:
+    done = progress["completed"] + progress["failed"] + progress["skipped"]
+    eta = progress["etaSeconds"]
+    eta_text = f"{eta // 3600}h{eta % 3600 // 60:02d}m{eta % 60:02d}s" if eta is not None else "--"
+    return (f"[{done}/{progress['total']}] {progress['failed']} failed, "
+            f"{progress['pairsPerMinute'] or 0} pairs/min, {progress['tokensPerSecond'] or 0} tok/s, ETA {eta_text}")
+
+
+async def run(args) -> int:
+    with open(args.input, encoding="utf-8") as f:
+        questions = load_questions(f)
+    if args.fresh:
+        checkpoint = os.path.join(args.output, "_checkpoint.jsonl") if os.path.isdir(args.output) else args.output
+        if os.path.exists(checkpoint):
+            os.remove(checkpoint)
+
+    await ollama_pool.start()
+    try:
+        changes = await model_registry.refresh()
+        if changes.get("error"):
+            print(f"Could not list models: {changes['error']}")
+            return 1
+        models = select_models(args.models.split(",") if args.models else None)
+        if not models:
+            print("No models available")
+            return 1
+
+        job = BatchJob(
+            "cli", questions, models, make_sink(args.output, args.format),
+            generate=run_model_with_timeout, make_prompt=create_enhanced_prompt,
+            response_length=args.length, custom_length=args.custom_length,
+            concurrency=args.concurrency, order=args.order, use_cache=not args.no_cache,
+            retry_errors=not args.keep_errors, timeout=args.timeout,
+        )
+        print(f"{len(questions)} questions x {len(models)} models -> {args.output}")
+        task = asyncio.create_task(job.run())
+        while not task.done():
+            await asyncio.wait([task], timeout=args.progress_interval)
+            if job.status == "running":
+                print(format_progress(job.progress()), flush=True)
+        await task
+        print(format_progress(job.progress()))
+        return 0 if job.failed == 0 else 2
+    finally:
+        await ollama_pool.close()
+        response_cache.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("input", help="JSONL with question/prompt (or title/body) per line")
+    parser.add_argument("-o", "--output", required=True, help="results .jsonl file or .parquet directory")
+    parser.add_argument("--format", choices=("jsonl", "parquet"), help="default: from the output name")
+    parser.add_argument("--models", help="comma-separated names or tags (default: every model)")
+    parser.add_argument("--length", default="medium", help="response length for records that don't set one")
+    parser.add_argument("--custom-length", default="10")
+    parser.add_argument("--concurrency", type=int, default=BATCH_CONCURRENCY)
+    parser.add_argument("--order", choices=("model", "question"), default="model",
+                        help="model runs each model over all questions before loading the next")
+    parser.add_argument("--timeout", type=int, default=BATCH_TIMEOUT, help="seconds per generation")
+    parser.add_argument("--no-cache", action="store_true", help="don't use the response cache")
+    parser.add_argument("--keep-errors", action="store_true", help="on resume, don't retry pairs that failed")
+    parser.add_argument("--fresh", action="store_true", help="ignore earlier results and start over")
+    parser.add_argument("--progress-interval", type=float, default=10.0)
+    args = parser.parse_args()
+
+    try:
+        sys.exit(asyncio.run(run(args)))
+    except BatchInputError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    except KeyboardInterrupt:
+        print("Interrupted - run the same command again to resume")
+        sys.exit(130)
+
+
+if __name__ == "__main__":
+    main()
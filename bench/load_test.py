@@ -0,0 +1,426 @@
+#!/usr/bin/env python3
+"""Load-test the backend against the mock Ollama server.
+
+Starts bench/mock_ollama.py and the backend (unless --backend-url is given),
+runs concurrent /ws clients (and optionally /api/meta-summary callers), and
+reports latency percentiles, server CPU per token, bytes, event loop lag and
+peak RSS:
+
+    python bench/load_test.py --clients 20 --rounds 3 --json results.json
+    python bench/load_test.py --clients 20 --baseline results.json --max-regression 0.2
+    python bench/load_test.py --hosts 3 --kill-host-after 5    # routing and failover
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+import websockets
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Lower is better for all of these; a run fails the baseline check when one grows
+# by more than --max-regression
+REGRESSION_KEYS = (
+    ("latency", "p95"),
+    ("ttft", "p95"),
+    ("cpu_ms_per_token",),
+    ("bytes_per_token",),
+    ("loop_lag", "p99"),
+    ("peak_rss_mb",),
+)
+
+
+def percentiles(values) -> dict:
+    if not values:
+        return {"count": 0}
+    ordered = sorted(values)
+
+    def rank(p):
+        # Nearest-rank percentile
+        return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+    return {
+        "count": len(ordered),
+        "mean": round(sum(ordered) / len(ordered), 4),
+        "p50": round(rank(50), 4),
+        "p95": round(rank(95), 4),
+        "p99": round(rank(99), 4),
+        "max": round(ordered[-1], 4),
+    }
+
+
+def parse_histogram(text: str, name: str) -> dict:
+    """Cumulative bucket counts {le: count} for an unlabelled histogram in /metrics output"""
+    buckets = {}
+    pattern = re.compile(rf'^{name}_bucket{{le="([^"]+)"}} (\S+)$')
+    for line in text.splitlines():
+        match = pattern.match(line)
+        if match:
+            le = float("inf") if match.group(1) == "+Inf" else float(match.group(1))
+            buckets[le] = float(match.group(2))
+    return buckets
+
+
+def histogram_quantile(before: dict, after: dict, q: float):
+    """Upper bucket bound holding the q-quantile of observations made between two scrapes"""
+    counts = {le: after[le] - before.get(le, 0.0) for le in after}
+    total = counts.get(float("inf"), 0.0)
+    if not total:
+        return None
+    for le in sorted(counts):
+        if counts[le] >= q * total:
+            return le if le != float("inf") else None
+    return None
+
+
+def metric_value(text: str, name: str):
+    for line in text.splitlines():
+        if line.startswith(name + " "):
+            return float(line.split()[1])
+    return None
+
+
+class ProcessStats:
+    """CPU time and peak RSS of a local process, from /proc"""
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.ticks = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+    def cpu_seconds(self):
+        if self.pid is None:
+            return None
+        try:
+            with open(f"/proc/{self.pid}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            return (int(fields[11]) + int(fields[12])) / self.ticks
+        except OSError:
+            return None
+
+    def peak_rss_mb(self):
+        if self.pid is None:
+            return None
+        try:
+            with open(f"/proc/{self.pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        return round(int(line.split()[1]) / 1024, 1)
+        except OSError:
+            return None
+        return None
+
+
+class Results:
+    def __init__(self):
+        self.latencies = []
+        self.ttfts = []
+        self.meta_latencies = []
+        self.questions = 0
+        self.errors = 0
+        self.tokens = 0
+        self.frames = 0
+        self.bytes = 0
+
+
+async def run_client(args, index: int, results: Results):
+    ws_url = args.backend_url.replace("http", "ws", 1) + "/ws"
+    subprotocols = ["compare.v2"] if args.protocol == 2 else None
+    compression = None if args.no_compression else "deflate"
+    async with websockets.connect(ws_url, subprotocols=subprotocols, max_size=None, compression=compression) as ws:
+        async with httpx.AsyncClient(base_url=args.backend_url, timeout=args.timeout) as http:
+            for round_number in range(args.rounds):
+                session_id = f"bench-{index}-{round_number}"
+                # Distinct questions, unless coalescing is what is being measured
+                question = "Shared bench question" if args.shared_questions else f"Bench question {index}-{round_number}"
+                started = time.perf_counter()
+                first_token = {}
+                await ws.send(json.dumps({
+                    "question": question, "mode": args.mode, "responseLength": args.response_length,
+                    "sessionId": session_id, "bypassCache": not args.cache,
+                }))
+                completed_model = None
+                while True:
+                    raw = await asyncio.wait_for(ws.recv(), args.timeout)
+                    results.frames += 1
+                    results.bytes += len(raw)
+                    message = json.loads(raw)
+                    if message.get("sessionId") not in (session_id, None):
+                        continue
+                    status = message.get("status")
+                    model = message.get("model")
+                    if status in ("streaming", "delta") and (message.get("delta") or message.get("content")):
+                        first_token.setdefault(model, time.perf_counter() - started)
+                    elif status == "completed":
+                        results.tokens += (message.get("stats") or {}).get("evalCount", 0)
+                        completed_model = completed_model or model
+                    elif status == "error":
+                        results.errors += 1
+                        if not model:
+                            break
+                    elif status == "all_completed":
+                        break
+                results.questions += 1
+                results.latencies.append(time.perf_counter() - started)
+                results.ttfts.extend(first_token.values())
+
+                if index < args.meta_clients and completed_model:
+                    await run_meta_summary(http, session_id, completed_model, results)
+
+
+async def run_meta_summary(http: httpx.AsyncClient, session_id: str, model: str, results: Results):
+    started = time.perf_counter()
+    async with http.stream("POST", "/api/meta-summary", json={"sessionId": session_id, "model": model}) as response:
+        async for line in response.aiter_lines():
+            results.bytes += len(line) + 1
+            if not line.startswith("data: "):
+                continue
+            event = json.loads(line[6:])
+            if event.get("error"):
+                results.errors += 1
+                return
+            if event.get("done"):
+                break
+    results.meta_latencies.append(time.perf_counter() - started)
+
+
+async def wait_for_models(url: str, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(timeout=2.0) as http:
+        while time.monotonic() < deadline:
+            try:
+                response = await http.get(url + "/api/models")
+                if response.status_code == 200 and response.json().get("models"):
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"Backend at {url} did not list any models within {timeout:g}s")
+
+
+def start_processes(args, workdir: str):
+    """Launch the mock Ollama servers and the backend; returns (backend, mocks)"""
+    mocks = []
+    for index in range(args.hosts):
+        mock_args = [
+            sys.executable, os.path.join(ROOT, "bench", "mock_ollama.py"), "--port", str(args.mock_port + index),
+            "--models", str(args.models), "--max-loaded", str(args.max_loaded), "--tokens", str(args.tokens),
+            "--token-rate", str(args.token_rate), "--ttft", str(args.ttft), "--load-delay", str(args.load_delay),
+            "--error-rate", str(args.error_rate), "--stall-rate", str(args.stall_rate),
+            "--stall-seconds", str(args.stall_seconds), "--seed", str(7 + index),
+        ]
+        mocks.append(subprocess.Popen(mock_args))
+
+    env = dict(os.environ)
+    env.update({
+        "OLLAMA_URLS": ",".join(f"http://127.0.0.1:{args.mock_port + index}" for index in range(args.hosts)),
+        "RESPONSE_CACHE_ENABLED": "1" if args.cache else "0",
+        # Everything the backend persists stays in workdir, away from the user's real files
+        "RESPONSE_CACHE_PATH": os.path.join(workdir, "cache.db"),
+        "HISTORY_PATH": os.path.join(workdir, "history.db"),
+        "TRACE_PATH": os.path.join(workdir, "traces.jsonl"),
+        "SEMANTIC_CACHE_DIR": os.path.join(workdir, "semantic_cache"),
+        "MODEL_PROFILE_PATH": os.path.join(workdir, "model_profile.json"),
+        "BATCH_DIR": os.path.join(workdir, "batch_jobs"),
+    })
+    backend = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(args.port), "--log-level", "warning"],
+        cwd=os.path.join(ROOT, "backend"), env=env,
+        stdout=subprocess.DEVNULL if not args.server_output else None,
+    )
+    return backend, mocks
+
+
+async def kill_host_after(seconds: float, mocks, http: httpx.AsyncClient):
+    """Take the busiest stand-in host down mid-run so requests have to fail over
+
+    Hosts in /api/pool-stats are in OLLAMA_URLS order, the order the mocks were started in.
+    """
+    await asyncio.sleep(seconds)
+    hosts = (await http.get("/api/pool-stats")).json().get("hosts", [])
+    if len(hosts) != len(mocks):
+        print(f"Not killing a host: the backend has {len(hosts)} hosts, {len(mocks)} mocks were started")
+        return
+    index = max(range(len(hosts)), key=lambda i: (hosts[i]["active"], hosts[i]["requests"]))
+    print(f"Killing mock Ollama {hosts[index]['url']} (pid {mocks[index].pid}, "
+          f"{hosts[index]['active']} streaming, {hosts[index]['requests']} requests so far)")
+    mocks[index].kill()
+
+
+async def run(args) -> dict:
+    async with httpx.AsyncClient(base_url=args.backend_url, timeout=10.0) as http:
+        await wait_for_models(args.backend_url)
+        metrics_before = (await http.get("/metrics")).text
+        server = ProcessStats(args.server_pid)
+        cpu_before = server.cpu_seconds()
+
+        results = Results()
+        killer = None
+        if args.kill_host_after is not None and args.mocks:
+            killer = asyncio.create_task(kill_host_after(args.kill_host_after, args.mocks, http))
+        started = time.perf_counter()
+        await asyncio.gather(*(run_client(args, i, results) for i in range(args.clients)))
+        wall = time.perf_counter() - started
+        if killer is not None:
+            killer.cancel()
+
+        cpu_after = server.cpu_seconds()
+        metrics_after = (await http.get("/metrics")).text
+        pool = (await http.get("/api/pool-stats")).json()
+
+    cpu = cpu_after - cpu_before if cpu_before is not None and cpu_after is not None else None
+    lag_before = parse_histogram(metrics_before, "compare_event_loop_lag_seconds")
+    lag_after = parse_histogram(metrics_after, "compare_event_loop_lag_seconds")
+    return {
+        "wall_seconds": round(wall, 3),
+        "questions": results.questions,
+        "errors": results.errors,
+        "tokens": results.tokens,
+        "tokens_per_second": round(results.tokens / wall, 2) if wall else None,
+        "latency": percentiles(results.latencies),
+        "ttft": percentiles(results.ttfts),
+        "meta_latency": percentiles(results.meta_latencies),
+        "frames": results.frames,
+        "bytes": results.bytes,
+        "bytes_per_token": round(results.bytes / results.tokens, 2) if results.tokens else None,
+        "server_cpu_seconds": round(cpu, 3) if cpu is not None else None,
+        "cpu_ms_per_token": round(cpu * 1000 / results.tokens, 4) if cpu is not None and results.tokens else None,
+        "loop_lag": {
+            "p50": histogram_quantile(lag_before, lag_after, 0.50),
+            "p99": histogram_quantile(lag_before, lag_after, 0.99),
+            "max": metric_value(metrics_after, "compare_event_loop_lag_max_seconds"),
+        },
+        "peak_rss_mb": server.peak_rss_mb(),
+        "failovers": pool.get("failovers"),
+        "hedges": pool.get("hedges"),
+        "hedge_wins": pool.get("hedge_wins"),
+        "hosts": [
+            {"url": host["url"], "requests": host["requests"], "failures": host["failures"], "healthy": host["healthy"]}
+            for host in pool.get("hosts", [])
+        ],
+    }
+
+
+def lookup(results: dict, path):
+    for key in path:
+        if not isinstance(results, dict):
+            return None
+        results = results.get(key)
+    return results
+
+
+def check_baseline(results: dict, baseline_path: str, max_regression: float) -> list:
+    """Names of metrics that got worse than the baseline by more than max_regression"""
+    with open(baseline_path) as f:
+        baseline = json.load(f)["results"]
+    regressions = []
+    for path in REGRESSION_KEYS:
+        old, new = lookup(baseline, path), lookup(results, path)
+        if old and new is not None and new > old * (1 + max_regression):
+            regressions.append(f"{'.'.join(path)}: {old} -> {new}")
+    return regressions
+
+
+def print_summary(results: dict):
+    print(f"{results['questions']} questions in {results['wall_seconds']}s, {results['errors']} errors, "
+          f"{results['tokens']} tokens ({results['tokens_per_second']} tok/s)")
+    for name in ("latency", "ttft", "meta_latency"):
+        p = results[name]
+        if p.get("count"):
+            print(f"  {name:<13} p50 {p['p50']:.3f}s  p95 {p['p95']:.3f}s  p99 {p['p99']:.3f}s  (n={p['count']})")
+    print(f"  bytes         {results['bytes']} ({results['bytes_per_token']} per token, {results['frames']} frames)")
+    print(f"  server cpu    {results['server_cpu_seconds']}s ({results['cpu_ms_per_token']} ms per token)")
+    lag = results["loop_lag"]
+    print(f"  loop lag      p50 <= {lag['p50']}s  p99 <= {lag['p99']}s  max {lag['max']}s")
+    print(f"  peak rss      {results['peak_rss_mb']} MB")
+    if len(results["hosts"]) > 1:
+        print(f"  hosts         {results['failovers']} failovers, {results['hedges']} hedges "
+              f"({results['hedge_wins']} won)")
+        for host in results["hosts"]:
+            print(f"    {host['url']:<26} {host['requests']:>5} requests  {host['failures']} failures"
+                  f"{'' if host['healthy'] else '  (down)'}")
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    load = parser.add_argument_group("load")
+    load.add_argument("--clients", type=int, default=10, help="concurrent WebSocket clients")
+    load.add_argument("--rounds", type=int, default=3, help="questions per client")
+    load.add_argument("--meta-clients", type=int, default=0, help="clients that also request a meta-summary")
+    load.add_argument("--mode", default="parallel", choices=("parallel", "batch", "sequential", "race", "top_k", "quorum"))
+    load.add_argument("--response-length", default="medium")
+    load.add_argument("--protocol", type=int, default=2, choices=(1, 2))
+    load.add_argument("--no-compression", action="store_true", help="count uncompressed bytes only")
+    load.add_argument("--shared-questions", action="store_true", help="every client asks the same question")
+    load.add_argument("--cache", action="store_true", help="leave the response cache on")
+    load.add_argument("--timeout", type=float, default=120.0)
+
+    server = parser.add_argument_group("servers")
+    server.add_argument("--backend-url", help="use a running backend instead of starting one")
+    server.add_argument("--server-pid", type=int, help="pid of --backend-url's process, for CPU and RSS")
+    server.add_argument("--port", type=int, default=8765, help="port for the backend this script starts")
+    server.add_argument("--mock-port", type=int, default=11435, help="first mock port; --hosts counts up from it")
+    server.add_argument("--hosts", type=int, default=1, help="mock Ollama hosts behind the backend")
+    server.add_argument("--kill-host-after", type=float, help="kill the busiest mock host this many seconds in")
+    server.add_argument("--server-output", action="store_true", help="show the backend's stdout")
+
+    mock = parser.add_argument_group("mock Ollama")
+    mock.add_argument("--models", type=int, default=4)
+    mock.add_argument("--max-loaded", type=int, default=2)
+    mock.add_argument("--tokens", type=int, default=200)
+    mock.add_argument("--token-rate", type=float, default=50.0)
+    mock.add_argument("--ttft", type=float, default=0.1)
+    mock.add_argument("--load-delay", type=float, default=0.0)
+    mock.add_argument("--error-rate", type=float, default=0.0)
+    mock.add_argument("--stall-rate", type=float, default=0.0)
+    mock.add_argument("--stall-seconds", type=float, default=5.0)
+
+    output = parser.add_argument_group("output")
+    output.add_argument("--json", help="write results to this file")
+    output.add_argument("--baseline", help="results file to compare against")
+    output.add_argument("--max-regression", type=float, default=0.2, help="allowed growth over the baseline")
+    return parser
+
+
+def main():
+    args = build_parser().parse_args()
+    processes = []
+    args.mocks = []
+    with tempfile.TemporaryDirectory() as workdir:
+        try:
+            if args.backend_url is None:
+                backend, args.mocks = start_processes(args, workdir)
+                processes = [backend] + args.mocks
+                args.server_pid = backend.pid
+                args.backend_url = f"http://127.0.0.1:{args.port}"
+            args.backend_url = args.backend_url.rstrip("/")
+            results = asyncio.run(run(args))
+        finally:
+            for process in processes:
+                process.terminate()
+            for process in processes:
+                process.wait(timeout=10)
+
+    print_summary(results)
+    config = {k: v for k, v in vars(args).items() if k not in ("json", "baseline", "server_pid", "mocks")}
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"config": config, "results": results}, f, indent=2)
+
+    if args.baseline:
+        regressions = check_baseline(results, args.baseline, args.max_regression)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
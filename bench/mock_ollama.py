@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""Stand-in Ollama server with controllable speed and failures.
+
+Serves /api/tags, /api/ps, /api/show, /api/embeddings and streaming NDJSON
+/api/generate, so the backend's own overhead can be measured without real models:
+
+    python bench/mock_ollama.py --port 11435 --models 6 --token-rate 40 --ttft 0.2
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import time
+from collections import OrderedDict
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+WORDS = ("the model response token stream latency answer context question summary "
+         "compare local inference memory weights prompt output result").split()
+
+
+class MockOllama:
+    """Model residency and generation timing for the fake server"""
+
+    def __init__(self, args):
+        self.args = args
+        self.models = [f"mock-{i}:latest" if i % 3 else f"mock-{i}:7b" for i in range(args.models)]
+        self.loaded = OrderedDict()  # tag -> expiry, least recently used first
+        self.rng = random.Random(args.seed)
+        self.generations = 0
+        self.errors = 0
+        self.stalls = 0
+
+    def digest(self, tag: str) -> str:
+        return "sha256:" + hashlib.sha256(tag.encode()).hexdigest()
+
+    async def load(self, tag: str) -> float:
+        """Load the model unless resident; returns seconds spent loading"""
+        if tag in self.loaded:
+            self.loaded.move_to_end(tag)
+            return 0.0
+        started = time.perf_counter()
+        if self.args.load_delay:
+            await asyncio.sleep(self.args.load_delay)
+        while len(self.loaded) >= self.args.max_loaded:
+            self.loaded.popitem(last=False)
+        self.loaded[tag] = time.time() + 300
+        return time.perf_counter() - started
+
+    def token(self, index: int) -> str:
+        word = self.rng.choice(WORDS)
+        if index % 15 == 14:
+            word += ".\n" if index % 60 == 59 else ","
+        return " " + word
+
+
+def create_app(args) -> FastAPI:
+    app = FastAPI()
+    mock = MockOllama(args)
+    app.state.mock = mock
+
+    @app.get("/api/tags")
+    async def tags():
+        return {"models": [
+            {"name": tag, "model": tag, "digest": mock.digest(tag), "size": args.model_size}
+            for tag in mock.models
+        ]}
+
+    @app.get("/api/ps")
+    async def ps():
+        return {"models": [
+            {"name": tag, "model": tag, "digest": mock.digest(tag), "size": args.model_size, "size_vram": args.model_size}
+            for tag in mock.loaded
+        ]}
+
+    @app.post("/api/show")
+    async def show(request: Request):
+        return {"model_info": {"llama.context_length": args.context_length}}
+
+    @app.post("/api/embeddings")
+    async def embeddings(request: Request):
+        body = await request.json()
+        digest = hashlib.sha256(body.get("prompt", "").encode()).digest()
+        return {"embedding": [(b - 127.5) / 127.5 for b in digest * (args.embedding_dim // 32)]}
+
+    @app.get("/api/stats")
+    async def stats():
+        return {"generations": mock.generations, "errors": mock.errors, "stalls": mock.stalls,
+                "loaded": list(mock.loaded)}
+
+    @app.post("/api/generate")
+    async def generate(request: Request):
+        body = await request.json()
+        tag = body.get("model")
+        if tag not in mock.models:
+            return JSONResponse({"error": f"model '{tag}' not found"}, status_code=404)
+        if mock.rng.random() < args.error_rate:
+            mock.errors += 1
+            return JSONResponse({"error": "mock failure"}, status_code=500)
+
+        if not body.get("prompt") and str(body.get("keep_alive")) in ("0", "0s"):
+            # Unload, as Ollama does for keep_alive 0 without a prompt
+            mock.loaded.pop(tag, None)
+            return {"model": tag, "response": "", "done": True, "done_reason": "unload"}
+
+        options = body.get("options") or {}
+        count = min(int(options.get("num_predict", args.tokens)), args.tokens)
+        prompt = body.get("prompt", "")
+        stream = body.get("stream", True)
+        mock.generations += 1
+
+        async def events():
+            started = time.perf_counter()
+            load_seconds = await mock.load(tag)
+            if not prompt:
+                # Warm-up request: load only
+                yield json.dumps({"model": tag, "response": "", "done": True,
+                                  "load_duration": int(load_seconds * 1e9)}) + "\n"
+                return
+            await asyncio.sleep(args.ttft)
+            eval_started = time.perf_counter()
+            stall_at = mock.rng.randrange(count) if count and mock.rng.random() < args.stall_rate else None
+            for index in range(count):
+                if index == stall_at:
+                    mock.stalls += 1
+                    await asyncio.sleep(args.stall_seconds)
+                await asyncio.sleep(1.0 / args.token_rate)
+                yield json.dumps({"model": tag, "response": mock.token(index), "done": False}) + "\n"
+            now = time.perf_counter()
+            prompt_tokens = max(1, len(prompt) // 4)
+            yield json.dumps({
+                "model": tag, "response": "", "done": True, "done_reason": "length" if count == args.tokens else "stop",
+                "total_duration": int((now - started) * 1e9),
+                "load_duration": int(load_seconds * 1e9),
+                "prompt_eval_count": prompt_tokens,
+                "prompt_eval_duration": int(args.ttft * 1e9),
+                "eval_count": count,
+                "eval_duration": int((now - eval_started) * 1e9),
+                "context": list(range(prompt_tokens + count)),
+            }) + "\n"
+
+        if not stream:
+            lines = [json.loads(line) async for line in events()]
+            final = lines[-1]
+            final["response"] = "".join(line["response"] for line in lines)
+            return final
+        return StreamingResponse(events(), media_type="application/x-ndjson")
+
+    return app
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11435)
+    parser.add_argument("--models", type=int, default=4, help="number of fake models")
+    parser.add_argument("--max-loaded", type=int, default=2, help="models resident at once")
+    parser.add_argument("--model-size", type=int, default=4_000_000_000, help="bytes per model")
+    parser.add_argument("--tokens", type=int, default=200, help="tokens per response, capped by num_predict")
+    parser.add_argument("--token-rate", type=float, default=50.0, help="tokens per second per generation")
+    parser.add_argument("--ttft", type=float, default=0.1, help="seconds before the first token")
+    parser.add_argument("--load-delay", type=float, default=0.0, help="seconds to load a non-resident model")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of generations that fail")
+    parser.add_argument("--stall-rate", type=float, default=0.0, help="fraction of generations that stall once")
+    parser.add_argument("--stall-seconds", type=float, default=5.0)
+    parser.add_argument("--context-length", type=int, default=8192)
+    parser.add_argument("--embedding-dim", type=int, default=256)
+    parser.add_argument("--seed", type=int, default=7)
+    return parser
+
+
+def main():
+    args = build_parser().parse_args()
+    uvicorn.run(create_app(args), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""Compare bytes on the wire and encoder CPU for the v1 and v2 WebSocket protocols.
+
+Feeds a synthetic token stream through ModelStreamWriter at a simulated token
+rate, so results do not depend on Ollama or the network:
+
+    python bench/protocol_compare.py --tokens 1200 --rate 40
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "backend"))
+
+from protocol import ModelStreamWriter  # noqa: E402
+
+WORDS = ("the model response token stream latency answer context question summary "
+         "compare local inference memory weights prompt output result").split()
+
+
+def make_tokens(count: int, seed: int = 7):
+    rng = random.Random(seed)
+    tokens = []
+    for i in range(count):
+        word = rng.choice(WORDS)
+        if i % 15 == 14:
+            word += ".\n" if i % 60 == 59 else ","
+        tokens.append(" " + word)
+    return tokens
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+async def encode(version: int, tokens, rate: float, coalesce_ms: float, coalesce_bytes: int):
+    frames = []
+
+    async def send(message):
+        frames.append(json.dumps(message))
+
+    clock = FakeClock()
+    writer = ModelStreamWriter(send, "bench-model", "bench-session", version,
+                               coalesce_ms=coalesce_ms, coalesce_bytes=coalesce_bytes, clock=clock)
+    await writer.start()
+    for token in tokens:
+        clock.now += 1.0 / rate
+        await writer.push(token)
+    await writer.complete()
+    writer.close()
+    return frames
+
+
+def deflated_size(frames) -> int:
+    """Bytes after permessage-deflate with context takeover (the browser default)"""
+    compressor = zlib.compressobj(wbits=-15)
+    total = 0
+    for frame in frames:
+        data = compressor.compress(frame.encode("utf-8")) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        total += len(data) - 4  # the trailing 00 00 ff ff is stripped on the wire
+    return total
+
+
+def measure(version: int, tokens, args) -> dict:
+    frames = asyncio.run(encode(version, tokens, args.rate, args.coalesce_ms, args.coalesce_bytes))
+    cpu_start = time.process_time()
+    for _ in range(args.repeat):
+        asyncio.run(encode(version, tokens, args.rate, args.coalesce_ms, args.coalesce_bytes))
+    cpu = (time.process_time() - cpu_start) / args.repeat
+    return {
+        "protocol": f"v{version}",
+        "frames": len(frames),
+        "bytes": sum(len(f.encode("utf-8")) for f in frames),
+        "deflate_bytes": deflated_size(frames),
+        "encode_cpu_ms": round(cpu * 1000, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--tokens", type=int, default=1200, help="tokens per response")
+    parser.add_argument("--rate", type=float, default=40.0, help="simulated tokens per second")
+    parser.add_argument("--coalesce-ms", type=float, default=50.0)
+    parser.add_argument("--coalesce-bytes", type=int, default=2048)
+    parser.add_argument("--repeat", type=int, default=20, help="encodings averaged for CPU time")
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+
+    tokens = make_tokens(args.tokens)
+    results = [measure(1, tokens, args), measure(2, tokens, args)]
+
+    print(f"{args.tokens} tokens at {args.rate:g} tok/s, {sum(len(t) for t in tokens)} chars")
+    print(f"{'protocol':<10}{'frames':>8}{'bytes':>12}{'deflated':>12}{'cpu ms':>10}")
+    for r in results:
+        print(f"{r['protocol']:<10}{r['frames']:>8}{r['bytes']:>12}{r['deflate_bytes']:>12}{r['encode_cpu_ms']:>10}")
+    v1, v2 = results
+    print(f"v2/v1 bytes: {v2['bytes'] / v1['bytes']:.3f}  deflated: {v2['deflate_bytes'] / v1['deflate_bytes']:.3f}  "
+          f"cpu: {v2['encode_cpu_ms'] / v1['encode_cpu_ms']:.3f}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"tokens": args.tokens, "rate": args.rate, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
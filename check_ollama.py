@@ -1,57 +1,128 @@
 #!/usr/bin/env python3
-import subprocess
-import requests
-import json
-
-def check_ollama_status():
-    """Check Ollama status and running models"""
-    print("🔍 Checking Ollama status...")
-    
-    # Check if Ollama is running
+"""Check Ollama's status, unload stuck models, or profile each model's speed.
+
+    python check_ollama.py                  # loaded and available models
+    python check_ollama.py --unload         # then unload everything that is loaded
+    python check_ollama.py profile          # measure every model into model_profile.json
+    python check_ollama.py profile --models llama3:8b,phi3 --runs 3 --no-cold
+
+Profiling unloads each model first to time a cold load (skip with --no-cold
+while the app is serving), then streams a fixed set of prompts to measure
+first-token latency, token rate and gaps. The backend reads the file at startup.
+"""
+import argparse
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backend'))
+
+from model_profile import MODEL_PROFILE_PATH, profile_model, write_profile  # noqa: E402
+from model_registry import model_registry  # noqa: E402
+from ollama_client import ollama_pool  # noqa: E402
+
+
+def format_bytes(size) -> str:
+    return f"{size / 1e9:.1f} GB" if size else "-"
+
+
+async def show_status() -> int:
     try:
-        result = subprocess.run(['ollama', 'ps'], capture_output=True, text=True)
-        print(f"📊 Running models:\n{result.stdout}")
-        
-        if result.stdout.strip() == "NAME\tID\tSIZE\tPROCESSOR\tUNTIL":
-            print("✅ No models currently running")
-        
-    except FileNotFoundError:
-        print("❌ Ollama not found. Make sure it's installed and in PATH")
-        return
-    
-    # Check available models
+        running = await ollama_pool.running_models()
+        available = await ollama_pool.list_models()
+    except Exception as e:
+        print(f"❌ Cannot reach Ollama at {', '.join(host.base_url for host in ollama_pool.hosts)}: {e}")
+        return 1
+    print(f"📊 Running models ({len(running)}):")
+    for model in running:
+        print(f"  {model.get('name') or model.get('model'):<40} {format_bytes(model.get('size')):>9}"
+              f"  VRAM {format_bytes(model.get('size_vram')):>9}  until {model.get('expires_at', '-')}")
+    print(f"📋 Available models ({len(available)}):")
+    for model in available:
+        print(f"  {model.get('name') or model.get('model'):<40} {format_bytes(model.get('size')):>9}")
+    return 0
+
+
+async def unload_all():
+    for model in await ollama_pool.running_models():
+        tag = model.get("name") or model.get("model")
+        response = await ollama_pool.request(tag, "POST", "/api/generate", json={"model": tag, "keep_alive": 0, "stream": False},
+                                             timeout=ollama_pool.timeout(read=60.0))
+        print(f"  {'✅' if response.status_code == 200 else '❌'} {tag}")
+
+
+async def run_status(args) -> int:
+    await ollama_pool.start()
     try:
-        result = subprocess.run(['ollama', 'list'], capture_output=True, text=True)
-        print(f"📋 Available models:\n{result.stdout}")
-    except:
-        print("❌ Could not list models")
-    
-    # Test API connection
+        status = await show_status()
+        if status == 0 and args.unload:
+            print("\n🔧 Unloading running models...")
+            await unload_all()
+            print("\n📊 Status after cleanup:")
+            status = await show_status()
+        return status
+    finally:
+        await ollama_pool.close()
+
+
+async def run_profile(args) -> int:
+    await ollama_pool.start()
     try:
-        response = requests.get("http://localhost:11434/api/tags", timeout=5)
-        if response.status_code == 200:
-            models = response.json().get("models", [])
-            print(f"🌐 API accessible - {len(models)} models found via API")
-        else:
-            print(f"⚠️ API returned status {response.status_code}")
-    except requests.exceptions.RequestException as e:
-        print(f"❌ Cannot connect to Ollama API: {e}")
-
-def kill_stuck_models():
-    """Kill any stuck model processes"""
-    print("\n🔧 Checking for stuck processes...")
+        changes = await model_registry.refresh()
+        if changes.get("error"):
+            print(f"Could not list models: {changes['error']}")
+            return 1
+        tags = sorted(entry["model_name"] for entry in model_registry.models.values())
+        if args.models:
+            wanted = [name.strip() for name in args.models.split(",")]
+            tags = [model_registry.get(name)["model_name"] for name in wanted if model_registry.get(name)]
+            missing = [name for name in wanted if not model_registry.get(name)]
+            if missing:
+                print(f"Unknown models: {', '.join(missing)}")
+                return 1
+        if not tags:
+            print("No models available")
+            return 1
+
+        profiles = {}
+        for index, tag in enumerate(tags, 1):
+            print(f"[{index}/{len(tags)}] {tag}...", flush=True)
+            try:
+                profile = await profile_model(tag, runs=args.runs, cold=not args.no_cold)
+            except Exception as e:
+                print(f"  ❌ {e}")
+                continue
+            profiles[tag] = profile
+            print(f"  load {profile.get('coldLoadSeconds', '-')}s, first token p50 {profile['firstTokenP50']}s"
+                  f" / p95 {profile['firstTokenP95']}s, {profile['tokensPerSecond']} tok/s,"
+                  f" gap p95 {profile['gapP95']}s, {format_bytes(profile.get('sizeBytes'))}")
+        if not profiles:
+            return 1
+        write_profile(profiles, args.output)
+        print(f"Wrote {len(profiles)} model profiles to {args.output}")
+        return 0 if len(profiles) == len(tags) else 2
+    finally:
+        await ollama_pool.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--unload", action="store_true", help="unload every running model after showing status")
+    commands = parser.add_subparsers(dest="command")
+    profile = commands.add_parser("profile", help="measure load time, latency and token rate per model")
+    profile.add_argument("--models", help="comma-separated names or tags (default: every model)")
+    profile.add_argument("--runs", type=int, default=2, help="passes over the prompt set per model")
+    profile.add_argument("--no-cold", action="store_true", help="don't unload models to time a cold load")
+    profile.add_argument("-o", "--output", default=MODEL_PROFILE_PATH,
+                         help="profile file; models not profiled this time are kept")
+    args = parser.parse_args()
+
     try:
-        # This will stop all running models
-        subprocess.run(['ollama', 'stop', '--all'], capture_output=True)
-        print("✅ Stopped all running models")
-    except:
-        print("❌ Could not stop models")
+        sys.exit(asyncio.run(run_profile(args) if args.command == "profile" else run_status(args)))
+    except KeyboardInterrupt:
+        print("Interrupted")
+        sys.exit(130)
+
 
 if __name__ == "__main__":
-    check_ollama_status()
-    
-    response = input("\n🤔 Kill stuck models? (y/N): ")
-    if response.lower() == 'y':
-        kill_stuck_models()
-        print("\n📊 Status after cleanup:")
-        check_ollama_status()
\ No newline at end of file
+    main()
@@ -9,7 +9,8 @@ def main():
     
     # Run the FastAPI server
     import uvicorn
-    uvicorn.run("main:app", host="127.0.0.1", port=8000, reload=False)
+    uvicorn.run("main:app", host="127.0.0.1", port=8000, reload=False,
+                ws_per_message_deflate=os.environ.get("WS_PERMESSAGE_DEFLATE", "1") == "1")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
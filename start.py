@@ -18,5 +18,6 @@ if __name__ == "__main__":
         app, 
         host="0.0.0.0", 
         port=8000, 
-        log_level="info"
+        log_level="info",
+        ws_per_message_deflate=os.environ.get("WS_PERMESSAGE_DEFLATE", "1") == "1"
     )
\ No newline at end of file
@@ -0,0 +1,50 @@
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import httpx
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Backend modules import each other as top-level modules, as uvicorn runs them
+sys.path.insert(0, os.path.join(ROOT, "backend"))
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture(scope="session")
+def start_mock():
+    """Starts bench/mock_ollama.py with extra arguments; returns (process, url)
+
+    Every server started is killed when the test session ends.
+    """
+    processes = []
+
+    def start(*args):
+        port = _free_port()
+        process = subprocess.Popen(
+            [sys.executable, os.path.join(ROOT, "bench", "mock_ollama.py"), "--port", str(port),
+             "--tokens", "5", "--token-rate", "200", *args],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        processes.append(process)
+        url = f"http://127.0.0.1:{port}"
+        deadline = time.monotonic() + 20
+        while time.monotonic() < deadline:
+            try:
+                if httpx.get(f"{url}/api/tags", timeout=1).status_code == 200:
+                    return process, url
+            except httpx.TransportError:
+                time.sleep(0.1)
+        raise RuntimeError(f"mock Ollama on port {port} did not start")
+
+    yield start
+    for process in processes:
+        process.kill()
+        process.wait()
@@ -0,0 +1,80 @@
+import asyncio
+import json
+import os
+
+import pytest
+
+import batch
+from batch import BatchInputError, BatchJob, BatchJobs, JsonlSink, finished_pairs, load_questions, parse_concurrency
+from scheduler import QueueFullError
+
+
+@pytest.mark.parametrize("name", ["../secret.jsonl", "/etc/passwd", "sub/../../x.jsonl"])
+def test_input_outside_batch_dir_is_rejected(tmp_path, name):
+    jobs = BatchJobs(str(tmp_path / "jobs"))
+    with pytest.raises(BatchInputError):
+        jobs.input_path(name)
+
+
+def test_input_inside_batch_dir(tmp_path):
+    directory = tmp_path / "jobs"
+    (directory / "sub").mkdir(parents=True)
+    jobs = BatchJobs(str(directory))
+    assert jobs.input_path("sub/questions.jsonl") == os.path.join(os.path.realpath(directory), "sub", "questions.jsonl")
+
+
+def test_symlink_out_of_batch_dir_is_rejected(tmp_path):
+    directory = tmp_path / "jobs"
+    directory.mkdir()
+    (directory / "link.jsonl").symlink_to(tmp_path / "elsewhere.jsonl")
+    with pytest.raises(BatchInputError):
+        BatchJobs(str(directory)).input_path("link.jsonl")
+
+
+def test_job_ids_cannot_leave_batch_dir(tmp_path):
+    with pytest.raises(BatchInputError):
+        BatchJobs(str(tmp_path)).output_path("../x", "jsonl")
+
+
+def test_load_questions_formats():
+    lines = ['"plain"', '{"question": "q", "id": "a"}', "", '{"title": "T", "body": "B", "request_id": "r"}']
+    questions = load_questions(lines)
+    assert [q[1] for q in questions][:2] == ["plain", "q"]
+    assert questions[1][0] == "a"
+    with pytest.raises(BatchInputError):
+        load_questions(["{not json"])
+
+
+@pytest.mark.parametrize("value", ["four", None, "0", -2])
+def test_bad_concurrency_is_an_input_error(value):
+    with pytest.raises(BatchInputError):
+        parse_concurrency(value)
+
+
+def test_failing_pair_is_an_error_row_and_a_full_queue_is_retried(tmp_path, monkeypatch):
+    monkeypatch.setattr(batch, "BATCH_QUEUE_FULL_BACKOFF", 0)
+    calls = []
+
+    async def generate(model, prompt, sink, **kwargs):
+        calls.append(prompt)
+        if prompt == "full" and calls.count("full") == 1:
+            raise QueueFullError(9, 8)
+        if prompt == "bad":
+            raise RuntimeError("boom")
+        return f"answer to {prompt}"
+
+    questions = load_questions(['{"id": "1", "question": "full"}', '{"id": "2", "question": "bad"}',
+                                '{"id": "3", "question": "fine"}'])
+    sink = JsonlSink(str(tmp_path / "out.jsonl"))
+    job = BatchJob("t", questions, [("m", {"model_name": "m:latest"})], sink, generate,
+                   make_prompt=lambda question, *_: question, concurrency=2)
+    asyncio.run(job.run())
+
+    assert job.status == "completed"
+    assert (job.completed, job.failed) == (2, 1)
+    with open(sink.path) as f:
+        rows = {row["id"]: row for row in map(json.loads, f)}
+    assert rows["1"]["response"] == "answer to full"
+    assert rows["2"]["error"] == "RuntimeError: boom" and rows["2"]["response"] is None
+    # The error row is left for a resumed run to retry
+    assert finished_pairs(sink.path) == {("1", "m"), ("3", "m")}
@@ -0,0 +1,55 @@
+import asyncio
+import sqlite3
+
+from history import ComparisonHistory, fts5_available, fts_query
+
+
+def _history(tmp_path):
+    history = ComparisonHistory(enabled=True, path=str(tmp_path / "history.db"))
+    history.start()
+    return history
+
+
+def test_rerecorded_response_replaces_its_search_row(tmp_path):
+    history = _history(tmp_path)
+    history.record_session("s1", "why is the sky blue", {}, ["llama"])
+    history.record_response("s1", "llama", "llama3:8b", "Rayleigh scattering of sunlight")
+    history.record_response("s1", "llama", "llama3:8b", "Rayleigh scattering, shorter wavelengths")
+    history.close()
+
+    conn = sqlite3.connect(str(tmp_path / "history.db"))
+    try:
+        responses = conn.execute("SELECT response FROM responses WHERE session_id = 's1'").fetchall()
+        assert responses == [("Rayleigh scattering, shorter wavelengths",)]
+        if fts5_available():
+            rows = conn.execute("SELECT model FROM history_fts WHERE session_id = 's1' ORDER BY model").fetchall()
+            # The question row plus one row for the model
+            assert rows == [("",), ("llama",)]
+    finally:
+        conn.close()
+
+
+def test_error_replacing_a_response_removes_it_from_search(tmp_path):
+    history = _history(tmp_path)
+    history.record_session("s1", "question", {}, ["llama"])
+    history.record_response("s1", "llama", "llama3:8b", "a unique answer")
+    history.record_response("s1", "llama", "llama3:8b", "Error: cancelled")
+    history._writer.queue.join()
+    found = asyncio.run(history.search("unique"))
+    history.close()
+    assert found["items"] == [] or not fts5_available()
+
+
+def test_search_finds_responses_once(tmp_path):
+    history = _history(tmp_path)
+    history.record_session("s1", "question", {}, ["a", "b"])
+    history.record_response("s1", "a", "a:1", "photosynthesis converts light")
+    history.record_response("s1", "a", "a:1", "photosynthesis converts light")
+    history._writer.queue.join()
+    found = asyncio.run(history.search("photosynthesis"))
+    history.close()
+    assert [item["sessionId"] for item in found["items"]] == ["s1"]
+
+
+def test_fts_query_quotes_terms():
+    assert fts_query('say "hi" OR') == '"say" """hi""" "OR"'
@@ -0,0 +1,110 @@
+import asyncio
+import types
+
+import pytest
+
+import model_health
+from model_health import CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_OPEN_SECONDS, Deadline, ModelHealth, StallTimeout
+from model_profile import model_profiles
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """A hand-advanced time.monotonic for the circuit breaker"""
+    now = [1000.0]
+    monkeypatch.setattr(model_health, "time", types.SimpleNamespace(monotonic=lambda: now[0]))
+    return now
+
+
+def _open(health, model):
+    for _ in range(CIRCUIT_FAILURE_THRESHOLD):
+        assert health.allow(model) == (True, None)
+        health.failure(model, "boom")
+
+
+def test_deadline_expires_into_a_stall_timeout():
+    async def run():
+        deadline = Deadline()
+        deadline.extend(0.05, "first token")
+        try:
+            await asyncio.sleep(1)
+        except asyncio.CancelledError:
+            deadline.check()
+            raise
+    with pytest.raises(StallTimeout) as error:
+        asyncio.run(run())
+    assert error.value.kind == "first token"
+
+
+def test_deadline_pushed_back_or_cancelled_does_not_fire():
+    async def run():
+        deadline = Deadline()
+        deadline.extend(0.05, "first token")
+        for _ in range(5):
+            await asyncio.sleep(0.03)
+            deadline.extend(0.05, "next token")
+        deadline.cancel()
+        await asyncio.sleep(0.1)
+        return deadline.expired
+    assert asyncio.run(run()) is None
+
+
+def test_circuit_opens_after_consecutive_failures(clock):
+    health = ModelHealth()
+    for _ in range(CIRCUIT_FAILURE_THRESHOLD - 1):
+        health.failure("m", "boom")
+    health.success("m")
+    # A success in between resets the count
+    for _ in range(CIRCUIT_FAILURE_THRESHOLD - 1):
+        health.failure("m", "boom")
+    assert health.allow("m") == (True, None)
+
+    health.failure("m", "boom")
+    allowed, reason = health.allow("m")
+    assert not allowed and "boom" in reason
+    assert health.stats()["models"]["m"]["state"] == "open"
+
+
+def test_half_open_lets_one_probe_through_and_success_closes(clock):
+    health = ModelHealth()
+    _open(health, "m")
+    clock[0] += CIRCUIT_OPEN_SECONDS + 1
+    assert health.allow("m") == (True, None)
+    assert health.stats()["models"]["m"]["state"] == "half_open"
+    assert not health.allow("m")[0]  # only one probe at a time
+    health.success("m", first_token=0.5)
+    assert health.stats()["models"]["m"]["state"] == "closed"
+    assert health.allow("m") == (True, None)
+
+
+def test_failed_probe_reopens_for_twice_as_long(clock):
+    health = ModelHealth()
+    _open(health, "m")
+    clock[0] += CIRCUIT_OPEN_SECONDS + 1
+    assert health.allow("m")[0]
+    health.failure("m", "still down")
+    clock[0] += CIRCUIT_OPEN_SECONDS + 1
+    assert not health.allow("m")[0]
+    clock[0] += CIRCUIT_OPEN_SECONDS
+    assert health.allow("m")[0]
+
+
+def test_released_probe_frees_the_slot(clock):
+    health = ModelHealth()
+    _open(health, "m")
+    clock[0] += CIRCUIT_OPEN_SECONDS + 1
+    assert health.allow("m")[0]
+    health.release("m")  # e.g. the probe was cancelled
+    assert health.allow("m")[0]
+    assert health.stats()["models"]["m"]["state"] == "half_open"
+
+
+def test_hedge_after_adds_the_cold_load_or_skips_unprofiled_models(monkeypatch):
+    monkeypatch.setattr(model_profiles, "_models", {"profiled": {"firstTokenP95": 3.0, "coldLoadSeconds": 20.0}})
+    health = ModelHealth()
+    assert health.hedge_after("profiled") == 6.0
+    assert health.hedge_after("profiled", loaded=False) == 26.0
+    for _ in range(health.min_samples):
+        health.success("unprofiled", first_token=2.0)
+    assert health.hedge_after("unprofiled") == 4.0
+    assert health.hedge_after("unprofiled", loaded=False) is None
@@ -0,0 +1,45 @@
+import asyncio
+
+import httpx
+import pytest
+
+from model_profile import profile_model
+from ollama_client import OllamaHosts
+
+MODEL = "mock-1:latest"
+
+
+def _profile_resident(url, before_profiling=None):
+    """Profile MODEL on a host where it is already loaded, as on one that is serving"""
+    async def run():
+        pool = OllamaHosts([url], health_interval=0)
+        await pool.start()
+        try:
+            await pool.request(MODEL, "POST", "/api/generate", json={"model": MODEL, "prompt": "", "stream": False})
+            await pool.check()
+            assert MODEL in pool.hosts[0].loaded
+            if before_profiling is not None:
+                before_profiling(pool)
+            return await profile_model(MODEL, prompts=("hi",), pool=pool)
+        finally:
+            await pool.close()
+    return asyncio.run(run())
+
+
+def test_cold_load_is_timed_after_the_model_has_left_memory(start_mock):
+    _, url = start_mock("--load-delay", "0.3")
+    profile = _profile_resident(url)
+    assert profile["coldLoadSeconds"] >= 0.3
+    assert profile["runs"] == 1 and profile["firstTokenP95"] is not None
+
+
+def test_failed_unload_is_an_error_not_a_warm_cold_load(start_mock):
+    _, url = start_mock("--load-delay", "0.3")
+
+    def refuse_unloads(pool):
+        async def post(path, **kwargs):
+            return httpx.Response(500)
+        pool.hosts[0].client.post = post
+
+    with pytest.raises(Exception, match="Unloading mock-1:latest"):
+        _profile_resident(url, refuse_unloads)
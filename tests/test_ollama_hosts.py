@@ -0,0 +1,132 @@
+import asyncio
+import time
+
+import pytest
+
+import ollama_client
+from ollama_client import OllamaHosts, stream_generate
+
+OPTIONS = {"num_predict": 5}
+
+
+@pytest.fixture(scope="module")
+def mocks(start_mock):
+    """Two quick stand-in hosts and one whose first token takes 2s"""
+    started = [start_mock("--ttft", "0.02"), start_mock("--ttft", "0.02"), start_mock("--ttft", "2")]
+    return {"fast": [url for _, url in started[:2]], "slow": started[2][1]}
+
+
+async def _generate(pool, model, **kwargs):
+    timings = {}
+    chunks = [chunk async for chunk in stream_generate(model, "hi", OPTIONS, pool=pool, timings=timings, **kwargs)]
+    assert chunks[-1]["done"]
+    return timings
+
+
+def test_concurrent_generations_spread_then_stick_to_the_loaded_host(mocks):
+    async def run():
+        pool = OllamaHosts(mocks["fast"], health_interval=0)
+        await pool.start()
+        try:
+            await pool.check()
+            first = asyncio.ensure_future(_generate(pool, "mock-1:latest"))
+            await asyncio.sleep(0.01)  # let the first stream reach its host
+            second = asyncio.ensure_future(_generate(pool, "mock-1:latest"))
+            spread = {timings["host"] for timings in await asyncio.gather(first, second)}
+            # The second host has served more by now, but only it has mock-2 loaded
+            pool.hosts[1].requests += 10
+            pool.hosts[1].loaded.add("mock-2:latest")
+            loaded = await _generate(pool, "mock-2:latest")
+            return spread, loaded["host"], pool.failovers, pool.hedges
+        finally:
+            await pool.close()
+
+    spread, loaded, failovers, hedges = asyncio.run(run())
+    assert spread == set(mocks["fast"])
+    assert loaded == mocks["fast"][1]
+    assert failovers == hedges == 0
+
+
+def test_serving_host_killed_fails_over_and_is_not_a_hedge_win(mocks, start_mock):
+    process, url = start_mock("--ttft", "0.02")
+
+    async def run():
+        pool = OllamaHosts([url, mocks["fast"][0]], health_interval=0)
+        await pool.start()
+        try:
+            served = await _generate(pool, "mock-1:latest", hedge_after=1.0)
+            process.kill()
+            process.wait()
+            # The dead host still looks healthy and has the model loaded, so it is tried first
+            after = await _generate(pool, "mock-1:latest", hedge_after=1.0)
+            return served, after, pool
+        finally:
+            await pool.close()
+
+    served, after, pool = asyncio.run(run())
+    assert served["host"] == url
+    assert after["host"] == mocks["fast"][0]
+    assert after["hosts_tried"] == 2 and not after["hedged"]
+    assert pool.failovers == 1
+    assert pool.hedges == pool.hedge_wins == 0
+    assert not pool.hosts[0].healthy
+
+
+def test_slow_first_token_is_hedged_on_another_host(mocks):
+    async def run():
+        # Neither host has anything loaded, so the slow one, listed first, is picked
+        pool = OllamaHosts([mocks["slow"], mocks["fast"][0]], health_interval=0)
+        await pool.start()
+        try:
+            started = time.monotonic()
+            timings = await _generate(pool, "mock-2:latest", hedge_after=0.2)
+            return timings, time.monotonic() - started, pool
+        finally:
+            await pool.close()
+
+    timings, elapsed, pool = asyncio.run(run())
+    assert timings["host"] == mocks["fast"][0] and timings["hedged"]
+    assert elapsed < 1.5
+    assert pool.hedges == pool.hedge_wins == 1
+    assert pool.failovers == 0
+    # The losing copy was closed, not left streaming
+    assert all(host.active == 0 for host in pool.hosts)
+
+
+def test_cancel_while_the_losing_copy_closes_reaches_the_caller(monkeypatch):
+    pool = OllamaHosts(["http://slow.invalid", "http://fast.invalid"], health_interval=0)
+    slow, fast = pool.hosts
+    closed = []
+
+    async def generate_on(host, model, payload, timeout, connected):
+        try:
+            if host is slow:
+                await asyncio.sleep(5)
+            yield {"response": "hi", "done": False}
+            yield {"response": "", "done": True}
+        finally:
+            if host is slow:
+                await asyncio.sleep(0.2)  # tearing the connection down takes a while
+            closed.append(host)
+
+    monkeypatch.setattr(ollama_client, "_generate_on", generate_on)
+
+    async def run():
+        chunks = []
+
+        async def consume():
+            async for chunk in stream_generate("m", "hi", OPTIONS, pool=pool, hedge_after=0.05):
+                chunks.append(chunk)
+
+        caller = asyncio.ensure_future(consume())
+        # The hedge answers at 0.05s; the slow copy is still closing at 0.1s
+        await asyncio.sleep(0.1)
+        caller.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await caller
+        await asyncio.sleep(0.3)
+        return chunks
+
+    assert asyncio.run(run()) == []
+    # The winner is closed too, though it was never read
+    assert fast in closed
@@ -0,0 +1,20 @@
+from outbound import _merge
+
+
+def test_v2_deltas_are_concatenated_from_the_queued_offset():
+    queued = {"status": "delta", "model": "m", "offset": 0, "delta": "Hel", "seq": 1}
+    assert _merge(queued, {"status": "delta", "model": "m", "offset": 3, "delta": "lo", "seq": 2})
+    assert queued == {"status": "delta", "model": "m", "offset": 0, "delta": "Hello", "seq": 2}
+
+
+def test_v1_frames_keep_the_later_text_instead_of_repeating_it():
+    queued = {"status": "streaming", "model": "m", "content": "Hel", "full_response": "Hel"}
+    assert _merge(queued, {"status": "streaming", "model": "m", "content": "lo", "full_response": "Hello"})
+    assert queued["full_response"] == "Hello"
+    assert queued["content"] == "lo"
+
+
+def test_frames_of_a_different_status_are_not_merged():
+    queued = {"status": "streaming", "model": "m", "content": "Hel", "full_response": "Hel"}
+    assert not _merge(queued, {"status": "completed", "model": "m", "full_response": "Hello"})
+    assert queued["full_response"] == "Hel"
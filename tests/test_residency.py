@@ -0,0 +1,36 @@
+import asyncio
+import types
+
+from ollama_client import ollama_pool
+from residency import ResidencyPlan, ResidencyTracker
+
+
+def test_started_warms_the_next_model_without_holding_up_the_generation(monkeypatch):
+    warmed = []
+
+    async def running_models():
+        await asyncio.sleep(0.2)  # /api/ps on every host
+        return [{"name": "a:1b", "size": 1_000}]
+
+    async def request(tag, method, path, **kwargs):
+        warmed.append(tag)
+        return types.SimpleNamespace(status_code=200)
+
+    monkeypatch.setattr(ollama_pool, "running_models", running_models)
+    monkeypatch.setattr(ollama_pool, "request", request)
+    models = {"a": {"model_name": "a:1b", "size": 1_000}, "b": {"model_name": "b:1b", "size": 1_000}}
+
+    async def run():
+        tracker = ResidencyTracker(memory_bytes=10_000)
+        plan = ResidencyPlan(["a", "b"], [], [["a", "b"]])
+        started = asyncio.get_running_loop().time()
+        tracker.started(plan, "a", models)
+        returned_after = asyncio.get_running_loop().time() - started
+        assert "a:1b" in tracker.loaded and not warmed
+        await asyncio.sleep(0.3)
+        return returned_after, plan, tracker
+
+    returned_after, plan, tracker = asyncio.run(run())
+    assert returned_after < 0.05
+    assert plan.warmed == ["b"] and warmed == ["b:1b"]
+    assert set(tracker.loaded) == {"a:1b", "b:1b"}
@@ -0,0 +1,139 @@
+import asyncio
+import itertools
+import json
+import types
+
+from resume import SessionBuffers, SessionChannel
+
+
+class Outbox:
+    """Records what a connection was sent; broken=True acts like a dropped socket"""
+
+    _ids = itertools.count(1)
+
+    def __init__(self, broken: bool = False):
+        self.id = next(Outbox._ids)
+        self.broken = broken
+        self.closed = False
+        self.frames = []
+
+    async def send_message(self, message: dict):
+        if self.broken:
+            raise ConnectionError("socket closed")
+        self.frames.append(message)
+
+    async def send_text(self, payload: str):
+        if self.broken:
+            raise ConnectionError("socket closed")
+        self.frames.append(json.loads(payload))
+
+
+def _delta(model: str, seq: int, text: str) -> dict:
+    return {"model": model, "status": "delta", "v": 2, "seq": seq, "delta": text}
+
+
+def test_resume_sends_what_the_client_missed_from_its_utf16_offset():
+    async def run():
+        first = Outbox()
+        channel = SessionChannel("s1", protocol=2, outbox=first)
+        await channel.send_text(json.dumps({"status": "starting", "sessionId": "s1"}))
+        await channel.send_message(_delta("a", 1, "Hel"))
+        await channel.send_message(_delta("a", 2, "lo 😀"))
+        first.broken = True
+        await channel.send_message(_delta("a", 3, " world"))
+        await channel.send_message(_delta("b", 1, "Hi"))
+        assert channel.outbox is None  # recording carries on without a socket
+
+        second = Outbox()
+        # The first connection saw "Hello 😀": 8 UTF-16 units, the emoji is two
+        replayed = await channel.attach(second, {"a": 8})
+        await channel.send_message(_delta("a", 4, "!"))
+        return first.frames, second.frames, replayed
+
+    first, second, replayed = asyncio.run(run())
+    assert [frame.get("delta") for frame in first] == [None, "Hel", "lo 😀"]
+    assert replayed == 3
+    starting, a, b, live = second
+    assert starting["status"] == "starting"
+    assert (a["model"], a["offset"], a["delta"], a["seq"], a["replay"]) == ("a", 8, " world", 3, True)
+    assert (b["model"], b["offset"], b["delta"]) == ("b", 0, "Hi")
+    assert live["delta"] == "!"
+
+
+def test_replay_skips_done_models_and_ends_with_session_status():
+    async def run():
+        channel = SessionChannel("s1", protocol=2)
+        await channel.send_message({"status": "starting", "sessionId": "s1"})
+        await channel.send_message(_delta("a", 1, "one"))
+        await channel.send_message({"model": "a", "status": "completed", "full_response": "one."})
+        await channel.send_message(_delta("b", 1, "two"))
+        await channel.send_message({"model": "b", "status": "completed", "full_response": "two"})
+        await channel.send_message({"status": "all_completed", "sessionId": "s1"})
+        return channel.replay({"a": 3}, done=("b",))
+
+    frames = [json.loads(frame) if isinstance(frame, str) else frame for frame in asyncio.run(run())]
+    # a's final text differs from what was streamed, so the difference is replayed before it
+    assert [(frame.get("model"), frame["status"]) for frame in frames] == [
+        (None, "starting"), ("a", "delta"), ("a", "completed"), (None, "all_completed")]
+    assert frames[1]["delta"] == "."
+
+
+def test_detached_session_expires_after_the_grace_period_unless_resumed():
+    async def run():
+        buffers = SessionBuffers(grace=0.05)
+        expired = []
+
+        async def on_expire(channel, reason):
+            expired.append((channel.session_id, reason))
+        buffers.on_expire = on_expire
+
+        generation = asyncio.create_task(asyncio.sleep(10))
+        kept = buffers.open("kept", 2, Outbox())
+        lost = buffers.open("lost", 2, Outbox())
+        for channel in (kept, lost):
+            channel.run = types.SimpleNamespace(task=generation)
+            await buffers.detach(channel, channel.outbox)
+        await buffers.resume("kept", Outbox(), {}, token=kept.token)
+        await asyncio.sleep(0.15)
+        generation.cancel()
+        missed = await buffers.resume("lost", Outbox(), {}, token=lost.token)
+        return expired, missed, buffers
+
+    expired, missed, buffers = asyncio.run(run())
+    assert expired == [("lost", "disconnected")]
+    assert missed is None
+    assert (buffers.resumed, buffers.resume_misses, buffers.expired) == (1, 1, 1)
+
+
+def test_old_connection_dropping_after_a_resume_does_not_detach():
+    async def run():
+        buffers = SessionBuffers(grace=60)
+        old = Outbox()
+        channel = buffers.open("s1", 2, old)
+        await buffers.resume("s1", Outbox(), {}, token=channel.token)
+        await buffers.detach(channel, old)
+        return channel
+
+    channel = asyncio.run(run())
+    assert channel.outbox is not None and channel.detached_at is None
+
+
+def test_resume_from_another_connection_needs_the_token():
+    async def run():
+        buffers = SessionBuffers(grace=60)
+        owner = Outbox()
+        channel = buffers.open("s1", 2, owner)
+        await channel.send_message(_delta("a", 1, "secret"))
+        thief = Outbox()
+        stolen = await buffers.resume("s1", thief, {})
+        guessed = await buffers.resume("s1", thief, {}, token="guess")
+        same_socket = await buffers.resume("s1", owner, {})
+        reconnected = Outbox()
+        resumed = await buffers.resume("s1", reconnected, {}, token=channel.token)
+        return stolen, guessed, same_socket, resumed, thief, reconnected, buffers
+
+    stolen, guessed, same_socket, resumed, thief, reconnected, buffers = asyncio.run(run())
+    assert stolen is None and guessed is None and thief.frames == []
+    assert same_socket is not None and resumed is not None
+    assert reconnected.frames[0]["delta"] == "secret"
+    assert buffers.resume_rejected == 2
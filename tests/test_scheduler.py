@@ -0,0 +1,141 @@
+import asyncio
+
+import pytest
+
+from scheduler import FairScheduler, QueueFullError
+
+
+async def _hold(scheduler, session, model, order, release, session_limit=None, positions=None):
+    async def on_queued(position):
+        if positions is not None:
+            positions[(session, len(positions))] = position
+
+    async with scheduler.slot(session, model, session_limit, on_queued=on_queued):
+        order.append(session)
+        await release.wait()
+
+
+def test_sessions_take_turns():
+    async def run():
+        scheduler = FairScheduler(global_limit=1, per_model_limit=1, max_queue=10)
+        order = []
+        gates = {}
+        tasks = []
+        for session in ("a", "a", "a", "b", "b"):
+            gates[len(tasks)] = gate = asyncio.Event()
+            tasks.append(asyncio.create_task(_hold(scheduler, session, "m", order, gate)))
+            await asyncio.sleep(0)
+        for index in range(len(tasks)):
+            gates[index].set()
+            await asyncio.sleep(0)
+            await asyncio.sleep(0)
+        await asyncio.gather(*tasks)
+        return order
+
+    # "a" got the free slot; after that the sessions alternate instead of "a" draining its queue
+    assert asyncio.run(run()) == ["a", "a", "b", "a", "b"]
+
+
+def test_queued_position_follows_dispatch_order():
+    async def run():
+        scheduler = FairScheduler(global_limit=1, per_model_limit=1, max_queue=10)
+        release = asyncio.Event()
+        positions = {}
+        holder = asyncio.create_task(_hold(scheduler, "x", "m", [], release))
+        await asyncio.sleep(0)
+        tasks = []
+        for session in ("a", "a", "a", "b"):
+            tasks.append(asyncio.create_task(_hold(scheduler, session, "m", [], release, positions=positions)))
+            await asyncio.sleep(0)
+        release.set()
+        await asyncio.gather(holder, *tasks)
+        return list(positions.values())
+
+    # a's 2nd and 3rd wait behind b's 1st, which joined later
+    assert asyncio.run(run()) == [1, 2, 3, 2]
+
+
+def test_position_counts_later_sessions_for_earlier_rounds():
+    async def run():
+        scheduler = FairScheduler(global_limit=1, per_model_limit=1, max_queue=10)
+        release = asyncio.Event()
+        holder = asyncio.create_task(_hold(scheduler, "x", "m", [], release))
+        await asyncio.sleep(0)
+        tasks = [asyncio.create_task(_hold(scheduler, s, "m", [], release)) for s in ("a", "a", "b", "b", "c")]
+        await asyncio.sleep(0)
+        queues = scheduler._queues
+        positions = [scheduler.position(session, waiter) for session in queues for waiter in queues[session]]
+        release.set()
+        await asyncio.gather(holder, *tasks)
+        return positions
+
+    # Dispatch order: a1 b1 c1 a2 b2
+    assert asyncio.run(run()) == [1, 4, 2, 5, 3]
+
+
+def test_per_model_limit_lets_other_models_through():
+    async def run():
+        scheduler = FairScheduler(global_limit=3, per_model_limit=1, max_queue=10)
+        release = asyncio.Event()
+        order = []
+        tasks = [asyncio.create_task(_hold(scheduler, s, m, order, release))
+                 for s, m in (("a", "big"), ("b", "big"), ("c", "small"))]
+        await asyncio.sleep(0)
+        running = list(order)
+        release.set()
+        await asyncio.gather(*tasks)
+        return running
+
+    assert asyncio.run(run()) == ["a", "c"]
+
+
+def test_session_limit():
+    async def run():
+        scheduler = FairScheduler(global_limit=4, per_model_limit=4, max_queue=10)
+        release = asyncio.Event()
+        order = []
+        tasks = [asyncio.create_task(_hold(scheduler, "a", f"m{i}", order, release, session_limit=1))
+                 for i in range(3)]
+        await asyncio.sleep(0)
+        running = len(order)
+        release.set()
+        await asyncio.gather(*tasks)
+        return running
+
+    assert asyncio.run(run()) == 1
+
+
+def test_queue_bound():
+    async def run():
+        scheduler = FairScheduler(global_limit=1, per_model_limit=1, max_queue=1)
+        release = asyncio.Event()
+        tasks = [asyncio.create_task(_hold(scheduler, "a", "m", [], release)) for _ in range(2)]
+        await asyncio.sleep(0)
+        with pytest.raises(QueueFullError):
+            await scheduler.acquire("b", "m")
+        with pytest.raises(QueueFullError):
+            scheduler.check_capacity(1)
+        release.set()
+        await asyncio.gather(*tasks)
+        return scheduler.stats()
+
+    stats = asyncio.run(run())
+    assert stats["active"] == 0 and stats["queued"] == 0 and stats["rejected"] == 2
+
+
+def test_cancelled_waiter_leaves_the_queue():
+    async def run():
+        scheduler = FairScheduler(global_limit=1, per_model_limit=1, max_queue=10)
+        release = asyncio.Event()
+        holder = asyncio.create_task(_hold(scheduler, "a", "m", [], release))
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(_hold(scheduler, "b", "m", [], release))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        queued = scheduler.stats()["queued"]
+        release.set()
+        await holder
+        return queued, scheduler.stats()["active"]
+
+    assert asyncio.run(run()) == (0, 0)
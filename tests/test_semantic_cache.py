@@ -0,0 +1,63 @@
+import numpy as np
+
+from semantic_cache import CANDIDATES, VectorIndex
+
+DIMENSIONS = 384
+
+
+def _unit_rows(rng, count: int) -> np.ndarray:
+    rows = rng.standard_normal((count, DIMENSIONS)).astype(np.float32)
+    return rows / np.linalg.norm(rows, axis=1, keepdims=True)
+
+
+def _near(rng, vectors: np.ndarray, noise: float) -> np.ndarray:
+    """Rephrasings: each vector nudged so its cosine to the original is about 1 / sqrt(1 + noise**2)"""
+    rows = vectors + noise * _unit_rows(rng, len(vectors))
+    return rows / np.linalg.norm(rows, axis=1, keepdims=True)
+
+
+def test_search_finds_the_exact_nearest_neighbour():
+    rng = np.random.default_rng(1)
+    stored = _unit_rows(rng, 20 * CANDIDATES)
+    index = VectorIndex(DIMENSIONS, len(stored))
+    for row, vector in enumerate(stored):
+        index.add(vector, group=1, created=1.0 + row)
+
+    # Cosine about 0.93, near SEMANTIC_CACHE_THRESHOLD; the prefilter must not lose the match
+    queries = _near(rng, stored[:500], 0.4)
+    found = 0
+    for query in queries:
+        best = int(np.argmax(stored @ query))
+        match = index.search(query, group=1)
+        if match is not None and match[0] == best:
+            found += 1
+            assert abs(match[1] - float(stored[best] @ query)) < 1e-2  # float16 storage
+    assert found / len(queries) >= 0.99
+
+
+def test_search_is_limited_to_the_group_and_to_live_rows():
+    rng = np.random.default_rng(2)
+    a, b = _unit_rows(rng, 2)
+    index = VectorIndex(DIMENSIONS, 4)
+    index.add(a, group=1, created=10.0)
+    index.add(b, group=2, created=20.0)
+
+    assert index.search(a, group=1)[0] == 0
+    assert index.search(a, group=2)[0] == 1  # the only row in group 2, however far
+    assert index.search(a, group=3) is None
+    assert index.search(a, group=1, added_after=10.0) is None
+    assert index.live(added_after=15.0) == 1
+
+
+def test_full_index_replaces_the_oldest_row_and_persists(tmp_path):
+    rng = np.random.default_rng(3)
+    vectors = _unit_rows(rng, 4)
+    index = VectorIndex(DIMENSIONS, 3, directory=str(tmp_path))
+    rows = [index.add(vector, group=1, created=1.0 + i) for i, vector in enumerate(vectors)]
+    assert rows == [0, 1, 2, 0]
+    index.flush()
+
+    reopened = VectorIndex(DIMENSIONS, 3, directory=str(tmp_path))
+    assert reopened.filled == 3
+    assert reopened.search(vectors[3], group=1)[0] == 0
+    assert reopened.search(vectors[0], group=1)[1] < 0.5  # evicted
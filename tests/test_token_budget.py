@@ -0,0 +1,101 @@
+import numpy as np
+
+from token_budget import TOKEN_BUDGET_HEADROOM, TOKEN_BUDGET_QUANTILE, StopHint, TokenBudgets, target_tokens
+
+
+def test_stop_hint_counts_words_split_across_chunks_once():
+    hint = StopHint(max_words=4)
+    chunks = ["The", " sk", "y is", "", " blu", "e", " today", "."]
+    stops = [hint.push(chunk) for chunk in chunks]
+    assert hint.words == 5
+    # Past four words, but only a sentence end stops it
+    assert stops == [False] * 7 + [True]
+
+
+def test_stop_hint_stops_at_a_line_end():
+    hint = StopHint(max_words=2)
+    assert not hint.push("- one two")
+    assert hint.push(" three\n")
+
+
+def _budgets(**kwargs):
+    return TokenBudgets(adaptive=True, window=50, min_samples=5, stop_hint=True, **kwargs)
+
+
+def test_budget_is_the_target_until_there_are_enough_samples():
+    budgets = _budgets()
+    target = target_tokens("medium")
+    assert budgets.num_predict("m", "medium") == int(target * TOKEN_BUDGET_HEADROOM)
+    for _ in range(4):
+        budgets.record("m", "medium", "10", 3 * target, 2000)
+    assert budgets.num_predict("m", "medium") == int(target * TOKEN_BUDGET_HEADROOM)
+
+
+def test_budget_follows_the_quantile_of_recorded_tokens():
+    budgets = _budgets()
+    used = [900 + 10 * i for i in range(20)]
+    for tokens in used:
+        budgets.record("verbose", "medium", "10", tokens, 2000)
+    expected = int(float(np.percentile(used, TOKEN_BUDGET_QUANTILE)) * TOKEN_BUDGET_HEADROOM)
+    assert budgets.num_predict("verbose", "medium") == min(2000, expected)
+    # Terse models still get the target
+    for _ in range(20):
+        budgets.record("terse", "medium", "10", 50, 2000)
+    assert budgets.num_predict("terse", "medium") == int(target_tokens("medium") * TOKEN_BUDGET_HEADROOM)
+
+
+def test_custom_lengths_are_learned_per_line():
+    budgets = _budgets()
+    for _ in range(10):
+        budgets.record("m", "custom", "20", 20 * 60, 2000)
+    assert budgets.num_predict("m", "custom", "5") == int(max(5 * 60, target_tokens("custom", "5")) * TOKEN_BUDGET_HEADROOM)
+    assert budgets.num_predict("m", "custom", "10") == int(max(10 * 60, target_tokens("custom", "10")) * TOKEN_BUDGET_HEADROOM)
+
+
+def test_stopped_generations_count_as_usage_but_not_samples():
+    budgets = _budgets()
+    for _ in range(10):
+        budgets.record("m", "medium", "10", 900, 2000)
+    before = budgets.num_predict("m", "medium")
+    # A stopped stream only saw a few chunks; recording them would drag the quantile down
+    for _ in range(40):
+        budgets.record("m", "medium", "10", 40, 2000, stopped=True)
+    assert budgets.num_predict("m", "medium") == before
+
+    usage = budgets.stats()["usage"]["adaptive"]
+    assert (usage["generations"], usage["stoppedAtTarget"], usage["truncated"]) == (50, 40, 0)
+    assert budgets.stats()["models"]["m medium"]["samples"] == 10
+
+
+def test_truncated_generations_raise_the_budget():
+    budgets = _budgets()
+    budget = budgets.num_predict("m", "long")
+    for _ in range(10):
+        budgets.record("m", "long", "10", budget, budget, truncated=True)
+    assert budgets.num_predict("m", "long") > budget
+    assert budgets.stats()["usage"]["adaptive"]["truncated"] == 10
+
+
+def test_the_policy_not_in_use_is_simulated_from_the_same_answers():
+    budgets = _budgets()
+    fixed = 500  # TOKEN_LIMITS["medium"]
+    budgets.record("m", "medium", "10", 300, 600)  # finished: the same under either budget
+    budgets.record("m", "medium", "10", 700, 900)  # finished: the fixed table cuts it at 500
+    budgets.record("m", "medium", "10", 600, 600, truncated=True)  # cut off: fixed cuts it sooner
+    budgets.record("m", "medium", "10", 250, 600, stopped=True)  # stopped by the hint under both
+    usage = budgets.stats()["usage"]
+
+    assert not usage["adaptive"]["simulated"] and usage["fixed"]["simulated"]
+    assert (usage["adaptive"]["tokens"], usage["adaptive"]["truncated"]) == (1850, 1)
+    assert usage["fixed"]["tokens"] == 300 + fixed + fixed + 250
+    assert (usage["fixed"]["truncated"], usage["fixed"]["stoppedAtTarget"], usage["fixed"]["lowerBounds"]) == (2, 1, 0)
+
+
+def test_a_cut_off_answer_is_a_lower_bound_under_a_larger_budget():
+    budgets = TokenBudgets(adaptive=False, window=50, min_samples=5, stop_hint=False)
+    budgets.record("m", "brief", "10", 100, 100, truncated=True)
+    usage = budgets.stats()["usage"]
+    # The adaptive budget for brief is larger than the fixed 100, so how long the answer would have run is unknown
+    assert usage["adaptive"]["simulated"]
+    assert (usage["adaptive"]["tokens"], usage["adaptive"]["truncated"], usage["adaptive"]["lowerBounds"]) == (100, 0, 1)
+    assert (usage["fixed"]["truncated"], usage["fixed"]["lowerBounds"]) == (1, 0)